@@ -0,0 +1,190 @@
+"""Аналитика сессий телеметрии на NumPy.
+
+Данные сессии декодируются сразу в структурированный массив событий (ts, code, value)
+без построчного разбора: куски в столбцовом формате (см. db.encode_columns) читаются
+через np.frombuffer, текст разбивается по разделителям и преобразуется в числа целыми
+столбцами. Статистика (события по кодам, частота событий, распределение интервалов
+между событиями, длительность) считается векторно, а по сессиям работа раздается
+процессам ProcessPoolExecutor, каждый из которых открывает БД сам.
+
+Требуется numpy (серверу и db.py он не нужен):
+    python3 analytics.py -d DB_PATH [--user U] [--since 2023-03-01] [-j 8]
+"""
+
+import os
+import sys
+import argparse
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from db import (Database, DB_PATH, CODEC_MARKER, LAYOUT_COLUMNS, COMPRESSORS, COLUMNS_HEADER,
+                parse_events)
+
+
+EVENT_DTYPE     = np.dtype([("ts", "<i8"), ("code", "u1"), ("value", "<f8")])
+INTERVAL_BINS   = np.array([0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000, np.inf])     # мс
+PERCENTILES     = (50, 90, 99)
+MAP_CHUNKSIZE   = 16        # сессий в одном задании процессу
+
+
+def columns_to_array(payload):
+    """Столбцовый формат (дельты времени, коды, типы, целые, дробные) -> массив событий"""
+    n, n_ints = COLUMNS_HEADER.unpack_from(payload)
+    pos = COLUMNS_HEADER.size
+    deltas = np.frombuffer(payload, "<i8", n, pos)
+    codes = np.frombuffer(payload, "u1", n, pos + 8 * n)
+    kinds = np.frombuffer(payload, "u1", n, pos + 9 * n).astype(bool)
+    pos += 10 * n
+    ints = np.frombuffer(payload, "<i8", n_ints, pos)
+    floats = np.frombuffer(payload, "<f8", n - n_ints, pos + 8 * n_ints)
+
+    events = np.empty(n, EVENT_DTYPE)
+    events["ts"] = np.cumsum(deltas)
+    events["code"] = codes
+    events["value"][~kinds] = ints
+    events["value"][kinds] = floats
+    return events
+
+def text_to_array(data):
+    """Текст `timestamp;code;value\\n` -> массив событий: поля разбиваются по разделителям
+    одним вызовом и преобразуются в числа целыми столбцами. Число полей проверяется 
+    в каждой строке (по разделителям до конца строки), а не только в сумме: иначе строки 
+    из 2 и 4 полей сдвинули бы столбцы. Если в тексте есть строки не по формату, разбор 
+    идет построчно с пропуском таких строк"""
+    raw = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(raw == ord("\n"))
+    if len(raw) and raw[-1] != ord("\n"):
+        ends = np.append(ends, len(raw) - 1)
+    separators = np.cumsum(raw == ord(";"))[ends]
+    fields = data.replace(b"\n", b";").split(b";")
+    if fields[-1] == b"":
+        fields.pop()
+    try:
+        if (np.diff(separators, prepend=0) != 2).any():
+            raise ValueError("Not three fields in every line")
+        table = np.array(fields, dtype=bytes).reshape(-1, 3)
+        events = np.empty(len(table), EVENT_DTYPE)
+        events["ts"] = table[:, 0].astype(np.int64)
+        events["code"] = table[:, 1].astype(np.uint8)
+        events["value"] = table[:, 2].astype(np.float64)
+    except (ValueError, OverflowError):
+        events = np.array(parse_events(data), dtype=EVENT_DTYPE)
+    return events
+
+def blob_to_array(blob):
+    """Хранимый кусок (сжатый или нет, см. db.encode_blob) -> массив событий"""
+    blob = bytes(blob)
+    if not blob.startswith(CODEC_MARKER):
+        return text_to_array(blob)
+    layout, method = blob[1], blob[2]
+    decompress = {m: d for m, _, d in COMPRESSORS.values()}[method]
+    payload = decompress(blob[3:])
+    return columns_to_array(payload) if layout == LAYOUT_COLUMNS else text_to_array(payload)
+
+def load_session(db, session_id):
+    """Массив событий сессии в порядке записи"""
+    with db.session_reader(session_id) as (conn, p):
+        row = conn.execute(f"SELECT blob FROM {p}.sessions WHERE id = ?;", (session_id, )).fetchone() if p else None
+        if row is None:
+            return np.empty(0, EVENT_DTYPE)
+        if row.blob is not None:
+            return blob_to_array(row.blob)
+        chunks = conn.execute(f"SELECT data FROM {p}.chunks WHERE session_id = ? ORDER BY seq;", (session_id, )).fetchall()
+    if not chunks:
+        return np.empty(0, EVENT_DTYPE)
+    return np.concatenate([blob_to_array(chunk.data) for chunk in chunks])
+
+
+def session_stats(events):
+    """Статистика одной сессии: количество событий, длительность (мс), частота (событий/с),
+    события по кодам (массив на 256 кодов) и гистограмма интервалов между событиями по
+    INTERVAL_BINS. Гистограммы суммируются между сессиями, поэтому отчет по всей БД
+    не требует держать все интервалы в памяти"""
+    ts = np.sort(events["ts"])
+    duration = int(ts[-1] - ts[0]) if len(ts) else 0
+    intervals = np.diff(ts)
+    return {
+        "events":       len(events),
+        "duration":     duration,
+        "rate":         len(events) / (duration / 1000) if duration else 0.0,
+        "codes":        np.bincount(events["code"], minlength=256),
+        "intervals":    np.histogram(intervals, INTERVAL_BINS)[0],
+        "max_interval": int(intervals.max()) if len(intervals) else 0,
+    }
+
+
+_db = None
+
+def _open_db(db_path):
+    """Инициализатор процесса пула: у каждого процесса свое соединение с БД"""
+    global _db
+    _db = Database(db_path)
+
+def _analyze(session_id):
+    return session_id, session_stats(load_session(_db, session_id))
+
+
+def analyze(db_path, session_ids, jobs=None):
+    """Генератор (session_id, статистика) по сессиям, jobs процессов (None - по числу ядер,
+    1 - в текущем процессе)"""
+    if jobs == 1:
+        _open_db(db_path)
+        yield from map(_analyze, session_ids)
+        return
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_open_db, initargs=(db_path, )) as executor:
+        yield from executor.map(_analyze, session_ids, chunksize=MAP_CHUNKSIZE)
+
+def summarize(results):
+    """Сводит статистику сессий: суммы по кодам и гистограмме интервалов,
+    перцентили длительности и частоты событий по сессиям"""
+    codes = np.zeros(256, np.int64)
+    intervals = np.zeros(len(INTERVAL_BINS) - 1, np.int64)
+    durations, rates, events = [], [], 0
+    for _, stats in results:
+        codes += stats["codes"]
+        intervals += stats["intervals"]
+        events += stats["events"]
+        durations.append(stats["duration"])
+        rates.append(stats["rate"])
+    durations, rates = np.array(durations, np.float64), np.array(rates, np.float64)
+    return {
+        "sessions":     len(durations),
+        "events":       events,
+        "codes":        {int(c): int(codes[c]) for c in np.flatnonzero(codes)},
+        "intervals":    intervals,
+        "duration":     dict(zip(PERCENTILES, np.percentile(durations, PERCENTILES))) if len(durations) else {},
+        "rate":         dict(zip(PERCENTILES, np.percentile(rates, PERCENTILES))) if len(rates) else {},
+    }
+
+def print_report(summary):
+    print(f"Sessions: {summary['sessions']}, events: {summary['events']}")
+    for name, unit in (("duration", "ms"), ("rate", "events/sec")):
+        values = "  ".join(f"p{p} {v:.1f}" for p, v in summary[name].items())
+        print(f"Session {name}, {unit}: {values}")
+    print("Events by code:")
+    for code, count in summary["codes"].items():
+        print(f"{code}\t{count}")
+    print("Inter-event intervals, ms:")
+    for low, high, count in zip(INTERVAL_BINS[:-1], INTERVAL_BINS[1:], summary["intervals"]):
+        print(f"[{low:g}, {high:g})\t{count}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Telemetry sessions analytics (requires numpy).')
+    parser.add_argument('-d', "--db", type=str, default=DB_PATH, help=f"Database path (default: {DB_PATH})")
+    parser.add_argument("--user", type=str, help=f"Only sessions of username")
+    parser.add_argument("--since", type=str, help=f"Only sessions started >= ISO date/time")
+    parser.add_argument("--until", type=str, help=f"Only sessions started < ISO date/time")
+    parser.add_argument('-j', "--jobs", type=int, default=os.cpu_count(),
+                        help=f"Worker processes (default: {os.cpu_count()} - number of CPUs)")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.db):
+        print(f"Database '{args.db}' not found")
+        sys.exit(1)
+
+    sessions = Database(args.db).select_sessions(args.user, args.since, args.until)
+    print_report(summarize(analyze(args.db, [s.id for s in sessions], args.jobs)))
@@ -1,11 +1,16 @@
 import time
 import random
 import socket
+import asyncio
 import argparse
 
-from threading import Thread, Event
+from collections import deque
+from threading import Thread, Event, Lock
 
 from db import Database
+from protocol import (PROTO_TEXT, PROTO_BINARY, BATCH, FRAME_KEEP_ALIVE, FRAME_ACK, ACK_RECORD, 
+                      KEEP_ALIVE_FRAME, FINISHED_FRAME, make_greeting, parse_accepted, parse_event, 
+                      SERVER_FRAMES, encode_events, split_frames)
 
 HOST, PORT = "localhost", 10227
 
@@ -13,8 +18,12 @@ DB_PATH = "./telemetry.db"
 
 ACCEPTED    = 200
 KEEP_ALIVE  = 100
+ACK         = 300
 FINISHED    = 500
 
+RESUME_RETRIES  = 5         # попыток переподключения подряд для возобновляемой сессии
+RESUME_DELAY    = 1         # пауза между попытками, сек
+
 
 def datastream(num):
     """Имитация потока данных от клиента:
@@ -29,8 +38,12 @@ class Client:
     user, password, ip, port    - понятно
     datastream - поток событий, который генерирует клиент
     timeout, missed - таймаут и количество пропущенных KEEP_ALIVE пакетов для закрытия соединения
+    proto - версия протокола: текстовый (1) или двоичный (2)
+    resume - возобновляемая сессия: после обрыва клиент переподключается (до retries попыток 
+    подряд) и досылает события, прием которых сервер не подтвердил
     """
-    def __init__(self, user, password, datastream, ip, port, timeout=1, missed=-3, quiet=True):
+    def __init__(self, user, password, datastream, ip, port, timeout=1, missed=-3, quiet=True, proto=PROTO_TEXT,
+                 resume=False, retries=RESUME_RETRIES):
         self.sock       = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.ip         = ip
         self.port       = port
@@ -41,38 +54,177 @@ class Client:
         self.timestamp  = 0
         self.quiet      = quiet
         self.datastream = datastream
+        self.proto      = proto
+        self.resume     = resume
+        self.retries    = retries
+
+        self.token      = None          # токен возобновляемой сессии
+        self.sent       = 0             # отправлено событий
+        self.acked      = 0             # из них подтверждено сервером
+        self.unacked    = deque()       # (номер первого события, событий, данные) неподтвержденных пакетов
+        self.lock       = Lock()
+        self.max_missed = missed
 
         self.finished = False
 
-    def recv_keep_alive(self):
-        """Поток, обрабатывающий прием KEEP_ALIVE пакетов"""
-        while not self.finished or self.missed < 0:
+    def _ack(self, events):
+        """Сервер подтвердил прием events событий: подтвержденные пакеты больше не нужны"""
+        with self.lock:
+            self.acked = max(self.acked, events)
+            while self.unacked and self.unacked[0][0] + self.unacked[0][1] <= self.acked:
+                self.unacked.popleft()
+
+    def recv_keep_alive(self, sock=None):
+        """Поток, обрабатывающий прием KEEP_ALIVE пакетов (и подтверждений возобновляемой сессии)"""
+        sock = sock or self.sock
+        pending = b""
+        while (not self.finished or self.missed < 0) and sock is self.sock:
 
             try:
-                response = self.sock.recv(1024)
+                response = sock.recv(1024)
             except OSError: # Bad file descriptor - parent thread closed socket allready
                 break
 
-            if str(response, 'ascii').strip() == str(KEEP_ALIVE):
+            if self.proto == PROTO_BINARY:
+                frames, pending = split_frames(pending + response, SERVER_FRAMES)
+                received = sum(1 for frame_type, _ in frames if frame_type == FRAME_KEEP_ALIVE)
+                for frame_type, payload in frames:
+                    if frame_type == FRAME_ACK:
+                        self._ack(ACK_RECORD.unpack(payload)[0])
+            else:
+                *lines, pending = (pending + response).split(b"\n")
+                received = 0
+                for line in lines:
+                    code, _, events = str(line, 'ascii').strip().partition(" ")
+                    if code == str(KEEP_ALIVE):
+                        received += 1
+                    elif code == str(ACK) and events.isdigit():
+                        self._ack(int(events))
+
+            if received:
                 if not self.quiet: print(f"KA <-")
-                self.missed -=1
+                self.missed -= received
                 self.timestamp = time.time()
-        self.sock.close()
+            elif not response:  # сервер закрыл соединение
+                break
+        sock.close()
     
-    def send_keep_alive(self):
+    def send_keep_alive(self, sock=None):
         """Поток, обрабатывающий отправку KEEP_ALIVE пакетов"""
-        while not self.finished or self.missed < 0:
-            if time.time() - self.timestamp > self.timeout:
+        sock = sock or self.sock
+        while (not self.finished or self.missed < 0) and sock is self.sock:
+            delay = self.timestamp + self.timeout - time.time()
+            if delay > 0:                   # спим до следующего KEEP_ALIVE, а не крутимся в цикле
+                time.sleep(min(delay, self.timeout))
+            else:
                 self.missed += 1
                 self.timestamp = time.time()
 
                 try:
-                    self.sock.sendall(bytes((str(KEEP_ALIVE) + '\n'), 'ascii'))
+                    if self.proto == PROTO_BINARY:
+                        sock.sendall(KEEP_ALIVE_FRAME)
+                    else:
+                        sock.sendall(bytes((str(KEEP_ALIVE) + '\n'), 'ascii'))
                 except OSError: # Bad file descriptor - parent thread closed socket allready
                     break
 
                 if not self.quiet: print(f"KA ->")
-        self.sock.close()
+        sock.close()
+
+    def _packets(self):
+        """Данные для отправки вместе с количеством событий в них: в текстовом протоколе 
+        по строке на событие, в двоичном - кадры с пачками по BATCH событий"""
+        if self.proto != PROTO_BINARY:
+            for data in self.datastream:
+                yield 1, bytes(data, 'ascii')
+            return
+
+        batch = []
+        for data in self.datastream:
+            batch.append(parse_event(data))
+            if len(batch) >= BATCH:
+                yield len(batch), encode_events(batch)
+                batch = []
+        if batch:
+            yield len(batch), encode_events(batch)
+
+    def _open(self):
+        """Подключение возобновляемой сессии: первое - с опцией resume, повторные - с токеном 
+        и числом подтвержденных событий. Возвращает неподтвержденные сервером пакеты для 
+        повторной отправки или None, если подключиться или возобновить сессию не удалось"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.token is None:
+            options = {"resume": None}
+        else:
+            options = {"token": self.token, "offset": self.acked}
+        try:
+            sock.connect((self.ip, self.port))
+            sock.sendall(bytes(make_greeting(self.user, self.password, self.proto, **options), 'ascii'))
+            response = str(sock.recv(1024), 'ascii').strip()
+        except OSError as e:
+            if not self.quiet: print(f"[{self.user}] Connection failed: {e}")
+            sock.close()
+            return None
+
+        code, options = parse_accepted(response) if response else (None, {})
+        if code != str(ACCEPTED) or not options.get("offset", "").isdigit():
+            print(f"[{self.user}] Session not {'accepted' if self.token is None else 'resumed'}: {response!r}")
+            sock.close()
+            return None
+
+        self.token = options["token"]
+        self._ack(int(options["offset"]))       # сервер мог принять больше, чем успел подтвердить
+        with self.lock:
+            resend = [data for _, _, data in self.unacked]
+        if not self.quiet and self.sent: print(f"[{self.user}] Resumed from event {self.acked}")
+
+        self.sock = sock
+        self.missed = self.max_missed
+        self.timestamp = time.time()
+        Thread(target=self.recv_keep_alive, args=(sock, ), daemon=True).start()
+        Thread(target=self.send_keep_alive, args=(sock, ), daemon=True).start()
+        return resend
+
+    def send_resumable(self):
+        """Стриминг возобновляемой сессии: при обрыве соединения (ошибка сокета или пропущенные 
+        KEEP_ALIVE) клиент переподключается с токеном и досылает неподтвержденные пакеты"""
+        packets = self._packets()
+        attempts = 0
+        while not self.finished:
+            resend = self._open()
+            if resend is None:
+                attempts += 1
+                if self.token is None or attempts > self.retries:
+                    break
+                time.sleep(RESUME_DELAY)
+                continue
+            attempts = 0
+
+            sock = self.sock
+            try:
+                for data in resend:
+                    sock.sendall(data)
+                for n, data in packets:
+                    with self.lock:
+                        self.unacked.append((self.sent, n, data))
+                        self.sent += n
+                    sock.sendall(data)
+                    if not self.quiet: print("Sent: ", data)
+                    if self.missed == 0:
+                        raise ConnectionError("server did not answer KEEP_ALIVE")
+                if self.proto == PROTO_BINARY:
+                    sock.sendall(FINISHED_FRAME)
+                else:
+                    sock.sendall(bytes((str(FINISHED) + '\n'), 'ascii'))
+                self.finished = True
+                sock.close()
+            except OSError as e:
+                if not self.quiet: print(f"[{self.user}] Connection lost: {e}, reconnecting")
+                sock.close()
+
+        if not self.finished:
+            print(f"[{self.user}] Session lost, {self.sent - self.acked} events not confirmed")
+        self.finished = True
 
     def send_data(self):
         """Отправка данных авторизации и стриминг основных данных"""
@@ -83,7 +235,7 @@ class Client:
                 print(f"[{self.user}] Connection refused")
                 return
 
-            sock.sendall(bytes(f"{self.user}:{self.password}\n", 'ascii'))
+            sock.sendall(bytes(make_greeting(self.user, self.password, self.proto), 'ascii'))
             
             response = str(sock.recv(1024), 'ascii').strip()
             if not self.quiet: print("Recieved: ", response)
@@ -95,15 +247,15 @@ class Client:
                 self.t1.start()                                             # если авторизованы, начинаем 
                 self.t2.start()                                             # принимать / отправлять KEEP_ALIVE 
 
-                for data in self.datastream:
+                for _, data in self._packets():
                     try:
-                        sock.sendall(bytes(data, 'ascii'))
+                        sock.sendall(data)
                     except OSError: # ????????
                         print(f"[{self.user}] OSError ???")
                         self.finished = True
                         break
 
-                    if not self.quiet: print("Sent: ", bytes(data, 'ascii'))
+                    if not self.quiet: print("Sent: ", data)
 
                     if self.missed == 0:                                    # если сервер не ответил на N KEEP_ALIVE запросов
                         if not self.quiet: print("Connection lost")
@@ -113,7 +265,10 @@ class Client:
 
                 if not self.finished:
                     try:
-                        self.sock.sendall(bytes((str(FINISHED) + '\n'), 'ascii'))
+                        if self.proto == PROTO_BINARY:
+                            self.sock.sendall(FINISHED_FRAME)
+                        else:
+                            self.sock.sendall(bytes((str(FINISHED) + '\n'), 'ascii'))
                     except OSError: # Bad file descriptor - closed socket allready
                         pass
 
@@ -123,6 +278,11 @@ class Client:
         self.finished = True
     
     def connect(self):
+        if self.resume:
+            self.send_resumable()
+            if not self.quiet: print(f"[{self.user}] Finished")
+            return
+
         self.t1 = Thread(target=self.recv_keep_alive, daemon=True)
         self.t2 = Thread(target=self.send_keep_alive, daemon=True)
 
@@ -132,14 +292,187 @@ class Client:
 
 starter = Event()
 
-def session(user, password, host, port, Nevents, quiet):
+def session(user, password, host, port, Nevents, quiet, proto=PROTO_TEXT, resume=False):
     """Запуск сессии клиента, стартует после срабатывания события starter"""
     starter.wait()
     start = time.time()
-    Client(user, password, datastream(Nevents), host, port, quiet=quiet).connect()
+    Client(user, password, datastream(Nevents), host, port, quiet=quiet, proto=proto, resume=resume).connect()
     if not quiet: print(f"[{user}] duration: {(time.time() - start) :.02f} sec")
 
 
+def watch(user, password, host, port, target="*"):
+    """Зритель: подписывается на трансляцию сессий пользователя target (* - всех)
+    и печатает принятые строки, KEEP_ALIVE сервера пропускаются"""
+    with socket.create_connection((host, port)) as sock:
+        sock.sendall(bytes(make_greeting(user, password, subscribe=target), 'ascii'))
+        lines = sock.makefile("rb")
+        response = lines.readline()
+        if response.strip() != str(ACCEPTED).encode():
+            print(f"[{user}] Subscription rejected: {response!r}")
+            return
+        for line in lines:
+            if line.strip() != str(KEEP_ALIVE).encode():
+                print(str(line, 'ascii').rstrip("\n"))
+
+
+LOAD_TICK   = 0.1       # период отправки пачек событий при ограниченной скорости, сек
+LOAD_WAIT   = 30        # сколько ждать, пока сервер сохранит все сессии, сек
+
+
+def percentiles(values, ps=(50, 90, 99)):
+    """Перцентили по ближайшему рангу, {p: значение}"""
+    if not values:
+        return {p: float("nan") for p in ps}
+    values = sorted(values)
+    return {p: values[min(len(values) - 1, int(len(values) * p / 100))] for p in ps}
+
+
+class LoadStats:
+    """Результаты нагрузочного теста, общие для всех сессий (asyncio, один поток)"""
+
+    def __init__(self):
+        self.connect    = []        # задержки установки соединения, сек
+        self.auth       = []        # задержки от отправки приветствия до ACCEPTED, сек
+        self.duration   = []        # длительность сессий от connect до закрытия сервером, сек
+        self.sessions   = 0         # успешно завершенных сессий
+        self.failed     = 0
+        self.unclosed   = 0         # сессий, которые сервер не закрыл после FINISHED за время ожидания
+        self.events     = 0         # отправленных событий
+        self.bytes      = 0
+        self.keep_alives = 0        # полученных ответов KEEP_ALIVE
+
+    def report(self, elapsed):
+        print(f"Sessions: {self.sessions} finished ({self.unclosed} not closed by server), "
+              f"{self.failed} failed in {elapsed:.02f} sec")
+        print(f"Sent: {self.events} events, {self.bytes / 2**20:.02f} MiB, "
+              f"{self.events / elapsed:.0f} events/sec, {self.bytes / 2**20 / elapsed:.02f} MiB/sec")
+        print(f"Keep-alives answered: {self.keep_alives}")
+        for name, values in (("connect", self.connect), ("auth", self.auth), ("session", self.duration)):
+            p = percentiles(values)
+            print(f"{name + ' latency':16} p50 {p[50] * 1000:9.02f} ms  p90 {p[90] * 1000:9.02f} ms  p99 {p[99] * 1000:9.02f} ms")
+
+
+async def _recv_keep_alives(reader, proto, stats):
+    """Принимает ответы KEEP_ALIVE до закрытия соединения сервером"""
+    pending = b""
+    while data := await reader.read(1024):
+        if proto == PROTO_BINARY:
+            frames, pending = split_frames(pending + data, SERVER_FRAMES)
+            stats.keep_alives += sum(1 for frame_type, _ in frames if frame_type == FRAME_KEEP_ALIVE)
+        else:
+            stats.keep_alives += data.count(b"%d\n" % KEEP_ALIVE)
+
+async def load_session(user, password, host, port, events, rate, proto, stats, delay=0, timeout=1, wait=LOAD_WAIT):
+    """Одна сессия нагрузочного теста: events событий со скоростью rate событий/с (0 - без ограничения),
+    KEEP_ALIVE раз в timeout секунд. Все сессии работают в одном цикле событий, без потоков"""
+    await asyncio.sleep(delay)
+    start = time.perf_counter()
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+    except OSError as e:
+        stats.failed += 1
+        if stats.failed == 1: print(f"[{user}] {e}")
+        return
+    connected = time.perf_counter()
+    stats.connect.append(connected - start)
+
+    try:
+        writer.write(make_greeting(user, password, proto).encode("ascii"))
+        response = await reader.readline()
+        if response.strip() != str(ACCEPTED).encode("ascii"):
+            stats.failed += 1
+            if stats.failed == 1: print(f"[{user}] Not accepted: {response}")
+            return
+        stats.auth.append(time.perf_counter() - connected)
+
+        receiver = asyncio.create_task(_recv_keep_alives(reader, proto, stats))
+        batch = BATCH if not rate else max(1, min(BATCH, int(rate * LOAD_TICK)))
+        stream = datastream(events)
+        keep_alive = time.perf_counter()
+        sent = 0
+        while sent < events:
+            lines = [next(stream) for _ in range(min(batch, events - sent))]
+            if proto == PROTO_BINARY:
+                data = encode_events([parse_event(line) for line in lines])
+            else:
+                data = "".join(lines).encode("ascii")
+            writer.write(data)
+            await writer.drain()
+            sent += len(lines)
+            stats.events += len(lines)
+            stats.bytes += len(data)
+
+            now = time.perf_counter()
+            if now - keep_alive > timeout:
+                writer.write(KEEP_ALIVE_FRAME if proto == PROTO_BINARY else b"%d\n" % KEEP_ALIVE)
+                keep_alive = now
+            if rate:
+                await asyncio.sleep(max(0, connected + sent / rate - now))
+
+        writer.write(FINISHED_FRAME if proto == PROTO_BINARY else b"%d\n" % FINISHED)
+        await writer.drain()
+        stats.sessions += 1
+        try:
+            await asyncio.wait_for(receiver, wait)          # сервер закрывает соединение после FINISHED
+            stats.duration.append(time.perf_counter() - start)
+        except asyncio.TimeoutError:
+            stats.unclosed += 1
+    except (OSError, asyncio.TimeoutError) as e:
+        stats.failed += 1
+        if stats.failed == 1: print(f"[{user}] {type(e).__name__} {e}")
+    finally:
+        writer.close()
+
+def raise_fd_limit():
+    """Тысячи одновременных соединений не помещаются в типичный мягкий лимит 1024 дескриптора"""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        return hard
+    except (ImportError, ValueError, OSError):
+        return None
+
+def persisted(db, before=(0, 0)):
+    """Количество сессий и событий, сохраненных сервером в БД с момента снимка before = persisted(db). 
+    Считается по сводке user_stats, которую сервер обновляет при записи, без чтения данных сессий"""
+    rows = db.user_stats()
+    return sum(r.sessions for r in rows) - before[0], sum(r.events for r in rows) - before[1]
+
+def load(db, host, port, sessions, events, rate=0, users=0, ramp=0, proto=PROTO_TEXT, wait=LOAD_WAIT, prefix="user"):
+    """Нагрузочный тест: sessions одновременных сессий по events событий из одного процесса, 
+    суммарная скорость rate событий/с (0 - без ограничения), подключения равномерно за ramp секунд.
+    Сервер пускает одну сессию на пользователя, поэтому по умолчанию у каждой сессии свой пользователь, 
+    при users < sessions лишние одновременные сессии пользователя сервер отклоняет (считаются failed).
+    Печатает пропускную способность, перцентили задержек и сколько сервер сохранил в БД"""
+    raise_fd_limit()
+    users = min(users or sessions, sessions)
+    db.add_users((f"{prefix}{i}", "password") for i in range(users))
+    before = persisted(db)
+
+    stats = LoadStats()
+
+    async def run():
+        await asyncio.gather(*(load_session(f"{prefix}{i % users}", "password", host, port, events, rate / sessions, 
+                                            proto, stats, delay=ramp * i / sessions, wait=wait) 
+                               for i in range(sessions)))
+
+    start = time.perf_counter()
+    asyncio.run(run())
+    elapsed = time.perf_counter() - start
+    stats.report(elapsed)
+
+    deadline = time.perf_counter() + wait        # сервер может дописывать сессии после закрытия соединений
+    stored = persisted(db, before)
+    while stored != (stats.sessions, stats.events) and time.perf_counter() < deadline:
+        time.sleep(0.5)
+        stored = persisted(db, before)
+    elapsed = time.perf_counter() - start
+    print(f"Persisted: {stored[0]} sessions, {stored[1]} events in {elapsed:.02f} sec, "
+          f"{stored[1] / elapsed:.0f} events/sec end-to-end")
+    return stats, stored
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description='Testing clients.')
@@ -148,10 +481,32 @@ if __name__ == "__main__":
     parser.add_argument('-n', type=int, default=5, help=f"Number of client threads to launch (dafault: 5)")
     parser.add_argument('-e', type=int, default=2000, help=f"Average number of events to send (dafault: 2000+randint(-1000,1000))")
     parser.add_argument('-q', '--quiet', action='store_true', help=f"Quiet mode")
+    parser.add_argument('--proto', type=int, choices=(PROTO_TEXT, PROTO_BINARY), default=PROTO_TEXT, 
+                        help=f"Protocol version: 1 - text lines, 2 - binary frames (dafault: {PROTO_TEXT})")
+    parser.add_argument('--resume', action='store_true', help=f"Resumable sessions: reconnect and resend unconfirmed events")
+    parser.add_argument('-w', '--watch', type=str, metavar="USER", 
+                        help=f"Print live events of USER sessions (* - all sessions) instead of sending data")
+    parser.add_argument('-l', '--load', action='store_true', 
+                        help=f"Load test: run -n sessions of exactly -e events in one asyncio process instead of threads")
+    parser.add_argument('-r', '--rate', type=float, default=0, help=f"Load test: total events/sec of all sessions (dafault: 0 - unlimited)")
+    parser.add_argument('--users', type=int, default=0, help=f"Load test: spread sessions over N users (dafault: 0 - user per session)")
+    parser.add_argument('--ramp', type=float, default=0, help=f"Load test: spread connects over N seconds (dafault: 0)")
+    parser.add_argument('--wait', type=float, default=LOAD_WAIT, 
+                        help=f"Load test: seconds to wait for the server to persist all sessions (dafault: {LOAD_WAIT})")
+    parser.add_argument('-d', '--db', type=str, default=DB_PATH, help=f"Server database to add users and count persisted data (dafault: {DB_PATH})")
     args = parser.parse_args()
 
     HOST = args.addr if args.addr is not None else HOST
-    db = Database(DB_PATH)
+    db = Database(args.db)
+
+    if args.watch:
+        db.add_user("spectator", "password")
+        watch("spectator", "password", HOST, args.port, args.watch)
+        raise SystemExit
+
+    if args.load:
+        load(db, HOST, args.port, args.n, args.e, args.rate, args.users, args.ramp, args.proto, args.wait)
+        raise SystemExit
 
     N_clients = args.n
     Nevents = args.e
@@ -162,7 +517,8 @@ if __name__ == "__main__":
         user, password = f"user{i}", "password"
         db.add_user(user, password)
         thread_pool.append(Thread(target=session, 
-                                  args=(user, password, HOST, PORT, Nevents + random.randint(-Nevents//2, Nevents//2), args.quiet))) #nosec
+                                  args=(user, password, HOST, PORT, Nevents + random.randint(-Nevents//2, Nevents//2), args.quiet, args.proto, 
+                                        args.resume))) #nosec
 
     starter.clear()
 
@@ -1,46 +1,712 @@
 import os
 import sys
+import re
+import lzma
+import math
+import time
 import uuid
+import zlib
+import struct
 import hashlib
 import sqlite3
 import datetime
+import queue
+import logging
 import argparse
+import functools
+import threading
 
-from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from array import array
+from contextlib import contextmanager
+from collections import namedtuple, OrderedDict
 
 
 DB_PATH = "./telemetry.db"
 
+CHUNK_SIZE      = 64 * 1024     # примерный размер куска данных сессии в таблице chunks, байт
+FLUSH_EVENTS    = 1000          # сбрасывать буфер сессии в БД каждые N событий
+FLUSH_INTERVAL  = 1.0           # ... или каждые N секунд
+WRITER_CACHE_KIB = 16 * 1024    # кэш страниц соединения, через которое идет пакетная запись, КиБ
+
+# Формат хранения данных сессий: сжатые куски начинаются с маркера b"\x00" + раскладка + 
+# алгоритм сжатия, несжатые (в т.ч. все старые записи) - это исходный текст телеметрии, 
+# который всегда начинается с цифры
+CODEC_MARKER    = b"\x00"
+LAYOUT_COLUMNS  = 1     # события разложены по столбцам: дельты времени, коды, значения
+LAYOUT_TEXT     = 2     # исходный текст (данные не в каноническом формате телеметрии)
+COMPRESSORS     = {
+    "zlib": (1, zlib.compress, zlib.decompress),
+    "lzma": (2, lzma.compress, lzma.decompress),
+}
+COLUMNS_HEADER  = struct.Struct("<II")      # количество событий, из них с целыми значениями
+
+POOL_SIZE           = 8         # соединений для чтения в пуле Database (pool_size по умолчанию у серверов)
+BUSY_TIMEOUT        = 5.0       # сколько ждать снятия блокировки БД другим соединением, сек
+STATEMENT_CACHE     = 256       # подготовленных запросов в кэше каждого соединения пула
+ATTACH_LIMIT        = 10        # подключаемых БД на соединение, если sqlite3 не сообщает SQLITE_LIMIT_ATTACHED
+
+AUTH_CACHE_TTL      = 300       # сколько секунд кэш авторизации доверяет строке пользователя
+AUTH_CACHE_SIZE     = 10000     # максимум пользователей в кэше, вытесняются давно не входившие
+AUTH_VERSION_CHECK  = 1.0       # как часто кэш сверяет версию таблицы users с БД, сек
+
+EXPORT_BLOCK        = 64 * 1024 # размер блока при потоковом чтении несжатых данных и записи экспорта, байт
+
+# Разбиение по времени: сессии пишутся в файлы разделов (по дню или месяцу начала сессии)
+# рядом с файлом-каталогом, где остаются пользователи и список разделов
+PARTITION_FORMATS   = {"day": "%Y-%m-%d", "month": "%Y-%m"}     # имя раздела по времени
+
+# Тепловая карта положений игроков. Клиент шлет координаты положения отдельными событиями
+# с кодами x, y, z, одно положение - события с одной временной меткой. Коды и размер ячейки
+# хранятся в meta БД (heatmap_codes, heatmap_cell) и меняются с перестроением карты
+POSITION_CODES      = (0, 1, 2) # коды событий с координатами x, y, z по умолчанию
+GRID_CELL           = 1.0       # размер ячейки сетки тепловой карты по умолчанию, единиц мира
+DWELL_MAX_GAP       = 1000      # пауза между положениями дольше этой засчитывается в пребывание только до нее, мс
+PLANES              = {"xy": (0, 1), "xz": (0, 2), "yz": (1, 2)}      # проекции карты: номера осей
+GRID_COLUMNS        = ("cx", "cy", "cz")
+HEATMAP_INTERVAL    = 60.0      # как часто сервер добавляет принятые данные в тепловую карту, сек
+
+
+@functools.lru_cache(maxsize=None)
+def row_class(fields):
+    """Класс строки создается один раз на набор столбцов, а не на каждую строку"""
+    return namedtuple("Row", fields)
 
 def namedtuple_factory(cursor, row):
-    fields = [column[0] for column in cursor.description]
-    cls = namedtuple("Row", fields)
-    return cls._make(row)
+    fields = tuple(column[0] for column in cursor.description)
+    return row_class(fields)._make(row)
 
 def salt_and_hash(password):
     salt = uuid.uuid4().hex
     return hashlib.sha256(salt.encode() + password.encode()).hexdigest() + ':' + salt
 
+def parse_events(data):
+    """Разбирает строки `timestamp;code;value` в список (timestamp, code, value) для таблицы events, 
+    value остается int, если записано как целое, строки с нечисловыми полями пропускаются"""
+    events = []
+    for line in data.split(b"\n"):
+        fields = line.split(b";")
+        if len(fields) != 3:
+            continue
+        try:
+            ts, code = int(fields[0]), int(fields[1])
+            try:
+                value = int(fields[2])
+            except ValueError:
+                value = float(fields[2])
+        except ValueError:
+            continue
+        events.append((ts, code, value))
+    return events
+
+def _line_ts(line):
+    try:
+        return int(line[:line.index(b";")])
+    except ValueError:
+        return None
+
+def ts_range(data):
+    """Минимальная и максимальная временная метка событий в данных, (None, None), если их нет"""
+    stamps = [ts for ts in map(_line_ts, data.split(b"\n")) if ts is not None]
+    return (min(stamps), max(stamps)) if stamps else (None, None)
+
+def filter_range(data, t_from=None, t_to=None):
+    """Оставляет строки событий с временной меткой в [t_from, t_to]"""
+    lines = []
+    for line in data.splitlines(keepends=True):
+        ts = _line_ts(line)
+        if ts is not None and (t_from is None or ts >= t_from) and (t_to is None or ts <= t_to):
+            lines.append(line)
+    return b"".join(lines)
+
+def _le(arr):
+    """Массивы хранятся в little-endian независимо от платформы"""
+    if sys.byteorder == "big":
+        arr.byteswap()
+    return arr
+
+def encode_columns(data):
+    """Раскладывает текст телеметрии по столбцам: дельты времени (int64), коды (uint8), 
+    признак типа значения, целые (int64) и дробные (float64) значения. Возвращает None, 
+    если текст не восстанавливается из столбцов байт в байт"""
+    lines = data.split(b"\n")
+    if lines.pop() != b"":                  # данные должны заканчиваться концом строки
+        return None
+
+    deltas, codes, kinds = array("q"), bytearray(), bytearray()
+    ints, floats = array("q"), array("d")
+    prev = 0
+    try:
+        for line in lines:
+            ts, code, value = line.split(b";")
+            t, c = int(ts), int(code)
+            if b"%d" % t != ts or b"%d" % c != code or not 0 <= c <= 255:
+                return None
+            deltas.append(t - prev)
+            codes.append(c)
+            prev = t
+            if value.lstrip(b"-").isdigit():
+                v = int(value)
+                if b"%d" % v != value:
+                    return None
+                ints.append(v)
+                kinds.append(0)
+            else:
+                v = float(value)
+                if b"%r" % v != value:
+                    return None
+                floats.append(v)
+                kinds.append(1)
+    except (ValueError, OverflowError):     # не три поля, не числа, значения вне int64
+        return None
+
+    return (COLUMNS_HEADER.pack(len(lines), len(ints)) + _le(deltas).tobytes() + bytes(codes) 
+            + bytes(kinds) + _le(ints).tobytes() + _le(floats).tobytes())
+
+def decode_columns(payload):
+    n, n_ints = COLUMNS_HEADER.unpack_from(payload)
+    pos = COLUMNS_HEADER.size
+
+    deltas = array("q")
+    deltas.frombytes(payload[pos:pos + 8 * n])
+    pos += 8 * n
+    codes = payload[pos:pos + n]
+    kinds = payload[pos + n:pos + 2 * n]
+    pos += 2 * n
+    ints, floats = array("q"), array("d")
+    ints.frombytes(payload[pos:pos + 8 * n_ints])
+    floats.frombytes(payload[pos + 8 * n_ints:])
+    _le(deltas), _le(ints), _le(floats)
+
+    lines = []
+    ts = 0
+    next_int, next_float = iter(ints).__next__, iter(floats).__next__
+    for delta, code, kind in zip(deltas, codes, kinds):
+        ts += delta
+        if kind:
+            lines.append(b"%d;%d;%r\n" % (ts, code, next_float()))
+        else:
+            lines.append(b"%d;%d;%d\n" % (ts, code, next_int()))
+    return b"".join(lines)
+
+def encode_blob(data, compression="zlib"):
+    """Кодирует данные сессии для хранения: по возможности раскладывает по столбцам 
+    с дельта-кодированием времени, затем сжимает. compression=None - хранить как есть"""
+    if compression is None or not data:
+        return bytes(data)
+    method, compress, _ = COMPRESSORS[compression]
+    payload = encode_columns(data)
+    layout = LAYOUT_COLUMNS
+    if payload is None:
+        payload, layout = bytes(data), LAYOUT_TEXT
+    return CODEC_MARKER + bytes((layout, method)) + compress(payload)
+
+def decode_blob(blob):
+    """Восстанавливает исходный текст сессии из хранимого формата (сжатого или нет)"""
+    blob = bytes(blob)
+    if not blob.startswith(CODEC_MARKER):
+        return blob
+    layout, method = blob[1], blob[2]
+    decompress = {m: d for m, _, d in COMPRESSORS.values()}[method]
+    payload = decompress(blob[3:])
+    return decode_columns(payload) if layout == LAYOUT_COLUMNS else payload
+
+def split_chunks(data, chunk_size=CHUNK_SIZE):
+    """Делит данные на куски примерно по chunk_size байт, разрез делается по концу строки, 
+    чтобы каждый кусок содержал только целые события"""
+    chunks = []
+    start = 0
+    while start < len(data):
+        end = start + chunk_size
+        if end < len(data):
+            cut = data.rfind(b"\n", start, end)
+            if cut < 0:                         # строка длиннее куска
+                cut = data.find(b"\n", end)
+            end = len(data) if cut < 0 else cut + 1
+        chunks.append(bytes(data[start:end]))
+        start = end
+    return chunks
+
+
+@functools.lru_cache(maxsize=None)
+def position_lines(codes):
+    """Выражение для строк событий положения с кодами codes, компилируется один раз на набор кодов"""
+    return re.compile(rb"^(-?\d+);(" + b"|".join(b"%d" % code for code in codes) + rb");([^;\n]+)$", re.MULTILINE)
+
+def parse_positions(data, codes=POSITION_CODES):
+    """События положения (ts, code, value) из данных сессии, остальные строки не разбираются"""
+    try:
+        return [(int(ts), int(code), float(value)) for ts, code, value in position_lines(codes).findall(data)]
+    except ValueError:      # нечисловые поля: построчно, с пропуском таких строк
+        return [event for event in parse_events(data) if event[1] in codes]
+
+def accumulate_positions(events, state, cell, cells, codes=POSITION_CODES):
+    """Добавляет в cells {(cx, cy, cz): [входы, пребывание мс]} положения игрока из событий
+    (ts, code, value) сессии, codes - коды координат x, y, z. Положение с временной меткой ts длится до следующей метки
+    (не дольше DWELL_MAX_GAP), вход - положение в другой ячейке, чем предыдущее.
+    state - [ts, x, y, z, (cx, cy, cz)] последнего, еще не законченного положения и ячейки,
+    возвращается обновленным: так следующий кусок сессии продолжает с того же места"""
+    axes = {code: i for i, code in enumerate(codes)}
+    floor, isfinite = math.floor, math.isfinite
+    ts0, position, last = state[0], list(state[1:4]), state[4]
+    index = [None if v is None else floor(v / cell) for v in position]     # ячейка по каждой оси
+    complete = None not in index
+    for ts, code, value in events:
+        axis = axes.get(code)
+        if axis is None or not isfinite(value):
+            continue
+        if ts0 is None or ts > ts0:
+            if complete and ts0 is not None:
+                current = (index[0], index[1], index[2])
+                visit = cells.get(current)
+                if visit is None:
+                    visit = cells[current] = [0, 0]
+                if current != last:
+                    visit[0] += 1
+                    last = current
+                visit[1] += min(ts - ts0, DWELL_MAX_GAP)
+            ts0 = ts
+        position[axis] = value
+        index[axis] = floor(value / cell)
+        if not complete:
+            complete = None not in index
+    return [ts0, *position, last]
+
+
+class SessionBuffer:
+    """Буфер принимаемой сессии: события накапливаются в растущем bytearray и периодически 
+    (каждые flush_events событий, flush_interval секунд или при наборе chunk_size байт) 
+    сбрасываются в таблицу chunks, поэтому в памяти обработчика держится только хвост сессии"""
+
+    def __init__(self, username, chunk_size=CHUNK_SIZE, flush_events=FLUSH_EVENTS, flush_interval=FLUSH_INTERVAL):
+        self.username = username
+        self.chunk_size = chunk_size
+        self.flush_events = flush_events
+        self.flush_interval = flush_interval
+
+        self.session_id = None
+        self.seq = 0
+        self.data = bytearray()
+        self.events = 0
+        self.flushed = time.monotonic()
+        self.total_events = 0           # всего событий и байт за сессию
+        self.total_bytes = 0
+
+    def append(self, data, events=1):
+        """Добавляет событие (или пачку из events событий) в буфер, возвращает True, 
+        если буфер пора сбросить в БД"""
+        self.data += data
+        self.events += events
+        self.total_events += events
+        self.total_bytes += len(data)
+        return (self.events >= self.flush_events 
+                or len(self.data) >= self.chunk_size 
+                or time.monotonic() - self.flushed >= self.flush_interval)
+
+    def drain(self):
+        """Забирает накопленные данные в виде списка кусков"""
+        chunks = split_chunks(self.data, self.chunk_size)
+        del self.data[:]
+        self.events = 0
+        self.flushed = time.monotonic()
+        return chunks
+
+    def store(self, db, chunks):
+        """Записывает куски в БД, при первой записи создает строку сессии"""
+        if chunks:
+            self.session_id, self.seq = db.add_chunks(self.session_id, self.seq, chunks, self.username)
+
+    def flush(self, db):
+        self.store(db, self.drain())
+
+    def close(self, db):
+        """Сбрасывает остаток буфера, сессия создается, даже если валидных данных не было"""
+        self.flush(db)
+        if self.session_id is None:
+            self.session_id = db.open_session(self.username)
+        db.close_session(self.session_id)
+
+
+class CredentialCache:
+    """Кэш строк пользователей для авторизации на сервере: строки (и отсутствие пользователя) 
+    хранятся ttl секунд, при переполнении вытесняются давно не запрашивавшиеся (LRU). 
+    Промахи читаются через переданный Database (из многих потоков - в режиме пула), и не 
+    чаще раза в check_interval секунд кэш сверяет счетчик изменений таблицы users 
+    (meta.users_version), при его изменении сбрасывается. Запросы к БД идут вне блокировки 
+    кэша: промахи разных потоков читаются параллельно (через пул соединений), блокировка 
+    берется только для поиска и вставки строк"""
+
+    def __init__(self, db, ttl=AUTH_CACHE_TTL, size=AUTH_CACHE_SIZE, check_interval=AUTH_VERSION_CHECK):
+        self.db = db
+        self.ttl = ttl
+        self.size = size
+        self.check_interval = check_interval
+
+        self.rows = OrderedDict()       # username -> (строка users или None, время устаревания)
+        self.lock = threading.Lock()
+        self.version = None
+        self.generation = 0             # число сбросов: строка, прочитанная до сброса, в кэш не попадет
+        self.checked = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _check_version(self, now):
+        with self.lock:
+            if now - self.checked < self.check_interval:
+                return
+            self.checked = now          # сверяет один поток, остальные не ждут его запроса
+        version = self.db.users_version()
+        with self.lock:
+            if version != self.version:
+                self.rows.clear()
+                self.version = version
+                self.generation += 1
+
+    def peek(self, username):
+        """Строка пользователя из кэша без обращения к БД: (True, строка) или (False, None)"""
+        now = time.monotonic()
+        with self.lock:
+            if now - self.checked >= self.check_interval:
+                return False, None
+            entry = self.rows.get(username)
+            if entry is None or entry[1] <= now:
+                return False, None
+            self.rows.move_to_end(username)
+            self.hits += 1
+            return True, entry[0]
+
+    def get_user(self, username):
+        """Аналог Database.get_user, при промахе читает строку из БД и кладет в кэш"""
+        now = time.monotonic()
+        self._check_version(now)
+        with self.lock:
+            entry = self.rows.get(username)
+            if entry is not None and entry[1] > now:
+                self.rows.move_to_end(username)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            generation = self.generation
+
+        row = self.db.get_user(username)
+        with self.lock:
+            if generation == self.generation:
+                self.rows[username] = (row, now + self.ttl)
+                self.rows.move_to_end(username)
+                while len(self.rows) > self.size:
+                    self.rows.popitem(last=False)
+        return row
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.rows)}
+
 
 class Database:
     """Класс для хранения соединения с БД и необходимых методов по чтению и 
-    добавлению данных, а также сохранению данных сессий в отдельные файлы"""
+    добавлению данных, а также сохранению данных сессий в отдельные файлы.
+
+    С pool_size > 0 объект можно использовать из многих потоков: чтение идет через пул 
+    из не более чем pool_size соединений (reader), запись - через одно выделенное 
+    соединение под блокировкой (writer), БД переводится в режим WAL.
 
-    def __init__(self, path):
+    С partition="day" или "month" (задается при создании БД и запоминается в ней) path - это
+    каталог: пользователи, meta и список разделов, а сессии с их кусками, событиями, сводкой
+    user_stats и тепловой картой пишутся в файлы разделов `{path без .db}.{день или месяц}.db` -
+    новые сессии в раздел текущего периода. Id сессий сквозные: раздел начинается с id, следующего за
+    последним в предыдущем, по нему находится раздел сессии. Запросы подключают (ATTACH)
+    только нужные разделы, старые данные удаляются вместе с файлом раздела (drop_partitions)"""
+
+    def __init__(self, path, index_events=False, compression="zlib", check_same_thread=True, pool_size=0, 
+                 partition=None):
         self.path = path
-        if os.path.isfile(self.path):
-            self.connection = sqlite3.connect(self.path)
+        self.index_events = index_events    # при записи сессий раскладывать события в таблицу events
+        self.compression = compression      # сжатие новых данных сессий: "zlib", "lzma" или None
+        self.pool_size = pool_size
+        self.pool = queue.LifoQueue() if pool_size else None
+        self.pool_opened = 0
+        self.pool_generation = 0            # меняется при удалении разделов: соединения пула с прежним номером закрываются
+        self.pool_lock = threading.Lock()
+        self.write_lock = threading.RLock()
+        self.partition = None               # период разделов: None (один файл), "day" или "month"
+        self.schema = "main"                # схема, куда пишутся новые сессии: main или текущий раздел
+        self.current = None                 # имя текущего раздела
+        self.partition_pragmas = []         # настройки соединения записи для подключаемых разделов
+
+        if partition is not None and partition not in PARTITION_FORMATS:
+            raise ValueError(f"Unknown partition period '{partition}', expected one of {sorted(PARTITION_FORMATS)}")
+        if pool_size:
+            check_same_thread = False
+        exists = os.path.isfile(self.path)
+        self.connection = self._connect(check_same_thread)
+        self.connection.row_factory = namedtuple_factory
+        if exists:
+            self.upgrade_db()
         else:
-            self.connection = sqlite3.connect(self.path)
-            self.init_db()
+            self.init_db(partition)
             self.add_user("user", "password")
             self.add_user("test", "dummy")
-        self.connection.row_factory = namedtuple_factory
+        self.partition = self._partition_mode(partition)
+        self.attach_limit = self._attach_limit() if self.partition else 0
+        if pool_size:
+            self.connection.execute("PRAGMA journal_mode=WAL;")
+            self.partition_pragmas.append("journal_mode=WAL")
     
+    def _connect(self, check_same_thread=False):
+        if not self.pool_size:
+            return sqlite3.connect(self.path, check_same_thread=check_same_thread)
+
+        conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, check_same_thread=False, 
+                               cached_statements=STATEMENT_CACHE)
+        conn.execute(f"PRAGMA busy_timeout={int(BUSY_TIMEOUT * 1000)};")
+        conn.row_factory = namedtuple_factory
+        return conn
+
+    @contextmanager
+    def reader(self):
+        """Соединение для чтения: из пула (ждет свободное, если открыто уже pool_size), 
+        без пула - основное соединение. В пуле лежат пары (номер поколения, соединение), 
+        соединение, вернувшееся после удаления разделов (drop_partitions), заменяется новым"""
+        if self.pool is None:
+            yield self.connection
+            return
+
+        try:
+            generation, conn = self.pool.get_nowait()
+        except queue.Empty:
+            conn = None
+            with self.pool_lock:
+                if self.pool_opened < self.pool_size:
+                    self.pool_opened += 1
+                    generation, conn = self.pool_generation, self._connect()
+            if conn is None:
+                generation, conn = self.pool.get()
+        try:
+            yield conn
+        finally:
+            with self.pool_lock:
+                if generation != self.pool_generation:
+                    conn.close()
+                    generation, conn = self.pool_generation, self._connect()
+                self.pool.put((generation, conn))
+
+    @contextmanager
+    def writer(self, session_id=None, new_sessions=False):
+        """Соединение для записи в транзакции, одновременно пишет только один поток. Для БД 
+        с разделами до начала транзакции подключается раздел сессии session_id, а если 
+        в транзакции создаются сессии (new_sessions) - раздел текущего периода: он создается 
+        при смене периода, и транзакция (BEGIN IMMEDIATE) начинается, только когда он 
+        последний в каталоге - иначе раздел создал другой процесс и подключается заново"""
+        with self.write_lock:
+            if self.partition and not self.connection.in_transaction:
+                if session_id is not None and (name := self._partition_of(self.connection, session_id)):
+                    self._attach(self.connection, [name] + ([self.current] if new_sessions and self.current else []), 
+                                 self.partition_pragmas)
+                while new_sessions:
+                    self._attach_current()
+                    self.connection.execute("BEGIN IMMEDIATE;")
+                    if self._partitions(self.connection)[-1].name == self.current:
+                        break
+                    self.connection.rollback()
+                    self.current = None
+            with self.connection as conn:
+                yield conn
+
+    def _partition_mode(self, partition):
+        """Режим разбиения из meta (для новой БД его записывает init_db), partition - ожидаемый"""
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'partition';").fetchone()
+        if row is None and partition is not None:
+            raise ValueError(f"{self.path} is a single-file database, partitioning is set on creation only")
+        if row is not None and partition is not None and row.value != partition:
+            raise ValueError(f"{self.path} is partitioned by {row.value}, not by {partition}")
+        return row.value if row else None
+
+    def _attach_limit(self):
+        """Сколько БД можно подключить к соединению: getlimit есть только с Python 3.11"""
+        getlimit = getattr(self.connection, "getlimit", None)
+        return getlimit(sqlite3.SQLITE_LIMIT_ATTACHED) if getlimit else ATTACH_LIMIT
+
+    def partition_path(self, name):
+        return f"{os.path.splitext(self.path)[0]}.{name}.db"
+
+    @staticmethod
+    def _alias(name):
+        """Имя схемы подключенного раздела"""
+        return "p_" + name.replace("-", "_")
+
+    def _period(self, name):
+        """Интервал времени [начало, конец) раздела"""
+        start = datetime.datetime.strptime(name, PARTITION_FORMATS[self.partition])
+        if self.partition == "day":
+            return start, start + datetime.timedelta(days=1)
+        return start, (start.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+
+    def _partitions(self, conn):
+        """Разделы (name, first_id) по возрастанию id их сессий"""
+        return conn.execute("SELECT name AS name, first_id AS first_id FROM main.partitions ORDER BY first_id, name;").fetchall()
+
+    def _partition_of(self, conn, session_id):
+        """Имя раздела, в котором лежит сессия, None - если раздела нет (у пустого раздела 
+        first_id совпадает со следующим, выбирается более поздний)"""
+        row = conn.execute("SELECT name AS name FROM main.partitions WHERE first_id <= ? ORDER BY first_id DESC, name DESC LIMIT 1;", 
+                           (session_id, )).fetchone()
+        return row.name if row else None
+
+    def _schema(self, conn, session_id):
+        """Схема данных сессии: main для БД одним файлом, иначе подключенный раздел сессии"""
+        if not self.partition:
+            return "main"
+        name = self._partition_of(conn, session_id)
+        return self._alias(name) if name else None
+
+    def _attach(self, conn, names, pragmas=()):
+        """Подключает к соединению (ATTACH) файлы разделов names. Число подключенных БД 
+        ограничено SQLITE_LIMIT_ATTACHED, при нехватке отключаются ранее подключенные разделы"""
+        wanted = {self._alias(name) for name in names}
+        attached = [row.name for row in conn.execute("PRAGMA database_list;") if row.name not in ("main", "temp")]
+        missing = [name for name in names if self._alias(name) not in attached]
+        spare = [alias for alias in attached if alias not in wanted]
+        while missing and spare and len(attached) + len(missing) > self.attach_limit:
+            alias = spare.pop(0)
+            conn.execute(f"DETACH DATABASE {alias};")
+            attached.remove(alias)
+        for name in missing:
+            alias = self._alias(name)
+            conn.execute(f"ATTACH DATABASE ? AS {alias};", (self.partition_path(name), ))
+            for pragma in pragmas:
+                conn.execute(f"PRAGMA {alias}.{pragma};")
+
+    def _attach_current(self):
+        """Подключает к соединению записи раздел текущего периода, создавая его при смене 
+        периода. Если часы отстают от последнего раздела, пишем в последний"""
+        name = datetime.datetime.now().strftime(PARTITION_FORMATS[self.partition])
+        if name != self.current:
+            partitions = self._partitions(self.connection)
+            while not partitions or name > partitions[-1].name:
+                self._create_partition(name, partitions)
+                partitions = self._partitions(self.connection)
+            self.current = partitions[-1].name
+        self._attach(self.connection, [self.current], self.partition_pragmas)
+        self.schema = self._alias(self.current)
+
+    def _create_partition(self, name, partitions):
+        """Создает файл раздела, id его сессий продолжают id последнего раздела. Последний id 
+        читается и раздел вносится в каталог в одной транзакции BEGIN IMMEDIATE, которая 
+        блокирует и каталог, и последний раздел: сессии другого процесса не попадут в него 
+        после того, как id нового раздела выбран. Если каталог с момента чтения partitions 
+        изменил другой процесс, раздел не создается (вызывающий перечитывает каталог)"""
+        alias = self._alias(name)
+        self._attach(self.connection, [p.name for p in partitions[-1:]] + [name], self.partition_pragmas)
+        self._create_data_tables(alias)
+        with self.connection as conn:
+            conn.execute("BEGIN IMMEDIATE;")
+            if self._partitions(conn) != partitions:
+                return
+            last_id = 0
+            if partitions:
+                row = conn.execute(f"SELECT MAX(id) AS id FROM {self._alias(partitions[-1].name)}.sessions;").fetchone()
+                last_id = row.id if row.id is not None else partitions[-1].first_id - 1
+            conn.execute(f"INSERT INTO {alias}.sqlite_sequence (name, seq) VALUES ('sessions', ?);", (last_id, ))
+            conn.execute("INSERT INTO main.partitions (name, first_id) VALUES (?, ?);", (name, last_id + 1))
+
+    @contextmanager
+    def session_reader(self, session_id):
+        """Соединение для чтения и схема, где лежит сессия (main или подключенный раздел, 
+        None - сессия не может быть ни в одном разделе)"""
+        with self.reader() as conn:
+            schema = self._schema(conn, session_id)
+            if schema and schema != "main":
+                self._attach(conn, [self._partition_of(conn, session_id)])
+            yield conn, schema
+
+    def _fan_out(self, sql, params=(), order=None, names=None):
+        """Строки запроса sql ({p} - схема с таблицами сессий) по всем данным: для БД одним 
+        файлом - по main, иначе по разделам names (по умолчанию всем). Разделы подключаются 
+        к одному соединению пачками до SQLITE_LIMIT_ATTACHED, запросы пачки объединяются 
+        UNION ALL и сортируются по order, пачки идут по порядку id сессий"""
+        with self.reader() as conn:
+            if not self.partition:
+                return conn.execute(sql.format(p="main") + (f" ORDER BY {order}" if order else ""), params).fetchall()
+            if names is None:
+                names = [row.name for row in self._partitions(conn)]
+            rows = []
+            for i in range(0, len(names), self.attach_limit):
+                batch = names[i:i + self.attach_limit]
+                self._attach(conn, batch)
+                union = " UNION ALL ".join(sql.format(p=self._alias(name)) for name in batch)
+                rows += conn.execute(union + (f" ORDER BY {order}" if order else ""), list(params) * len(batch)).fetchall()
+            return rows
+
+    def _each_schema(self, conn, names=None, pragmas=()):
+        """Схемы с таблицами сессий по одной, для запросов, которые читаются курсором или пишут 
+        в каждый раздел: main для БД одним файлом, иначе разделы names (по умолчанию все) по 
+        порядку id сессий, каждый подключается к conn перед тем, как отдать его схему"""
+        if not self.partition:
+            yield "main"
+            return
+        if names is None:
+            names = [row.name for row in self._partitions(conn)]
+        for name in names:
+            self._attach(conn, [name], pragmas)
+            yield self._alias(name)
+
+    def partitions(self):
+        """Разделы БД: (name, first_id, path, size - байт в файле, 0 - если файла нет)"""
+        with self.reader() as conn:
+            partitions = self._partitions(conn) if self.partition else []
+        return [(p.name, p.first_id, self.partition_path(p.name), 
+                 os.path.getsize(self.partition_path(p.name)) if os.path.isfile(self.partition_path(p.name)) else 0) 
+                for p in partitions]
+
+    def drop_partitions(self, before):
+        """Хранение данных: удаляет разделы, период которых закончился не позже before (datetime 
+        или строка ISO) - строку каталога и файл раздела. Последний раздел не удаляется. 
+        Перед удалением файлов раздел отключается от соединения записи, а соединения пула 
+        заменяются новыми. Возвращает имена удаленных разделов"""
+        if not self.partition:
+            raise ValueError(f"drop_partitions needs a partitioned database, {self.path} is a single file")
+        before = datetime.datetime.fromisoformat(str(before))
+        with self.write_lock:
+            partitions = self._partitions(self.connection)
+            dropped = [p.name for p in partitions[:-1] if self._period(p.name)[1] <= before]
+            attached = {row.name for row in self.connection.execute("PRAGMA database_list;")}
+            for name in dropped:
+                if self._alias(name) in attached:
+                    self.connection.execute(f"DETACH DATABASE {self._alias(name)};")
+            with self.connection as conn:
+                conn.executemany("DELETE FROM main.partitions WHERE name = ?;", [(name, ) for name in dropped])
+                conn.executemany("DELETE FROM main.meta WHERE key IN (?, ?);", 
+                                 [(f"heatmap_chunk:{self._alias(name)}", f"heatmap_session:{self._alias(name)}") for name in dropped])
+        if dropped and self.pool is not None:
+            self._invalidate_pool()
+        for name in dropped:
+            for suffix in ("", "-wal", "-shm", "-journal"):
+                if os.path.isfile(self.partition_path(name) + suffix):
+                    os.remove(self.partition_path(name) + suffix)
+        return dropped
+
+    def _invalidate_pool(self):
+        """Закрывает свободные соединения пула, занятые закроются при возврате (reader): 
+        к ним могут быть подключены удаленные разделы"""
+        with self.pool_lock:
+            self.pool_generation += 1
+            while not self.pool.empty():
+                self.pool.get_nowait()[1].close()
+                self.pool_opened -= 1
+
+    def close(self):
+        if self.pool is not None:
+            while not self.pool.empty():
+                self.pool.get_nowait()[1].close()
+        self.connection.close()
+
     def get_cursor(self):
         return self.connection.cursor()
 
-    def init_db(self):
+    def init_db(self, partition=None):
+        """Создает новую БД. Для БД с разделами (partition) в файле только каталог: 
+        пользователи, meta и список разделов, таблицы данных создаются в разделах"""
         sql_init_db = """
             DROP TABLE IF EXISTS users;
             CREATE TABLE users (
@@ -49,6 +715,16 @@ class Database:
                 hash TEXT
             );
             DROP TABLE IF EXISTS sessions;
+            DROP TABLE IF EXISTS chunks;
+            DROP TABLE IF EXISTS events;
+            DROP TABLE IF EXISTS meta;
+            DROP TABLE IF EXISTS user_stats;
+            CREATE TABLE meta (
+                key TEXT NOT NULL PRIMARY KEY,
+                value INTEGER
+            );
+        """
+        sql_create_sessions = """
             CREATE TABLE sessions (
                 id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
                 user TEXT,
@@ -62,94 +738,868 @@ class Database:
         """
         with self.connection as conn:
             conn.executescript(sql_init_db)
+            if partition is None:
+                conn.executescript(sql_create_sessions)
+            else:
+                conn.execute("INSERT INTO meta (key, value) VALUES ('partition', ?);", (partition, ))
+        self.upgrade_db()
+
+    def upgrade_db(self):
+        """Создает таблицы, появившиеся после первой версии схемы (для старых файлов БД), 
+        в старых файлах сводка user_stats и интервалы времени кусков при этом один раз 
+        заполняются по всем сессиям. В каталоге БД с разделами - только таблицы каталога"""
+        sql_upgrade_catalog = """
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT NOT NULL PRIMARY KEY,
+                value INTEGER
+            );
+            INSERT OR IGNORE INTO meta (key, value) VALUES ('users_version', 0);
+            CREATE TABLE IF NOT EXISTS partitions (
+                name TEXT NOT NULL PRIMARY KEY,
+                first_id INTEGER NOT NULL
+            );
+            INSERT OR IGNORE INTO meta (key, value) VALUES ('heatmap_cell', {cell});
+            INSERT OR IGNORE INTO meta (key, value) VALUES ('heatmap_codes', '{codes}');
+        """
+        with self.connection as conn:
+            conn.executescript(sql_upgrade_catalog.format(cell=float(GRID_CELL), codes=",".join(map(str, POSITION_CODES))))
+        if self.connection.execute("SELECT value FROM meta WHERE key = 'partition';").fetchone():
+            return
+
+        migrate = not self.connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'user_stats';").fetchone()
+        columns = [r.name for r in self.connection.execute("PRAGMA table_info(chunks);")]
+        with self.connection as conn:
+            if columns and "ts_min" not in columns:
+                conn.execute("ALTER TABLE chunks ADD COLUMN ts_min INTEGER;")
+                conn.execute("ALTER TABLE chunks ADD COLUMN ts_max INTEGER;")
+        self._create_data_tables("main")
+        if migrate:
+            self.rebuild_user_stats()
+        if columns and "ts_min" not in columns:
+            self.index_chunks()
+
+    def _create_data_tables(self, schema):
+        """Таблицы данных сессий в схеме schema: main для БД одним файлом или подключенный 
+        раздел. Сводка user_stats и тепловая карта ведутся там же, где лежат сессии"""
+        sql_create_data = """
+            CREATE TABLE IF NOT EXISTS {p}.sessions (
+                id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+                user TEXT,
+                timestamp TIMESTAMP,
+                blob BLOB
+            );
+            CREATE TABLE IF NOT EXISTS {p}.chunks (
+                session_id INTEGER NOT NULL,
+                seq INTEGER NOT NULL,
+                data BLOB,
+                ts_min INTEGER,
+                ts_max INTEGER,
+                PRIMARY KEY (session_id, seq),
+                FOREIGN KEY (session_id)
+                    REFERENCES sessions (id)
+                        ON UPDATE RESTRICT
+                        ON DELETE CASCADE
+            );
+            CREATE TABLE IF NOT EXISTS {p}.events (
+                session_id INTEGER NOT NULL,
+                ts INTEGER NOT NULL,
+                code INTEGER NOT NULL,
+                value NUMERIC,
+                FOREIGN KEY (session_id)
+                    REFERENCES sessions (id)
+                        ON UPDATE RESTRICT
+                        ON DELETE CASCADE
+            );
+            CREATE TABLE IF NOT EXISTS {p}.user_stats (
+                user TEXT NOT NULL PRIMARY KEY,
+                sessions INTEGER NOT NULL DEFAULT 0,
+                events INTEGER NOT NULL DEFAULT 0,
+                bytes INTEGER NOT NULL DEFAULT 0,
+                first_seen TIMESTAMP,
+                last_seen TIMESTAMP
+            );
+            CREATE TABLE IF NOT EXISTS {p}.heatmap (
+                cx INTEGER NOT NULL,
+                cy INTEGER NOT NULL,
+                cz INTEGER NOT NULL,
+                visits INTEGER NOT NULL DEFAULT 0,
+                dwell INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (cx, cy, cz)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS {p}.heatmap_sessions (
+                session_id INTEGER NOT NULL PRIMARY KEY,
+                seq INTEGER NOT NULL,
+                ts INTEGER,
+                x REAL,
+                y REAL,
+                z REAL,
+                cx INTEGER,
+                cy INTEGER,
+                cz INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS {p}.events_session_ts ON events (session_id, ts);
+            CREATE INDEX IF NOT EXISTS {p}.events_session_code_ts ON events (session_id, code, ts);
+            CREATE INDEX IF NOT EXISTS {p}.sessions_user_ts ON sessions (user, timestamp);
+            CREATE INDEX IF NOT EXISTS {p}.chunks_session_ts ON chunks (session_id, ts_min, ts_max, seq);
+        """
+        sql_create_projection = """
+            CREATE TABLE IF NOT EXISTS {p}.heatmap_{plane} (
+                a INTEGER NOT NULL,
+                b INTEGER NOT NULL,
+                visits INTEGER NOT NULL DEFAULT 0,
+                dwell INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (a, b)
+            ) WITHOUT ROWID;
+        """
+        with self.connection as conn:
+            conn.executescript(sql_create_data.format(p=schema) 
+                               + "".join(sql_create_projection.format(p=schema, plane=plane) for plane in PLANES))
 
     def add_user(self, user, password):
         if self.get_user(user) is None:
             sql_add_user = """
                 INSERT INTO users (id, name, hash) VALUES ( ? , ? , ? );
             """
-            with self.connection as conn:
+            with self.writer() as conn:
                 conn.execute(sql_add_user, (None, user, salt_and_hash(password)))
+                self._bump_users_version(conn)
+
+    def add_users(self, users):
+        """Добавляет недостающих пользователей [(user, password), ...] в одной транзакции"""
+        with self.writer() as conn:
+            existing = {r.name for r in conn.execute("SELECT name FROM users;")}
+            new = [(None, user, salt_and_hash(password)) for user, password in users if user not in existing]
+            if new:
+                conn.executemany("INSERT INTO users (id, name, hash) VALUES ( ? , ? , ? );", new)
+                self._bump_users_version(conn)
+
+    def set_password(self, user, password):
+        sql_set_password = """
+            UPDATE users SET hash = ? WHERE name = ?;
+        """
+        with self.writer() as conn:
+            conn.execute(sql_set_password, (salt_and_hash(password), user))
+            self._bump_users_version(conn)
+
+    def _bump_users_version(self, conn):
+        """Любое изменение users увеличивает счетчик, по нему серверы сбрасывают кэш авторизации"""
+        conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'users_version';")
+
+    def users_version(self):
+        with self.reader() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'users_version';").fetchone()
+        return row.value
 
     def get_user(self, username):
         sql_get_user = """
             SELECT * FROM users WHERE name = ?;
         """
-        with self.connection as conn:
+        with self.reader() as conn:
             cur = conn.execute(sql_get_user, (username, ))
-        row = cur.fetchone()
-        cur.close()
+            row = cur.fetchone()
+            cur.close()
         return row
 
 
-    def add_session(self, username, blob):
-        sql_insert_blob_query = """
-            INSERT INTO sessions (id, user, timestamp, blob) VALUES (?, ?, ?, ?);
+    def open_session(self, username, conn=None):
+        """Создает строку сессии без данных (данные пишутся кусками в chunks), возвращает ее id"""
+        sql_open_session = """
+            INSERT INTO {p}.sessions (id, user, timestamp, blob) VALUES (?, ?, ?, NULL);
+        """
+        sql_count_session = """
+            INSERT INTO {p}.user_stats (user, sessions, first_seen, last_seen) VALUES (?, 1, ?, ?)
+            ON CONFLICT (user) DO UPDATE SET sessions = sessions + 1, last_seen = excluded.last_seen;
         """
         timestamp = datetime.datetime.now()
-        with self.connection as conn:
-            conn.execute(sql_insert_blob_query, (None, username, timestamp, sqlite3.Binary(blob)))
-        
+        if conn is None:
+            with self.writer(new_sessions=True) as conn:
+                return self.open_session(username, conn)
+        session_id = conn.execute(sql_open_session.format(p=self.schema), (None, username, timestamp)).lastrowid
+        conn.execute(sql_count_session.format(p=self.schema), (username, timestamp, timestamp))
+        return session_id
 
-    def save_session(self, session_id):
+    def add_chunks(self, session_id, seq, chunks, username=None, conn=None):
+        """Дописывает куски данных сессии начиная с номера seq, если session_id не задан, 
+        в той же транзакции создается новая сессия пользователя username. 
+        Возвращает (session_id, номер следующего куска)"""
+        sql_insert_chunk = """
+            INSERT INTO {p}.chunks (session_id, seq, data, ts_min, ts_max) VALUES (?, ?, ?, ?, ?);
+        """
+        if conn is None:
+            with self.writer(session_id, new_sessions=session_id is None) as conn:
+                return self.add_chunks(session_id, seq, chunks, username, conn)
+
+        if session_id is None:
+            session_id = self.open_session(username, conn)
+            schema = self.schema
+        else:
+            schema = self._schema(conn, session_id)
+        conn.executemany(sql_insert_chunk.format(p=schema), 
+                         [(session_id, seq + i, sqlite3.Binary(encode_blob(chunk, self.compression)), *ts_range(chunk)) 
+                          for i, chunk in enumerate(chunks)])
+        self._count_data(conn, session_id, username, 
+                         sum(chunk.count(b"\n") for chunk in chunks), sum(len(chunk) for chunk in chunks), schema)
+        if self.index_events:
+            self.add_events(session_id, b"".join(chunks), conn)
+        return session_id, seq + len(chunks)
+
+    def _count_data(self, conn, session_id, username, events, size, schema="main"):
+        """Добавляет события и байты сессии в сводку пользователя (в разделе сессии)"""
+        if username is None:
+            username = conn.execute(f"SELECT user FROM {schema}.sessions WHERE id = ?;", (session_id, )).fetchone().user
+        conn.execute(f"UPDATE {schema}.user_stats SET events = events + ?, bytes = bytes + ? WHERE user = ?;", 
+                     (events, size, username))
+
+    def rebuild_user_stats(self):
+        """Пересчитывает сводку user_stats по всем сессиям: количество и время сессий берутся 
+        из sessions, события и байты - из данных сессий, которые для этого читаются потоково"""
+        sql_fill_user_stats = """
+            INSERT INTO user_stats (user, sessions, first_seen, last_seen)
+            SELECT user, COUNT(id), MIN(timestamp), MAX(timestamp) FROM sessions GROUP BY user;
+        """
+        with self.reader() as conn:
+            sessions = conn.execute("SELECT id AS id, user AS user FROM sessions;").fetchall()
+        totals = {}
+        for session in sessions:
+            events, size = totals.get(session.user, (0, 0))
+            for data in self.iter_session(session.id):
+                events += data.count(b"\n")
+                size += len(data)
+            totals[session.user] = (events, size)
+
+        with self.writer() as conn:
+            conn.execute("DELETE FROM user_stats;")
+            conn.execute(sql_fill_user_stats)
+            conn.executemany("UPDATE user_stats SET events = ?, bytes = ? WHERE user = ?;", 
+                             [(events, size, user) for user, (events, size) in totals.items()])
+
+    def user_stats(self, username=None):
+        """Строки сводки (user, sessions, events, bytes, first_seen, last_seen): всех 
+        пользователей по убыванию числа сессий или одного пользователя (None, если сессий нет). 
+        В БД с разделами сводки разделов складываются"""
+        if self.partition:
+            rows = self._fan_out("SELECT * FROM {p}.user_stats" + (" WHERE user = ?" if username is not None else ""),
+                                 (username, ) if username is not None else ())
+            totals = {}
+            for row in rows:
+                total = totals.get(row.user)
+                totals[row.user] = row if total is None else total._replace(
+                    sessions=total.sessions + row.sessions, events=total.events + row.events, 
+                    bytes=total.bytes + row.bytes, first_seen=min(total.first_seen, row.first_seen), 
+                    last_seen=max(total.last_seen, row.last_seen))
+            if username is not None:
+                return totals.get(username)
+            return sorted(totals.values(), key=lambda row: row.sessions, reverse=True)
+        with self.reader() as conn:
+            if username is not None:
+                return conn.execute("SELECT * FROM user_stats WHERE user = ?;", (username, )).fetchone()
+            return conn.execute("SELECT * FROM user_stats ORDER BY sessions DESC;").fetchall()
+
+    def add_events(self, session_id, data, conn=None):
+        """Раскладывает события из данных сессии в таблицу events"""
+        sql_insert_events = """
+            INSERT INTO {p}.events (session_id, ts, code, value) VALUES (?, ?, ?, ?);
+        """
+        rows = [(session_id, *event) for event in parse_events(data)]
+        if conn is None:
+            with self.writer(session_id) as conn:
+                conn.executemany(sql_insert_events.format(p=self._schema(conn, session_id)), rows)
+        else:
+            conn.executemany(sql_insert_events.format(p=self._schema(conn, session_id)), rows)
+        return len(rows)
+
+    def index_sessions(self):
+        """Заполняет таблицу events для сохраненных сессий, у которых событий в ней еще нет, 
+        возвращает количество обработанных сессий"""
+        sql_select_not_indexed = """
+            SELECT s.id AS id FROM {p}.sessions s WHERE NOT EXISTS (SELECT 1 FROM {p}.events e WHERE e.session_id = s.id)
+        """
+        rows = self._fan_out(sql_select_not_indexed, order="id")
+        for row in rows:
+            self.add_events(row.id, self.read_session(row.id))
+        return len(rows)
+
+    def events(self, username, code=None, t_from=None, t_to=None):
+        """Генератор событий пользователя (session_id, ts, code, value) по возрастанию времени 
+        внутри сессии, с фильтром по коду события и интервалу времени [t_from, t_to]. 
+        Результат читается курсором по мере перебора, данные сессий целиком не загружаются, 
+        разделы БД с разделами читаются по очереди"""
+        sql_select_events = """
+            SELECT e.session_id AS session_id, e.ts AS ts, e.code AS code, e.value AS value
+            FROM {{p}}.sessions s JOIN {{p}}.events e ON e.session_id = s.id
+            WHERE s.user = ? {}
+            ORDER BY e.session_id, e.ts;
+        """
+        conditions, params = [], [username]
+        if code is not None:
+            conditions.append("e.code = ?")
+            params.append(code)
+        if t_from is not None:
+            conditions.append("e.ts >= ?")
+            params.append(t_from)
+        if t_to is not None:
+            conditions.append("e.ts <= ?")
+            params.append(t_to)
+        sql = sql_select_events.format("".join(f"AND {c} " for c in conditions))
+
+        with self.reader() as conn:
+            for schema in self._each_schema(conn):
+                cur = conn.execute(sql.format(p=schema), params)
+                try:
+                    yield from cur
+                finally:
+                    cur.close()
+
+    def close_session(self, session_id):
+        """Вызывается после записи последнего куска сессии. Данные к этому моменту уже в БД, 
+        метод нужен заместителям Database (например, очереди к процессу записи)"""
+        pass
+
+    def add_session(self, username, blob, conn=None):
+        chunks = split_chunks(blob)
+        if chunks:
+            self.add_chunks(None, 0, chunks, username, conn)
+        else:
+            self.open_session(username, conn)
+
+    def add_sessions(self, sessions):
+        """Сохраняет несколько сессий [(username, blob), ...] в одной транзакции"""
+        with self.writer(new_sessions=True) as conn:
+            for username, blob in sessions:
+                self.add_session(username, blob, conn)
+
+    def tune_for_writes(self, cache_kib=WRITER_CACHE_KIB):
+        """Настройки соединения для потока записи: журнал WAL (читатели не блокируют запись), 
+        synchronous=NORMAL (fsync только на контрольных точках WAL) и увеличенный кэш страниц"""
+        with self.write_lock:
+            self.connection.execute("PRAGMA journal_mode=WAL;")
+            self.connection.execute("PRAGMA synchronous=NORMAL;")
+            self.connection.execute(f"PRAGMA cache_size=-{int(cache_kib)};")
+            pragmas = ["journal_mode=WAL", "synchronous=NORMAL", f"cache_size=-{int(cache_kib)}"]
+            for row in self.connection.execute("PRAGMA database_list;").fetchall():
+                if row.name not in ("main", "temp"):
+                    for pragma in pragmas:
+                        self.connection.execute(f"PRAGMA {row.name}.{pragma};")
+            self.partition_pragmas += pragmas
+
+    def read_session(self, session_id):
+        """Собирает данные сессии: старые сессии хранятся целиком в sessions.blob, 
+        новые - кусками в таблице chunks"""
         sql_fetch_blob_query = """
-            SELECT * FROM sessions WHERE id = ? ;
+            SELECT * FROM {p}.sessions WHERE id = ? ;
         """
-        with self.connection as conn:
-            cur = conn.execute(sql_fetch_blob_query, (session_id,))
-        row = cur.fetchone()
-        cur.close()
+        sql_fetch_chunks_query = """
+            SELECT data FROM {p}.chunks WHERE session_id = ? ORDER BY seq;
+        """
+        with self.session_reader(session_id) as (conn, schema):
+            if schema is None:
+                return None
+            row = conn.execute(sql_fetch_blob_query.format(p=schema), (session_id,)).fetchone()
+            if row is None:
+                return None
+            if row.blob is not None:
+                return decode_blob(row.blob)
+            chunks = conn.execute(sql_fetch_chunks_query.format(p=schema), (session_id,)).fetchall()
+        return b"".join(decode_blob(r.data) for r in chunks)
+
+    def _read_blob(self, conn, table, column, rowid, block=EXPORT_BLOCK, schema="main"):
+        """Читает значение BLOB через инкрементальный доступ (blobopen): несжатые данные 
+        отдаются блоками по block байт прямо из файла БД, сжатые раскодируются целиком 
+        (это кусок сессии из chunks, его размер ограничен CHUNK_SIZE)"""
+        with conn.blobopen(table, column, rowid, readonly=True, name=schema) as blob:
+            if blob.read(len(CODEC_MARKER)) == CODEC_MARKER:
+                blob.seek(0)
+                yield decode_blob(blob.read())
+                return
+            blob.seek(0)
+            while data := blob.read(block):
+                yield data
+
+    def iter_session(self, session_id, block=EXPORT_BLOCK):
+        """Генератор данных сессии по частям, в отличие от read_session сессия целиком 
+        в памяти не собирается: в каждый момент держится не больше одного куска"""
+        sql_fetch_session = """
+            SELECT length(blob) AS size FROM {p}.sessions WHERE id = ? ;
+        """
+        sql_fetch_chunks = """
+            SELECT rowid AS rowid FROM {p}.chunks WHERE session_id = ? AND length(data) > 0 ORDER BY seq;
+        """
+        with self.session_reader(session_id) as (conn, schema):
+            if schema is None:
+                return
+            row = conn.execute(sql_fetch_session.format(p=schema), (session_id, )).fetchone()
+            if row is None:
+                return
+            if row.size:                    # старая сессия хранится целиком в sessions.blob
+                yield from self._read_blob(conn, "sessions", "blob", session_id, block, schema)
+                return
+            for chunk in conn.execute(sql_fetch_chunks.format(p=schema), (session_id, )).fetchall():
+                yield from self._read_blob(conn, "chunks", "data", chunk.rowid, block, schema)
+
+    def index_chunks(self):
+        """Заполняет интервалы времени (ts_min, ts_max) кусков, записанных до их появления, 
+        возвращает количество обработанных кусков"""
+        with self.reader() as conn:
+            rows = conn.execute("SELECT rowid AS rowid FROM chunks WHERE ts_min IS NULL;").fetchall()
+            ranges = [(*ts_range(b"".join(self._read_blob(conn, "chunks", "data", row.rowid))), row.rowid) 
+                      for row in rows]
+        with self.writer() as conn:
+            conn.executemany("UPDATE chunks SET ts_min = ?, ts_max = ? WHERE rowid = ?;", ranges)
+        return len(rows)
+
+    def read_range(self, username, t_from=None, t_to=None, session_id=None):
+        """Генератор событий пользователя (или одной его сессии) с временной меткой в [t_from, t_to]: 
+        пары (session_id, строки событий одного куска). По индексу кусков читаются только куски, 
+        интервал времени которых пересекается с запрошенным, поэтому объем чтения 
+        пропорционален результату, а не размеру сессий. Старые сессии, хранящиеся целиком 
+        в sessions.blob, индекса не имеют и просматриваются потоково. В БД с разделами разделы 
+        читаются по очереди, для одной сессии - только ее раздел"""
+        sql_select_chunks = """
+            SELECT c.session_id AS session_id, c.rowid AS rowid
+            FROM {p}.sessions s JOIN {p}.chunks c ON c.session_id = s.id
+            WHERE s.user = ? {condition} AND c.ts_max >= ? AND c.ts_min <= ?
+            ORDER BY c.session_id, c.seq;
+        """
+        sql_select_blobs = """
+            SELECT s.id AS id FROM {p}.sessions s WHERE s.user = ? {condition} AND s.blob IS NOT NULL ORDER BY s.id;
+        """
+        params = [username] + ([session_id] if session_id is not None else [])
+        condition = "AND s.id = ?" if session_id is not None else ""
+        bounds = [-2**63 if t_from is None else t_from, 2**63 - 1 if t_to is None else t_to]
+
+        with self.reader() as conn:
+            names = None
+            if self.partition and session_id is not None:
+                names = [name] if (name := self._partition_of(conn, session_id)) else []
+            for schema in self._each_schema(conn, names):
+                for row in conn.execute(sql_select_blobs.format(p=schema, condition=condition), params).fetchall():
+                    tail = b""
+                    for data in self._read_blob(conn, "sessions", "blob", row.id, schema=schema):
+                        data = tail + data
+                        cut = data.rfind(b"\n") + 1
+                        data, tail = data[:cut], data[cut:]
+                        if data := filter_range(data, t_from, t_to):
+                            yield row.id, data
+                    if tail := filter_range(tail, t_from, t_to):
+                        yield row.id, tail
+
+                sql = sql_select_chunks.format(p=schema, condition=condition)
+                for row in conn.execute(sql, params + bounds).fetchall():
+                    data = b"".join(self._read_blob(conn, "chunks", "data", row.rowid, schema=schema))
+                    if data := filter_range(data, t_from, t_to):
+                        yield row.session_id, data
 
+    def heatmap_cell(self):
+        with self.reader() as conn:
+            return self._heatmap_settings(conn)[0]
+
+    def heatmap_codes(self):
+        """Коды событий с координатами x, y, z, по которым строится тепловая карта"""
+        with self.reader() as conn:
+            return self._heatmap_settings(conn)[1]
+
+    @staticmethod
+    def _heatmap_settings(conn):
+        """Размер ячейки и коды координат тепловой карты из meta"""
+        rows = dict(conn.execute("SELECT key, value FROM meta WHERE key IN ('heatmap_cell', 'heatmap_codes');").fetchall())
+        return rows["heatmap_cell"], tuple(int(code) for code in str(rows["heatmap_codes"]).split(","))
+
+    @classmethod
+    def _heatmap_version(cls, conn):
+        """Настройки карты и номер ее перестроения (rebuild_heatmap) - по ним обновление
+        проверяет, что прочитанные без блокировки данные еще годятся для записи"""
+        row = conn.execute("SELECT value FROM meta WHERE key = 'heatmap_generation';").fetchone()
+        return (*cls._heatmap_settings(conn), row[0] if row else 0)
+
+    def _session_positions(self, conn, session, chunks, codes, schema="main"):
+        """События положения из данных сессии, еще не учтенных в тепловой карте: куски
+        chunks (rowid) или (для старой сессии в sessions.blob) вся сессия"""
+        if session.legacy:
+            tail = b""
+            for data in self._read_blob(conn, "sessions", "blob", session.id, schema=schema):
+                data = tail + data
+                cut = data.rfind(b"\n") + 1
+                yield parse_positions(data[:cut], codes)
+                tail = data[cut:]
+            yield parse_positions(tail, codes)
+            return
+        for rowid in chunks:
+            yield parse_positions(b"".join(self._read_blob(conn, "chunks", "data", rowid, schema=schema)), codes)
+
+    def _map_session(self, conn, schema, session, cell, codes):
+        """Читает и раскладывает по сетке еще не учтенные данные сессии (без блокировки записи), 
+        возвращает (номер следующего куска до и после, последнее положение, ячейки {(cx, cy, cz): [входы, пребывание]})"""
+        row = conn.execute(f"SELECT * FROM {schema}.heatmap_sessions WHERE session_id = ?;", (session.id, )).fetchone()
+        if row and session.legacy:          # старая сессия не дописывается, уже учтена целиком
+            return None
+        seq = row.seq if row else None
+        state = [row.ts, row.x, row.y, row.z, None if row.cx is None else (row.cx, row.cy, row.cz)] \
+                if row else [None] * 5
+        chunks = conn.execute(f"SELECT rowid AS rowid, seq AS seq FROM {schema}.chunks WHERE session_id = ? AND seq >= ? ORDER BY seq;",
+                              (session.id, seq or 0)).fetchall()
+        if not chunks and not session.legacy:
+            return None
+        cells = {}
+        for events in self._session_positions(conn, session, [c.rowid for c in chunks], codes, schema):
+            state = accumulate_positions(events, state, cell, cells, codes)
+        return seq, (chunks[-1].seq + 1 if chunks else 0), state, cells
+
+    def update_heatmap(self):
+        """Добавляет в тепловую карту данные, записанные после прошлого обновления: новые
+        сессии и новые куски продолжающихся. Отметки в meta (последний учтенный rowid кусков 
+        и id старой сессии в sessions.blob, по схеме) ограничивают выборку новыми строками, 
+        а по каждой сессии хранится номер следующего куска и последнее положение 
+        (heatmap_sessions), поэтому уже учтенные данные повторно не читаются и карта не 
+        перестраивается. Вместе с сеткой (heatmap) обновляются ее проекции на плоскости 
+        (heatmap_xy, ...), из которых карта плоскости читается без суммирования по третьей оси. 
+        Данные читаются и разбираются через соединение чтения, блокировка записи берется 
+        только на запись ячеек сессии, поэтому обновление не задерживает прием на работающем 
+        сервере (HeatmapUpdater). В БД с разделами карта ведется в разделе сессии, запросы 
+        к карте складывают разделы. Возвращает количество обработанных сессий"""
+        sql_select_legacy = """
+            SELECT id AS id, 1 AS legacy FROM {p}.sessions WHERE id > ? AND blob IS NOT NULL ORDER BY id;
+        """
+        sql_select_chunked = """
+            SELECT session_id AS id, 0 AS legacy, MAX(rowid) AS last FROM {p}.chunks WHERE rowid > ?
+            GROUP BY session_id ORDER BY session_id;
+        """
+        sql_select_marks = """
+            SELECT key AS key, value AS value FROM meta WHERE key IN (?, ?);
+        """
+        sql_save_marks = """
+            INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?), (?, ?);
+        """
+        processed = 0
+        with self.reader() as conn:
+            version = self._heatmap_version(conn)
+            cell, codes, _ = version
+            for schema in self._each_schema(conn):
+                keys = (f"heatmap_chunk:{schema}", f"heatmap_session:{schema}")
+                marks = dict(conn.execute(sql_select_marks, keys).fetchall())
+                chunk_mark, session_mark = (marks.get(key, 0) for key in keys)
+                legacy = conn.execute(sql_select_legacy.format(p=schema), (session_mark, )).fetchall()
+                chunked = conn.execute(sql_select_chunked.format(p=schema), (chunk_mark, )).fetchall()
+                for session in legacy + chunked:
+                    mapped = self._map_session(conn, schema, session, cell, codes)
+                    if mapped is None:
+                        continue
+                    if not self._save_session_cells(schema, session.id, mapped, version):
+                        return processed    # карту перестроили, дальше обновляет rebuild_heatmap
+                    processed += 1
+                if legacy or chunked:
+                    with self.writer() as writer:
+                        if self._heatmap_version(writer) != version:
+                            return processed
+                        writer.execute(sql_save_marks, (keys[0], max([chunk_mark] + [s.last for s in chunked]), 
+                                                        keys[1], max([session_mark] + [s.id for s in legacy])))
+        return processed
+
+    def _save_session_cells(self, schema, session_id, mapped, version):
+        """Добавляет ячейки сессии в карту и сохраняет ее состояние одной транзакцией. Если 
+        с момента чтения сессию уже учло другое обновление, ничего не пишет (True), если 
+        карту перестроили (rebuild_heatmap) - тоже, но возвращает False"""
+        sql_add_cells = """
+            INSERT INTO {p}.heatmap (cx, cy, cz, visits, dwell) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (cx, cy, cz) DO UPDATE SET visits = visits + excluded.visits, dwell = dwell + excluded.dwell;
+        """
+        sql_add_projection = """
+            INSERT INTO {p}.heatmap_{plane} (a, b, visits, dwell) VALUES (?, ?, ?, ?)
+            ON CONFLICT (a, b) DO UPDATE SET visits = visits + excluded.visits, dwell = dwell + excluded.dwell;
+        """
+        sql_save_state = """
+            INSERT OR REPLACE INTO {p}.heatmap_sessions (session_id, seq, ts, x, y, z, cx, cy, cz)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);
+        """
+        seq, next_seq, state, cells = mapped
+        with self.writer(session_id) as conn:
+            if self._heatmap_version(conn) != version:
+                return False
+            row = conn.execute(f"SELECT seq FROM {schema}.heatmap_sessions WHERE session_id = ?;", (session_id, )).fetchone()
+            if (row.seq if row else None) != seq:
+                return True
+            conn.executemany(sql_add_cells.format(p=schema), [(*key, *value) for key, value in cells.items()])
+            for plane, (i, j) in PLANES.items():
+                projection = {}
+                for key, (visits, dwell) in cells.items():
+                    total = projection.setdefault((key[i], key[j]), [0, 0])
+                    total[0] += visits
+                    total[1] += dwell
+                conn.executemany(sql_add_projection.format(p=schema, plane=plane), 
+                                 [(*key, *value) for key, value in projection.items()])
+            conn.execute(sql_save_state.format(p=schema), (session_id, next_seq, *state[:4], *(state[4] or (None, ) * 3)))
+        return True
+
+    def rebuild_heatmap(self, cell=None, codes=None):
+        """Строит тепловую карту заново по всем сессиям, с новым размером ячейки cell 
+        и (или) новыми кодами событий координат codes - (x, y, z)"""
+        if cell is not None and not cell > 0:
+            raise ValueError(f"Cell size must be positive, got {cell}")
+        if codes is not None:
+            codes = tuple(int(code) for code in codes)
+            if len(codes) != 3 or len(set(codes)) != 3:
+                raise ValueError(f"Position codes must be three distinct event codes (x, y, z), got {codes}")
+        with self.write_lock:       # разделы подключаются вне транзакции, очищаются каждый в своей
+            for schema in self._each_schema(self.connection, pragmas=self.partition_pragmas):
+                with self.connection as conn:
+                    for table in ("heatmap", "heatmap_sessions", *(f"heatmap_{plane}" for plane in PLANES)):
+                        conn.execute(f"DELETE FROM {schema}.{table};")
+            with self.connection as conn:
+                conn.execute("DELETE FROM meta WHERE key LIKE 'heatmap_chunk:%' OR key LIKE 'heatmap_session:%';")
+                conn.execute("""INSERT INTO meta (key, value) VALUES ('heatmap_generation', 1)
+                                ON CONFLICT (key) DO UPDATE SET value = value + 1;""")
+                if cell is not None:
+                    conn.execute("UPDATE meta SET value = ? WHERE key = 'heatmap_cell';", (float(cell), ))
+                if codes is not None:
+                    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('heatmap_codes', ?);", 
+                                 (",".join(map(str, codes)), ))
+        return self.update_heatmap()
+
+    def _cell_bounds(self, lo, hi):
+        """Номера ячеек [(min, max), ...] по осям x, y, z параллелепипеда [lo, hi] (координаты
+        мира, None вместо точки или координаты - без ограничения)"""
+        cell = self.heatmap_cell()
+        return [(None if lo is None or lo[i] is None else math.floor(lo[i] / cell),
+                 None if hi is None or hi[i] is None else math.floor(hi[i] / cell)) for i in range(3)]
+
+    @staticmethod
+    def _where(bounds, columns):
+        conditions, params = [], []
+        for (low, high), column in zip(bounds, columns):
+            if low is not None:
+                conditions.append(f"{column} >= ?")
+                params.append(low)
+            if high is not None:
+                conditions.append(f"{column} <= ?")
+                params.append(high)
+        return ("WHERE " + " AND ".join(conditions) if conditions else ""), params
+
+    def heatmap(self, plane="xy", lo=None, hi=None):
+        """Тепловая карта в проекции на плоскость plane ("xy", "xz" или "yz"): строки (a, b, visits, dwell)
+        по столбцам ячеек, просуммированные по третьей оси, в параллелепипеде [lo, hi].
+        a, b - номера ячеек, угол ячейки в координатах мира - (a * cell, b * cell). Если третья
+        ось не ограничена, карта читается из готовой проекции, иначе суммируется по сетке.
+        В БД с разделами карты разделов складываются"""
+        i, j = PLANES[plane]
+        bounds = self._cell_bounds(lo, hi)
+        if bounds[3 - i - j] == (None, None):
+            condition, params = self._where([bounds[i], bounds[j]], ("a", "b"))
+            sql_select_heatmap = f"""
+                SELECT a AS a, b AS b, visits AS visits, dwell AS dwell FROM {{p}}.heatmap_{plane} {condition}
+            """
+        else:
+            a, b = GRID_COLUMNS[i], GRID_COLUMNS[j]
+            condition, params = self._where(bounds, GRID_COLUMNS)
+            sql_select_heatmap = f"""
+                SELECT {a} AS a, {b} AS b, SUM(visits) AS visits, SUM(dwell) AS dwell FROM {{p}}.heatmap {condition}
+                GROUP BY {a}, {b}
+            """
+        rows = self._fan_out(sql_select_heatmap, params, "a, b")
+        if not self.partition:
+            return rows
+        totals = {}
+        for row in rows:
+            total = totals.get((row.a, row.b))
+            totals[(row.a, row.b)] = row if total is None else total._replace(
+                visits=total.visits + row.visits, dwell=total.dwell + row.dwell)
+        return sorted(totals.values())
+
+    def region_stats(self, lo=None, hi=None):
+        """Сводка по параллелепипеду [lo, hi]: (cells - посещенных ячеек, visits - входов,
+        dwell - суммарное пребывание, мс)"""
+        sql_select_region = """
+            SELECT COUNT(*) AS cells, COALESCE(SUM(visits), 0) AS visits, COALESCE(SUM(dwell), 0) AS dwell
+            FROM heatmap {};
+        """
+        sql_select_cells = """
+            SELECT cx AS cx, cy AS cy, cz AS cz, visits AS visits, dwell AS dwell FROM {{p}}.heatmap {}
+        """
+        condition, params = self._where(self._cell_bounds(lo, hi), GRID_COLUMNS)
+        if not self.partition:
+            with self.reader() as conn:
+                return conn.execute(sql_select_region.format(condition), params).fetchone()
+        # ячейка бывает в нескольких разделах: посещенные ячейки считаются по объединению
+        rows = self._fan_out(sql_select_cells.format(condition), params)
+        return row_class(("cells", "visits", "dwell"))(len({(r.cx, r.cy, r.cz) for r in rows}), 
+                                                       sum(r.visits for r in rows), sum(r.dwell for r in rows))
+
+    def save_session(self, session_id):
         filename = f"./session{session_id}.txt"
         with open(filename, 'wb') as file:
-            file.write(row.blob)
+            for data in self.iter_session(session_id):
+                file.write(data)
+
+    def select_sessions(self, username=None, since=None, until=None):
+        """Сессии (id, user, timestamp) по возрастанию id, с фильтром по пользователю 
+        и времени начала сессии [since, until) (datetime или строка ISO). В БД с разделами 
+        читаются только разделы, период которых пересекается с [since, until)"""
+        sql_select_sessions = """
+            SELECT id AS id, user AS user, timestamp AS timestamp FROM {{p}}.sessions {}
+        """
+        conditions, params = [], []
+        if username is not None:
+            conditions.append("user = ?")
+            params.append(username)
+        if since is not None:
+            conditions.append("timestamp >= ?")
+            params.append(str(datetime.datetime.fromisoformat(str(since))))
+        if until is not None:
+            conditions.append("timestamp < ?")
+            params.append(str(datetime.datetime.fromisoformat(str(until))))
+        sql = sql_select_sessions.format("WHERE " + " AND ".join(conditions) if conditions else "")
+        names = None
+        if self.partition and (since is not None or until is not None):
+            with self.reader() as conn:
+                names = [p.name for p in self._partitions(conn) if self._overlaps(p.name, since, until)]
+        return self._fan_out(sql, params, "id", names)
+
+    def _overlaps(self, name, since, until):
+        start, end = self._period(name)
+        return ((since is None or end > datetime.datetime.fromisoformat(str(since))) 
+                and (until is None or start < datetime.datetime.fromisoformat(str(until))))
+
+    def _export_file(self, session, out, block=EXPORT_BLOCK):
+        size = 0
+        with open(os.path.join(out, f"session{session.id}.txt"), "wb", buffering=block) as file:
+            for data in self.iter_session(session.id, block):
+                size += file.write(data)
+        return size
+
+    def export(self, out, username=None, since=None, until=None, jobs=1, block=EXPORT_BLOCK):
+        """Потоковая выгрузка сессий: в каталог out (по файлу session{id}.txt на сессию, 
+        jobs потоков, если Database открыта с пулом соединений) или в один файл-архив out 
+        ("-" - stdout), где данные каждой сессии предваряет строка `# session id user timestamp`. 
+        Память не зависит от размера сессий. Возвращает (количество сессий, байт данных)"""
+        sessions = self.select_sessions(username, since, until)
+
+        if out != "-" and (os.path.isdir(out) or out.endswith(os.sep)):
+            os.makedirs(out, exist_ok=True)
+            if jobs > 1 and self.pool is not None:
+                with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="export") as executor:
+                    sizes = list(executor.map(lambda s: self._export_file(s, out, block), sessions))
+            else:
+                sizes = [self._export_file(session, out, block) for session in sessions]
+            return len(sessions), sum(sizes)
+
+        file = sys.stdout.buffer if out == "-" else open(out, "wb", buffering=block)
+        size = 0
+        try:
+            for session in sessions:
+                file.write(f"# session {session.id} {session.user} {session.timestamp}\n".encode("utf-8"))
+                for data in self.iter_session(session.id, block):
+                    size += file.write(data)
+        finally:
+            if file is not sys.stdout.buffer:
+                file.close()
+        return len(sessions), size
 
     def get_user_sessions(self, username):
         sql_select_user_sessions = """
-            SELECT user AS user, id AS id FROM sessions WHERE user = ? ;
+            SELECT user AS user, id AS id, timestamp AS timestamp FROM {p}.sessions WHERE user = ?
         """
-        with self.connection as conn:         
-            rows = conn.execute(sql_select_user_sessions, (username, )).fetchall()
+        # индекс sessions_user_ts, страницы с данными не читаются
+        rows = self._fan_out(sql_select_user_sessions, (username, ), "timestamp")
         
+        stats = self.user_stats(username)
+        if stats is not None:
+            print(f"{username}: {stats.sessions} sessions, {stats.events} events, {stats.bytes} bytes, "
+                  f"first seen {stats.first_seen}, last seen {stats.last_seen}")
         print(f"{username} sessions:", *[r.id for r in rows])
 
     def report(self):
-        sql = """
-            SELECT user AS username, COUNT(blob) as sessions FROM sessions GROUP BY user ORDER BY sessions DESC;
-        """
-        with self.connection as conn:
-            print("User\tNum of sessions")
-            
-            cur = conn.execute(sql)
-            for i, (user, num) in enumerate(cur.fetchall()):
-                print(f"{user}\t{num}")
+        """Сводка по пользователям из таблицы user_stats, без просмотра sessions"""
+        print("User\tNum of sessions\tEvents\tBytes\tLast seen")
+        for row in self.user_stats():
+            print(f"{row.user}\t{row.sessions}\t{row.events}\t{row.bytes}\t{row.last_seen}")
+
+
+class HeatmapUpdater:
+    """Фоновое обновление тепловой карты на работающем сервере: раз в interval секунд в карту
+    добавляется все, что записано после прошлого обновления (Database.update_heatmap), 
+    поэтому карта отстает от приема не больше чем на interval и не требует ручного запуска. 
+    db используется из потока обновления, поэтому должен быть открыт с пулом (pool_size > 0)"""
+
+    def __init__(self, db, interval=HEATMAP_INTERVAL):
+        self.db = db
+        self.interval = interval
+        self.sessions = 0           # обработано сессий (новых и продолжившихся) за все время
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def update(self):
+        try:
+            self.sessions += self.db.update_heatmap()
+        except sqlite3.Error:       # БД занята или недоступна: данные добавятся при следующем обновлении
+            logging.exception("Heatmap update failed")
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.update()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name="HeatmapUpdater", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Останавливает обновления, идущее обновление дописывается до конца (до закрытия БД)"""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description='Telemetry DB helper.')
     parser.add_argument('-d', "--db", type=str, default=DB_PATH, help=f"Use/create database by path")
-    parser.add_argument('-u', "--userpass", type=str, help=f"Add user ('user:password' template)")
+    parser.add_argument('-u', "--userpass", type=str, help=f"Add user or change password ('user:password' template)")
     parser.add_argument('-s', "--session", type=int, help=f"Save session blob by ID")
     parser.add_argument('-l', "--list", type=str, help=f"Get list of sessions of 'username'")
     parser.add_argument('-r', "--report", action='store_true', help=f"Get list of users'")
+    parser.add_argument('-i', "--index-events", action='store_true', help=f"Fill typed events table for not yet indexed sessions")
+    parser.add_argument('-e', "--events", type=str, help=f"Print events of 'username' from events table")
+    parser.add_argument("--code", type=int, help=f"Filter --events by event code")
+    parser.add_argument("--from", dest="t_from", type=int, help=f"Filter --events/--range by timestamp >= T (ms)")
+    parser.add_argument("--to", dest="t_to", type=int, help=f"Filter --events/--range by timestamp <= T (ms)")
+    parser.add_argument("--range", type=str, help=f"Print raw events of 'username' with timestamps --from/--to using chunk time index")
+    parser.add_argument("--export", action='store_true', help=f"Export sessions to --out")
+    parser.add_argument("--user", type=str, help=f"Filter --export by username")
+    parser.add_argument("--since", type=str, help=f"Filter --export by session start >= ISO date/time")
+    parser.add_argument("--until", type=str, help=f"Filter --export by session start < ISO date/time")
+    parser.add_argument("--out", type=str, default=".", 
+                        help=f"Export to directory (session{{id}}.txt per session) or to one archive file, '-' - stdout (default: .)")
+    parser.add_argument('-j', "--jobs", type=int, default=1, help=f"Export files with N threads (default: 1)")
+    parser.add_argument("--update-heatmap", action='store_true', help=f"Add sessions stored since last update to position heatmap")
+    parser.add_argument("--rebuild-heatmap", type=float, metavar="CELL", help=f"Rebuild position heatmap with grid cell size CELL")
+    parser.add_argument("--position-codes", type=str, metavar="X,Y,Z", 
+                        help=f"Rebuild position heatmap from events with these codes of x, y, z (default: {','.join(map(str, POSITION_CODES))})")
+    parser.add_argument("--heatmap", type=str, choices=PLANES, help=f"Print heatmap projected to plane: cell_a;cell_b;visits;dwell_ms")
+    parser.add_argument("--box", type=str, metavar="X0,Y0,Z0,X1,Y1,Z1", 
+                        help=f"Limit --heatmap to box, empty coordinate - unbounded (e.g. '0,0,,100,100,')")
+    parser.add_argument("--partition", type=str, choices=PARTITION_FORMATS, 
+                        help=f"Create new database with sessions partitioned to per day/month files")
+    parser.add_argument("--partitions", action='store_true', help=f"Print partitions of database: name;first_id;path;bytes")
+    parser.add_argument("--drop-before", type=str, metavar="DATE", help=f"Delete partitions that ended before ISO date/time")
     args = parser.parse_args()
 
 
     DB_PATH = DB_PATH if args.db is None else args.db
 
 
-    db = Database(DB_PATH)
+    db = Database(DB_PATH, pool_size=args.jobs if args.jobs > 1 else 0, partition=args.partition)
 
 
     userpass = args.userpass
     session_id = args.session
     list_user = args.list
 
-    print(f"Using {DB_PATH} database")
+    print(f"Using {DB_PATH} database", file=sys.stderr if args.export and args.out == "-" else sys.stdout)
     if userpass is not None:
         if len(userpass.split(":")) != 2:
             print("Use 'user:password' template to add user")
             sys.exit(0)
+        elif db.get_user(userpass.split(":")[0]) is not None:
+            db.set_password(*userpass.split(":"))
+            print("Password changed")
         else:
             db.add_user(*userpass.split(":"))
             print("User added")
@@ -166,6 +1616,43 @@ if __name__ == "__main__":
     if args.report:
         db.report()
 
+    if args.drop_before is not None:
+        print("Dropped partitions:", *db.drop_partitions(args.drop_before))
+
+    if args.partitions:
+        for row in db.partitions():
+            print(";".join(map(str, row)))
+
+    if args.index_events:
+        print(f"Indexed {db.index_sessions()} sessions")
+
+    if args.rebuild_heatmap is not None or args.position_codes is not None:
+        codes = args.position_codes.split(",") if args.position_codes is not None else None
+        print(f"Heatmap rebuilt from {db.rebuild_heatmap(args.rebuild_heatmap, codes)} sessions")
+    elif args.update_heatmap:
+        print(f"Heatmap updated with {db.update_heatmap()} sessions")
+
+    if args.heatmap is not None:
+        box = [float(v) if v.strip() else None for v in args.box.split(",")] if args.box else [None] * 6
+        if len(box) != 6:
+            print("Use 'X0,Y0,Z0,X1,Y1,Z1' template for --box")
+            sys.exit(0)
+        for row in db.heatmap(args.heatmap, box[:3], box[3:]):
+            print(f"{row.a};{row.b};{row.visits};{row.dwell}")
+        stats = db.region_stats(box[:3], box[3:])
+        print(f"{stats.cells} cells, {stats.visits} visits, {stats.dwell / 1000:.1f} sec, cell size {db.heatmap_cell()}", 
+              file=sys.stderr)
+
+    if args.events is not None:
+        for event in db.events(args.events, args.code, args.t_from, args.t_to):
+            print(f"{event.ts};{event.code};{event.value}")
 
+    if args.range is not None:
+        for session, data in db.read_range(args.range, args.t_from, args.t_to):
+            sys.stdout.buffer.write(data)
 
-    
\ No newline at end of file
+    if args.export:
+        start = time.time()
+        sessions, size = db.export(args.out, args.user, args.since, args.until, args.jobs)
+        print(f"Exported {sessions} sessions, {size / 2**20:.02f} MiB to '{args.out}' in {time.time() - start:.02f} sec", 
+              file=sys.stderr if args.out == "-" else sys.stdout)
@@ -0,0 +1,173 @@
+"""Трансляция телеметрии подписчикам в реальном времени.
+
+Пока сессию кто-то смотрит, обработчик кладет принятые события в кольцевой буфер
+сессии фиксированного размера (RingBuffer): запись - O(1) под короткой блокировкой
+и не зависит от числа и скорости подписчиков. Подписчик читает кольца сам, со своей
+скоростью, помня позицию в каждом. Если он отстал больше чем на размер кольца, старые
+записи уже перезаписаны, и вместо них подписчик получает сообщение о пропуске, так что
+медленный подписчик никогда не задерживает прием данных, а только теряет часть трансляции.
+
+Подписка - приветствие `user:password:subscribe=USER` (`subscribe=*` - все сессии),
+после ACCEPTED сервер шлет подписчику строки:
+    USER;timestamp;code;value   - событие сессии USER
+    410 USER N                  - N событий USER пропущено, подписчик не успевал их читать
+    500 USER                    - сессия USER закончилась (или оборвалась)
+    100                         - KEEP_ALIVE, если новых данных не было KEEP_ALIVE_INTERVAL
+Трансляция начинается с текущего момента, сессии, начатые позже, - с начала.
+
+Подписаться может любой авторизованный пользователь и на сессии любого пользователя:
+это намеренно, трансляция - инструмент наблюдения для всех учетных записей сервера
+(пароль проверяется, права на чужие сессии - нет). Если учетные записи выдаются игрокам,
+подписку нужно ограничивать отдельно."""
+
+import threading
+
+
+LIVE_RING   = 256       # записей (строка или пачка строк событий) в кольцевом буфере сессии
+ALL         = "*"       # подписка на все сессии
+
+SKIPPED     = 410
+FINISHED    = 500
+
+
+class RingBuffer:
+    """Кольцевой буфер последних capacity записей сессии. Запись - (номер первого события,
+    данные, событий), позиция читателя - (номер следующей записи, номер следующего события)"""
+
+    def __init__(self, username, capacity=LIVE_RING):
+        self.username = username
+        self.prefix = username.encode("ascii", "replace") + b";"
+        self.slots = [None] * capacity
+        self.written = 0            # записей за все время
+        self.events = 0             # событий за все время
+        self.watchers = 0           # подписок на сессию: пока их нет, данные в кольцо не пишутся
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def push(self, data, events=1):
+        with self.lock:
+            self.slots[self.written % len(self.slots)] = (self.events, data, events)
+            self.written += 1
+            self.events += events
+
+    def position(self):
+        with self.lock:
+            return self.written, self.events
+
+    def read(self, position):
+        """Записи, появившиеся после position: (новая позиция, пропущено событий, список данных)"""
+        written, events = position
+        with self.lock:
+            first = max(written, self.written - len(self.slots))
+            records = [self.slots[i % len(self.slots)] for i in range(first, self.written)]
+            written = self.written
+        if not records:
+            return (written, events), 0, []
+        skipped = records[0][0] - events
+        start, _, count = records[-1]
+        return (written, start + count), skipped, [data for _, data, _ in records]
+
+
+class Subscription:
+    """Подписка на сессии пользователя target (ALL - всех). wake вызывается публикующим
+    обработчиком при появлении новых данных и не должен блокировать (Event.set)"""
+
+    def __init__(self, hub, target, wake):
+        self.hub = hub
+        self.target = target
+        self.wake = wake
+        self.cursors = {}           # кольцо -> позиция чтения, меняется только под hub.lock
+
+    def wants(self, username):
+        return self.target == ALL or self.target == username
+
+    def poll(self):
+        """Забирает новые данные всех отслеживаемых сессий, возвращает
+        (строки для подписчика, пропущено событий)"""
+        with self.hub.lock:
+            for ring in self.hub.rings:
+                if ring not in self.cursors and self.wants(ring.username):
+                    self.cursors[ring] = (0, 0)     # сессия началась после подписки
+            cursors = list(self.cursors.items())
+
+        out, skipped_total, positions = [], 0, {}
+        for ring, position in cursors:              # кольца читаются вне блокировки хаба
+            closed = ring.closed                    # до чтения: данные закрытой сессии уже все в кольце
+            positions[ring], skipped, records = ring.read(position)
+            if skipped:
+                out.append(f"{SKIPPED} {ring.username} {skipped}\n".encode("ascii"))
+                skipped_total += skipped
+            for data in records:
+                out.append(ring.prefix + data.rstrip(b"\n").replace(b"\n", b"\n" + ring.prefix) + b"\n")
+            if closed:
+                out.append(f"{FINISHED} {ring.username}\n".encode("ascii"))
+                positions[ring] = None
+
+        with self.hub.lock:
+            for ring, position in positions.items():
+                if position is None:
+                    del self.cursors[ring]
+                else:
+                    self.cursors[ring] = position
+        return b"".join(out), skipped_total
+
+
+class LiveHub:
+    """Кольца активных сессий и подписки сервера"""
+
+    def __init__(self, capacity=LIVE_RING):
+        self.capacity = capacity
+        self.rings = set()
+        self.subscriptions = ()     # кортеж заменяется целиком: публикующие обходят его без блокировки
+        self.stopped = False
+        self.lock = threading.Lock()
+
+    def open(self, username):
+        """Кольцо новой (или возобновленной) сессии"""
+        ring = RingBuffer(username, self.capacity)
+        with self.lock:
+            ring.watchers = sum(1 for s in self.subscriptions if s.wants(username))
+            self.rings.add(ring)
+        return ring
+
+    def publish(self, ring, data, events=1):
+        """Данные сессии для трансляции, вызывается обработчиком на каждую пачку событий"""
+        if not ring.watchers:
+            return
+        ring.push(data, events)
+        for subscription in self.subscriptions:
+            if subscription.wants(ring.username):
+                subscription.wake()
+
+    def close(self, ring):
+        with self.lock:
+            self.rings.discard(ring)
+            ring.closed = True
+            watching = [s for s in self.subscriptions if s.wants(ring.username)]
+            for subscription in watching:   # сессия могла закончиться раньше, чем ее увидел подписчик
+                subscription.cursors.setdefault(ring, (0, 0))
+        for subscription in watching:
+            subscription.wake()
+
+    def subscribe(self, target, wake):
+        subscription = Subscription(self, target, wake)
+        with self.lock:
+            for ring in self.rings:
+                if subscription.wants(ring.username):
+                    ring.watchers += 1
+                    subscription.cursors[ring] = ring.position()    # с текущего момента
+            self.subscriptions += (subscription, )
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            for ring in self.rings:
+                if subscription.wants(ring.username):
+                    ring.watchers -= 1
+            self.subscriptions = tuple(s for s in self.subscriptions if s is not subscription)
+
+    def stop(self):
+        """Остановка сервера: подписчики заканчивают трансляцию"""
+        self.stopped = True
+        for subscription in self.subscriptions:
+            subscription.wake()
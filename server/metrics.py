@@ -0,0 +1,201 @@
+"""Счетчики и гистограммы сервера телеметрии и их отдача в текстовом формате Prometheus
+по HTTP на служебном порту (GET /metrics)"""
+
+import time
+import bisect
+import threading
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+SIZE_BUCKETS    = tuple(2 ** i for i in range(10, 27, 2))      # 1 КиБ ... 64 МиБ
+COUNT_BUCKETS   = tuple(10 ** i for i in range(0, 7))           # 1 ... 1e6 событий
+
+
+class Counter:
+    """Монотонно растущий счетчик"""
+
+    kind = "counter"
+
+    def __init__(self, name, help, func=None):
+        self.name = name
+        self.help = help
+        self.func = func            # если задана, значение читается ей при каждом запросе
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, "", self.func() if self.func else self.value)]
+
+
+class Gauge(Counter):
+    """Текущее значение: выставляется явно или читается функцией func при каждом запросе"""
+
+    kind = "gauge"
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        with self.lock:
+            self.value = value
+
+
+class LabeledCounter:
+    """Набор счетчиков с метками labels: отдельное значение на каждое сочетание значений меток"""
+
+    kind = "counter"
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}            # кортеж значений меток -> значение
+        self.lock = threading.Lock()
+
+    def inc(self, values, amount=1):
+        with self.lock:
+            self.values[values] = self.values.get(values, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        return [(self.name, "{" + ",".join(f'{k}="{v}"' for k, v in zip(self.labels, values)) + "}", n)
+                for values, n in items]
+
+
+class Histogram:
+    """Распределение наблюдений по корзинам (le - верхняя граница корзины)"""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self):
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        samples = []
+        cumulative = 0
+        for bound, n in zip(self.buckets + (float("inf"), ), counts):
+            cumulative += n
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            samples.append((f"{self.name}_bucket", f'{{le="{le}"}}', cumulative))
+        samples.append((f"{self.name}_sum", "", total))
+        samples.append((f"{self.name}_count", "", count))
+        return samples
+
+
+class Registry:
+    """Набор метрик одного сервера"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, func=None):
+        return self.add(Counter(name, help, func))
+
+    def gauge(self, name, help, func=None):
+        return self.add(Gauge(name, help, func))
+
+    def labeled_counter(self, name, help, labels):
+        return self.add(LabeledCounter(name, help, labels))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, help, buckets))
+
+    def render(self):
+        """Текстовый формат Prometheus (exposition format 0.0.4)"""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class ServerMetrics(Registry):
+    """Метрики сервера телеметрии, общие для всех реализаций сервера. Скорости (событий/с,
+    байт/с) считаются на стороне Prometheus функцией rate() от счетчиков *_total"""
+
+    def __init__(self):
+        super().__init__()
+        self.connections = self.counter("telemetry_connections_total", "Accepted TCP connections")
+        self.connections_active = self.gauge("telemetry_connections_active", "Currently open connections")
+        self.auth_seconds = self.histogram("telemetry_auth_seconds", "Greeting and authorization latency")
+        self.auth_failures = self.counter("telemetry_auth_failures_total", "Rejected greetings")
+        self.events = self.counter("telemetry_events_total", "Accepted telemetry events")
+        self.bytes = self.counter("telemetry_received_bytes_total", "Received telemetry bytes")
+        self.malformed = self.counter("telemetry_malformed_total", "Dropped malformed lines and frames")
+        self.keep_alives = self.counter("telemetry_keep_alives_total", "Answered KEEP_ALIVE messages")
+        self.idle_closed = self.counter("telemetry_idle_closed_total", "Connections closed by idle timeout")
+        self.resumed = self.counter("telemetry_sessions_resumed_total", "Sessions resumed after reconnect")
+        self.policy_events = self.labeled_counter("telemetry_policy_events_total", 
+                                                  "Events kept or dropped by the ingest policy", ("code", "action"))
+        self.live_skipped = self.counter("telemetry_live_skipped_total", "Events skipped for slow live subscribers")
+        self.session_bytes = self.histogram("telemetry_session_bytes", "Stored session size, bytes", SIZE_BUCKETS)
+        self.session_events = self.histogram("telemetry_session_events", "Stored session length, events", COUNT_BUCKETS)
+        self.db_write_seconds = self.histogram("telemetry_db_write_seconds", "Latency of one DB write")
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """HTTP сервер метрик на служебном порту, работает в фоновом потоке"""
+
+    daemon_threads = True
+
+    def __init__(self, address, registry):
+        self.registry = registry
+        super().__init__(address, MetricsHandler)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="Metrics", daemon=True).start()
+        return self
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):      # не засоряем stderr запросами Prometheus
+        pass
@@ -0,0 +1,195 @@
+"""Прореживание событий при приеме: политика по кодам событий из файла конфигурации.
+
+Частые события (движение мыши, положение и направление камеры) приходят с частотой кадров
+и занимают большую часть сессии при малой ценности для анализа. Политика задается JSON файлом
+`{"код": правило, ...}`, правило - словарь из условий:
+    every           - сохранять каждое N-е событие кода (первое, N+1-е, ...)
+    min_interval    - сохранять, если с последнего сохраненного прошло не меньше N мс
+    min_change      - сохранять, если значение изменилось не меньше чем на N
+                      от последнего сохраненного
+    window          - окна по N мс от первого события окна: из каждого окна сохраняются
+                      события с минимальным и максимальным значением и последнее
+                      (до трех событий, в порядке времени, в исходном виде)
+every, min_interval и min_change можно сочетать (сохраняется событие, прошедшее все условия),
+window - только отдельно. Первое событие кода в сессии сохраняется всегда. Коды без правила
+не трогаются.
+
+Фильтр работает в обработчике до буфера сессии, поэтому на запись в БД и трансляцию
+попадают только сохраненные события. События окна выдаются, когда окно закрывается
+(пришло событие кода за его пределами, или сессия закончилась/оборвалась), и поэтому
+записываются позже событий других кодов, пришедших в это время.
+
+Пример (server.py --policy policy.json):
+    {"1": {"window": 100}, "2": {"min_interval": 50}, "3": {"every": 5, "min_change": 0.5}}
+"""
+
+import re
+import json
+
+from collections import Counter
+
+
+CONDITIONS  = ("every", "min_interval", "min_change", "window")
+
+
+class IngestPolicy:
+    """Правила прореживания по кодам, общие для всех сессий сервера. counter - счетчик
+    метрик с метками (code, action), куда сессии сообщают число сохраненных и отброшенных событий"""
+
+    def __init__(self, rules, counter=None):
+        self.rules = {}
+        for code, rule in rules.items():
+            code = int(code)
+            unknown = set(rule) - set(CONDITIONS)
+            if unknown:
+                raise ValueError(f"Code {code}: unknown conditions {sorted(unknown)}")
+            if "window" in rule and len(rule) > 1:
+                raise ValueError(f"Code {code}: window can not be combined with other conditions")
+            if any(not isinstance(v, (int, float)) or v <= 0 for v in rule.values()):
+                raise ValueError(f"Code {code}: conditions must be positive numbers")
+            if not isinstance(rule.get("every", 1), int):
+                raise ValueError(f"Code {code}: every must be an integer")
+            if not 0 <= code <= 255:
+                raise ValueError(f"Code {code}: out of range 0..255")
+            self.rules[code] = rule
+        self.counter = counter
+
+        codes = "|".join(str(code) for code in sorted(self.rules))
+        # строки событий с кодами из правил: (timestamp, code, value)
+        self.lines = re.compile(rb"^([^;\n]*);(" + codes.encode() + rb");([^;\n]*)\n", re.MULTILINE)
+
+    @classmethod
+    def load(cls, path, counter=None):
+        with open(path) as f:
+            return cls(json.load(f), counter)
+
+    def session(self):
+        return SessionFilter(self)
+
+    def __bool__(self):
+        return bool(self.rules)
+
+
+class CodeState:
+    """Состояние правила одного кода в сессии"""
+
+    __slots__ = ("seen", "last_ts", "last_value", "window_end", "count", "low", "high", "last")
+
+    def __init__(self):
+        self.seen = 0
+        self.last_ts = None
+        self.last_value = None
+        self.window_end = None          # конец текущего окна, None - окна нет
+        self.count = 0                  # событий в окне
+        self.low = self.high = self.last = None        # (ts, value, строка) событий окна
+
+    def close_window(self):
+        """Закрывает окно, возвращает его сохраняемые строки в порядке времени"""
+        events = {id(e): e for e in (self.low, self.high, self.last)}.values()
+        self.window_end = None
+        return [line for _, _, line in sorted(events, key=lambda e: e[0])]
+
+
+class SessionFilter:
+    """Фильтр одной сессии: хранит состояние правил по кодам, считает сохраненные
+    и отброшенные события (за сессию - kept и dropped, общие - в метриках политики)"""
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.states = {code: CodeState() for code in policy.rules}
+        self.kept = Counter()
+        self.dropped = Counter()
+
+    def _keep(self, rule, state, ts, value):
+        """Решение для события кода с правилом без окна"""
+        state.seen += 1
+        if state.last_ts is not None:
+            if "every" in rule and (state.seen - 1) % rule["every"]:
+                return False
+            if "min_interval" in rule and ts - state.last_ts < rule["min_interval"]:
+                return False
+            if "min_change" in rule and abs(value - state.last_value) < rule["min_change"]:
+                return False
+        state.last_ts, state.last_value = ts, value
+        return True
+
+    def _close_window(self, code, state, out, kept, dropped):
+        lines = state.close_window()
+        out.extend(lines)
+        kept[code] += len(lines)
+        dropped[code] += state.count - len(lines)
+
+    def _window(self, code, rule, state, ts, value, line, out, kept, dropped):
+        """Добавляет событие в окно кода, закрытое окно выдает в out"""
+        if state.window_end is not None and ts >= state.window_end:
+            self._close_window(code, state, out, kept, dropped)
+        event = (ts, value, line)
+        if state.window_end is None:
+            state.window_end = ts + rule["window"]
+            state.count = 1
+            state.low = state.high = state.last = event
+            return
+        state.count += 1
+        if value < state.low[1]:
+            state.low = event
+        if value >= state.high[1]:
+            state.high = event
+        state.last = event
+
+    def _count(self, kept, dropped):
+        self.kept.update(kept)
+        self.dropped.update(dropped)
+        if self.policy.counter is not None:
+            for action, counts in (("kept", kept), ("dropped", dropped)):
+                for code, count in counts.items():
+                    if count:
+                        self.policy.counter.inc((str(code), action), count)
+
+    def apply(self, data, events=1):
+        """Прореживает пачку из events строк `timestamp;code;value\\n`, возвращает
+        (оставшиеся строки, количество событий в них)"""
+        rules, states = self.policy.rules, self.states
+        out = []
+        kept, dropped = Counter(), Counter()
+        taken = 0                   # строк, прошедших через правила
+        pos = 0
+        for match in self.policy.lines.finditer(data):
+            if match.start() > pos:
+                out.append(data[pos:match.start()])     # события без правил - целыми участками
+            pos = match.end()
+            code = int(match[2])
+            try:
+                ts, value = int(match[1]), float(match[3])
+            except ValueError:                          # не число: такие строки не прореживаем
+                out.append(match[0])
+                continue
+            taken += 1
+            rule, state = rules[code], states[code]
+            if "window" in rule:
+                self._window(code, rule, state, ts, value, match[0], out, kept, dropped)
+            elif self._keep(rule, state, ts, value):
+                out.append(match[0])
+                kept[code] += 1
+            else:
+                dropped[code] += 1
+        if pos == 0:
+            return data, events
+        out.append(data[pos:])
+
+        self._count(kept, dropped)
+        return b"".join(out), events - taken + sum(kept.values())     # kept включает закрытые окна
+
+    def flush(self):
+        """Закрывает незаконченные окна (конец или обрыв сессии), возвращает (строки, событий)"""
+        out = []
+        kept, dropped = Counter(), Counter()
+        for code, state in self.states.items():
+            if state.window_end is not None:
+                self._close_window(code, state, out, kept, dropped)
+        self._count(kept, dropped)
+        return b"".join(out), sum(kept.values())
+
+    def summary(self):
+        """Строка для журнала: `код: сохранено/отброшено` по кодам с правилами"""
+        codes = sorted(set(self.kept) | set(self.dropped))
+        return ", ".join(f"{code}: {self.kept[code]}/{self.dropped[code]}" for code in codes)
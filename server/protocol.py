@@ -0,0 +1,197 @@
+"""Двоичный протокол телеметрии (версия 2).
+
+Версия протокола запрашивается клиентом в приветствии: `user:password:proto=2`.
+Приветствие без третьего поля (`user:password`) означает текстовый протокол версии 1,
+ответ сервера на приветствие (ACCEPTED) в обеих версиях текстовый.
+
+После авторизации в версии 2 обе стороны обмениваются кадрами: заголовок `<IB`
+(длина полезной нагрузки, тип кадра) и полезная нагрузка. Кадры данных содержат пачку
+упакованных событий (int64 timestamp, uint8 code, int32 или float64 value),
+кадры KEEP_ALIVE и FINISHED - пустые. На сервере события превращаются в те же строки
+`timestamp;code;value\\n`, что и в текстовом протоколе, поэтому формат хранения не меняется.
+
+Возобновляемые сессии (в обеих версиях): клиент добавляет в приветствие опцию `resume`
+(`user:password:resume` или `user:password:proto=2,resume`), сервер отвечает
+`200 token=T offset=0` и в ответ на каждый KEEP_ALIVE сообщает, сколько событий сессии
+он принял (строка `300 N` или кадр ACK с uint64 N), клиент хранит только неподтвержденный
+хвост. После обрыва клиент переподключается с `token=T,offset=N` (N - последнее
+подтверждение), сервер отвечает `200 token=T offset=M` (M - сколько событий он принял)
+и клиент продолжает отправку с события M"""
+
+import struct
+
+
+PROTO_TEXT      = 1
+PROTO_BINARY    = 2
+
+FRAME_HEADER    = struct.Struct("<IB")      # длина полезной нагрузки, тип кадра
+RECORD_INT      = struct.Struct("<qBi")     # timestamp, code, int32 value
+RECORD_FLOAT    = struct.Struct("<qBd")     # timestamp, code, float64 value
+ACK_RECORD      = struct.Struct("<Q")       # количество принятых сервером событий сессии
+
+FRAME_DATA_INT      = 1
+FRAME_DATA_FLOAT    = 2
+FRAME_KEEP_ALIVE    = 3
+FRAME_FINISHED      = 4
+FRAME_ACK           = 5
+
+CLIENT_FRAMES   = (FRAME_DATA_INT, FRAME_DATA_FLOAT, FRAME_KEEP_ALIVE, FRAME_FINISHED)    # кадры клиента серверу
+SERVER_FRAMES   = (FRAME_KEEP_ALIVE, FRAME_ACK)                                         # ответы сервера клиенту
+
+RECORDS = {
+    FRAME_DATA_INT:     (RECORD_INT, b"%d;%d;%d\n"),
+    FRAME_DATA_FLOAT:   (RECORD_FLOAT, b"%d;%d;%r\n"),
+}
+
+MAX_FRAME   = 1 << 20       # максимальная длина полезной нагрузки кадра, байт
+BATCH       = 256           # событий в одном кадре данных при отправке клиентом
+
+INT32_MIN, INT32_MAX = -2**31, 2**31 - 1
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def parse_greeting(greeting):
+    """Разбирает приветствие `user:password[:key=value,...]`,
+    возвращает (username, password, options) или None при неверном формате"""
+    parts = greeting.split(":")
+    if len(parts) not in (2, 3):
+        return None
+
+    options = {}
+    if len(parts) == 3:
+        for option in parts[2].split(","):
+            key, _, value = option.partition("=")
+            options[key] = value
+    return parts[0], parts[1], options
+
+def greeting_version(options):
+    """Версия протокола, запрошенная в приветствии"""
+    try:
+        version = int(options.get("proto", PROTO_TEXT))
+    except ValueError:
+        return None
+    return version if version in (PROTO_TEXT, PROTO_BINARY) else None
+
+def make_greeting(user, password, version=PROTO_TEXT, **options):
+    if version != PROTO_TEXT:
+        options = {"proto": version, **options}
+    if not options:
+        return f"{user}:{password}\n"
+    extra = ",".join(f"{k}={v}" if v is not None else k for k, v in options.items())
+    return f"{user}:{password}:{extra}\n"
+
+
+def make_accepted(code, token=None, offset=0):
+    """Ответ на приветствие, для возобновляемой сессии - с токеном и числом принятых событий"""
+    if token is None:
+        return f"{code}\n"
+    return f"{code} token={token} offset={offset}\n"
+
+def parse_accepted(line):
+    """Разбирает ответ на приветствие `code[ key=value ...]`, возвращает (code, options)"""
+    code, *fields = line.split()
+    return code, dict(field.partition("=")[::2] for field in fields)
+
+
+def frame(frame_type, payload=b""):
+    return FRAME_HEADER.pack(len(payload), frame_type) + payload
+
+KEEP_ALIVE_FRAME    = frame(FRAME_KEEP_ALIVE)
+FINISHED_FRAME      = frame(FRAME_FINISHED)
+
+def ack_frame(events):
+    return frame(FRAME_ACK, ACK_RECORD.pack(events))
+
+
+def parse_event(line):
+    """Разбирает строку события `timestamp;code;value` в (timestamp, code, value),
+    value остается int, если записано как целое, иначе float"""
+    ts, code, value = line.strip().split(";")
+    try:
+        value = int(value)
+    except ValueError:
+        value = float(value)
+    return int(ts), int(code), value
+
+def encode_events(events):
+    """Упаковывает последовательность событий (timestamp, code, value) в кадры данных:
+    подряд идущие целые и дробные значения попадают в кадры соответствующего типа"""
+    frames = []
+    records = []
+    current = None
+    for ts, code, value in events:
+        if isinstance(value, int) and INT32_MIN <= value <= INT32_MAX:
+            frame_type = FRAME_DATA_INT
+        else:
+            frame_type, value = FRAME_DATA_FLOAT, float(value)
+
+        if frame_type != current or len(records) >= BATCH:
+            if records:
+                frames.append(frame(current, b"".join(records)))
+            records = []
+            current = frame_type
+        records.append(RECORDS[frame_type][0].pack(ts, code, value))
+
+    if records:
+        frames.append(frame(current, b"".join(records)))
+    return b"".join(frames)
+
+def decode_records(frame_type, payload):
+    """Превращает полезную нагрузку кадра данных в строки `timestamp;code;value\\n`,
+    возвращает (данные, количество событий)"""
+    if frame_type not in RECORDS:
+        raise ProtocolError(f"Frame type {frame_type} carries no events")
+    record, line = RECORDS[frame_type]
+    if len(payload) % record.size:
+        raise ProtocolError(f"Payload of {len(payload)} bytes is not a whole number of records")
+    lines = [line % r for r in record.iter_unpack(payload)]
+    return b"".join(lines), len(lines)
+
+
+def check_header(header, allowed=CLIENT_FRAMES):
+    """Проверяет заголовок кадра, allowed - типы кадров, которые может прислать другая сторона 
+    (по умолчанию - принимаемые сервером от клиента)"""
+    length, frame_type = FRAME_HEADER.unpack(header)
+    if length > MAX_FRAME:
+        raise ProtocolError(f"Frame too long: {length} bytes")
+    if frame_type not in allowed:
+        raise ProtocolError(f"Unexpected frame type: {frame_type}")
+    return length, frame_type
+
+def read_frame(rfile, allowed=CLIENT_FRAMES):
+    """Читает кадр из файлового объекта сокета, возвращает (тип, нагрузка) или None,
+    если соединение закрыто"""
+    header = rfile.read(FRAME_HEADER.size)
+    if len(header) < FRAME_HEADER.size:
+        return None
+    length, frame_type = check_header(header, allowed)
+    payload = rfile.read(length) if length else b""
+    if len(payload) < length:
+        return None
+    return frame_type, payload
+
+async def read_frame_async(reader, allowed=CLIENT_FRAMES):
+    """То же, что read_frame, для asyncio.StreamReader"""
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+        length, frame_type = check_header(header, allowed)
+        payload = await reader.readexactly(length) if length else b""
+    except EOFError:        # asyncio.IncompleteReadError
+        return None
+    return frame_type, payload
+
+def split_frames(data, allowed=CLIENT_FRAMES):
+    """Выделяет целые кадры из накопленных байтов, возвращает (список кадров, остаток)"""
+    frames = []
+    pos = 0
+    while len(data) - pos >= FRAME_HEADER.size:
+        length, frame_type = check_header(data[pos:pos + FRAME_HEADER.size], allowed)
+        end = pos + FRAME_HEADER.size + length
+        if end > len(data):
+            break
+        frames.append((frame_type, bytes(data[pos + FRAME_HEADER.size:end])))
+        pos = end
+    return frames, data[pos:]
@@ -1,16 +1,36 @@
 import os, sys
+import re
+import time
 import uuid
+import queue
+import signal
+import socket
 import hashlib
 import argparse
+import itertools
 
 import socketserver
 
+import asyncio
+import threading
+import multiprocessing
+import multiprocessing.managers
+import multiprocessing.connection
+from concurrent.futures import ThreadPoolExecutor
+
 import logging
 
 logging.basicConfig(filename='./server.log', level=logging.DEBUG, 
                     format='%(threadName)s  %(asctime)s : %(levelname)s : %(message)s')
 
-from db import Database
+from db import Database, SessionBuffer, CredentialCache, HeatmapUpdater, POOL_SIZE, HEATMAP_INTERVAL
+from metrics import ServerMetrics, MetricsServer
+from timers import TimerWheel, WHEEL_TICK
+from live import LiveHub, ALL
+from policy import IngestPolicy
+from protocol import (PROTO_BINARY, FRAME_HEADER, FRAME_KEEP_ALIVE, FRAME_FINISHED, KEEP_ALIVE_FRAME, ProtocolError,
+                      parse_greeting, greeting_version, make_accepted, ack_frame, decode_records,
+                      split_frames, check_header, read_frame_async)
 
 DB_PATH = os.path.abspath("telemetry.db")
 
@@ -19,8 +39,25 @@ PORT        = 10227
 
 ACCEPTED    = 200
 KEEP_ALIVE  = 100
+ACK         = 300
 FINISHED    = 500
 
+ENGINES     = ("threads", "asyncio")
+BACKLOG     = 4096
+
+KEEP_ALIVE_INTERVAL = 1         # клиент шлет KEEP_ALIVE раз в секунду (clients.Client.timeout)
+IDLE_MISSED         = 5         # соединение без данных и KEEP_ALIVE дольше N интервалов закрывается
+RESUME_GRACE        = 30        # сколько секунд держать оборванную возобновляемую сессию, сек
+
+RECV_BUFFER         = 1 << 16   # буфер приема соединения (потоковый сервер), байт
+
+WRITER_BATCH        = 1024      # сообщений от приемников в одной транзакции процесса записи
+WRITER_QUEUE_SIZE   = 10000     # максимум сообщений в очереди к процессу записи
+
+
+# подряд идущие строки событий `timestamp;code;value\n` (ASCII, ровно два разделителя)
+EVENT_LINES = re.compile(rb"^(?:[^;\n\x80-\xff]*;[^;\n\x80-\xff]*;[^;\n\x80-\xff]*\n)+", re.MULTILINE)
+
 
 def salt_and_hash(password):
     salt = uuid.uuid4().hex
@@ -31,58 +68,323 @@ def check_password(hashed_password, user_password):
     return password == hashlib.sha256(salt.encode() + user_password.encode()).hexdigest()
 
 
+def server_metrics(server):
+    """Метрики сервера, включая счетчики кэша авторизации и число пользователей онлайн"""
+    metrics = ServerMetrics()
+    metrics.counter("telemetry_auth_cache_hits_total", "Credential cache hits", 
+                    lambda: server.credentials.hits)
+    metrics.counter("telemetry_auth_cache_misses_total", "Credential cache misses", 
+                    lambda: server.credentials.misses)
+    metrics.gauge("telemetry_users_online", "Authorized users online", 
+                  lambda: len(server.users_online))
+    metrics.gauge("telemetry_sessions_suspended", "Dropped resumable sessions waiting for reconnect", 
+                  lambda: len(server.suspended))
+    metrics.gauge("telemetry_subscribers", "Connected live subscribers", 
+                  lambda: len(server.live.subscriptions))
+    return metrics
+
+
+class ResumableSessions:
+    """Возобновляемые сессии, общая часть серверов: при обрыве соединения без FINISHED 
+    буфер сессии и число принятых событий держатся grace секунд под токеном, выданным 
+    клиенту с ACCEPTED. Переподключившийся с токеном клиент продолжает ту же сессию и 
+    досылает только то, что сервер не успел принять. Сроки отслеживает колесо таймеров, 
+    по истечении срока сессия сохраняется как обычная оборванная"""
+
+    def _init_resume(self, grace):
+        self.suspended = {}         # токен -> (username, буфер сессии, принято событий)
+        self.suspended_lock = threading.Lock()
+        self.grace = TimerWheel(grace, self.expire_session) if grace else None
+
+    def open_session(self, handler, options):
+        """Начинает новую сессию обработчика или продолжает приостановленную по токену 
+        из приветствия. False - токен неизвестен, истек или не подходит"""
+        if "token" not in options:
+            handler.buffer = SessionBuffer(handler.username)
+            handler.live = self.live.open(handler.username)
+            handler.filter = self.policy.session() if self.policy else None
+            if "resume" in options and self.grace:
+                handler.token = uuid.uuid4().hex
+            return True
+
+        with self.suspended_lock:
+            state = self.suspended.get(options["token"])
+            offset = options.get("offset", "0")
+            if (state is None or state[0] != handler.username 
+                    or not offset.isdigit() or int(offset) > state[2]):
+                logging.error(f"{handler.username}: unknown or expired session token")
+                return False
+            del self.suspended[options["token"]]
+        self.grace.remove(options["token"])
+        handler.token = options["token"]
+        _, handler.buffer, handler.counter = state
+        handler.live = self.live.open(handler.username)
+        handler.filter = self.policy.session() if self.policy else None
+        self.metrics.resumed.inc()
+        logging.info(f"{handler.username}: session resumed from event {handler.counter}")
+        return True
+
+    def suspend(self, handler):
+        with self.suspended_lock:
+            self.suspended[handler.token] = (handler.username, handler.buffer, handler.counter)
+        self.grace.add(handler.token)
+
+    def expire_session(self, token):
+        with self.suspended_lock:
+            state = self.suspended.pop(token, None)
+        if state is not None:
+            logging.info(f"{state[0]}: session not resumed in {self.grace.timeout} sec, saving")
+            self.save_suspended(*state)
+
+    def save_suspended(self, username, buffer, counter):
+        if counter:
+            buffer.close(self.store)
+
+    def close_suspended(self):
+        """Сохраняет все приостановленные сессии при остановке сервера"""
+        with self.suspended_lock:
+            states = list(self.suspended.values())
+            self.suspended.clear()
+        for username, buffer, counter in states:
+            if counter:
+                buffer.close(self.store)
+
+
 class ThreadedTCPRequestHandler(socketserver.StreamRequestHandler):
     """Класс обработчика запросов к серверу, работает в отдельном потоке"""
 
     def handle(self):
-        """Основной обработчик, принимает приветствие от клиента, если авторизация 
-        успешная, начинает прием данных"""
+        """Основной обработчик, принимает приветствие от клиента, если авторизация
+        успешная, начинает прием данных. Данные читаются из сокета порциями (recv_into)
+        в буфер соединения, разбор идет по целым строкам или кадрам в буфере"""
 
         self.username = None
         self.auth = False
         self.counter = 0
-        self.db = Database(self.server.db_path)
-        self.blob = bytes()
+        self.buffer = None
         self.finished = False
+        self.token = None           # токен возобновляемой сессии
+        self.suspended = False
+        self.subscription = None    # подписка на трансляцию: пользователь или live.ALL
+        self.live = None            # кольцо трансляции сессии
+        self.filter = None          # прореживание событий сессии по политике сервера
+        self.metrics = self.server.metrics
+        self.metrics.connections.inc()
+        self.metrics.connections_active.inc()
+        self.reading = True         # ждем данных от клиента, а не БД: только тогда простой закрывает соединение
+        if self.server.idle: self.server.idle.add(self)
 
-        greeting = self.rfile.readline().strip()
-        greeting = greeting.decode("ascii")
+        self.recv_buffer = bytearray(RECV_BUFFER)
+        self.recv_view = memoryview(self.recv_buffer)
+        self.filled = 0             # байт данных в начале буфера
+        self.skipping = False       # строка не поместилась в буфер, отбрасываем ее до конца
 
-        if self._auth(greeting):
-            self.wfile.write((str(ACCEPTED)+"\n").encode("ascii"))
-            while not self.finished:
+        greeting = self._read_greeting().strip()
+        greeting = greeting.decode("ascii", "replace")
 
-                try:
-                    data = self.rfile.readline()
-                except ConnectionResetError:
-                    print(f"[{self.username}] ConnectionResetError")
+        start = time.perf_counter()
+        if self._auth(greeting):
+            if self.subscription:
+                self.metrics.auth_seconds.observe(time.perf_counter() - start)
+                self.wfile.write(make_accepted(ACCEPTED, self.token, self.counter).encode("ascii"))
+                self._serve_subscription()
+                return
 
-                if data:
-                    self._process_data(data)
+            try:
+                self.metrics.auth_seconds.observe(time.perf_counter() - start)
+                self.wfile.write(make_accepted(ACCEPTED, self.token, self.counter).encode("ascii"))
+                self.metrics.bytes.inc(self.filled)     # данные, пришедшие вместе с приветствием
+                if self.version == PROTO_BINARY:
+                    self._handle_frames()
                 else:
+                    self._handle_lines()
+
+                self._flush_filter()
+                if self.token and not self.finished:    # обрыв без FINISHED: ждем переподключения
+                    self.suspended = True
+                    self.server.suspend(self)
+            finally:        # при любой ошибке после входа пользователь не должен остаться в сети, сессию сохранит finish
+                self.server.live.close(self.live)
+                self.server.users_online.remove(self.username)
+
+    def _serve_subscription(self):
+        """Трансляция подписчику: новые данные сессий забираются из их кольцевых буферов,
+        если данных нет - KEEP_ALIVE. Запись в сокет блокирует только этот поток, отставший
+        подписчик теряет данные, перезаписанные в кольцах (см. live.py)"""
+
+        if self.server.idle: self.server.idle.remove(self)     # подписчик только читает
+        wake = threading.Event()
+        subscription = self.server.live.subscribe(self.subscription, wake.set)
+        logging.info(f"{self.username} {self.client_address[0]}: subscribed to {self.subscription}")
+        try:
+            while not self.server.live.stopped:
+                wake.wait(KEEP_ALIVE_INTERVAL)
+                wake.clear()
+                data, skipped = subscription.poll()
+                self.metrics.live_skipped.inc(skipped)
+                self.wfile.write(data or f"{KEEP_ALIVE}\n".encode("ascii"))
+        except OSError:         # подписчик отключился
+            pass
+        finally:
+            self.server.live.unsubscribe(subscription)
+
+    def _recv(self):
+        """Дочитывает из сокета в свободную часть буфера, возвращает число байт (0 - соединение закрыто)"""
+        try:
+            self.reading = True
+            size = self.request.recv_into(self.recv_view[self.filled:])
+        except ConnectionResetError:
+            print(f"[{self.username}] ConnectionResetError")
+            size = 0
+        self.reading = False
+        if size and self.server.idle: self.server.idle.touch(self)
+        self.filled += size
+        return size
+
+    def _consume(self, size):
+        """Убирает из буфера обработанные size байт, необработанный хвост переносится в начало"""
+        rest = self.filled - size
+        if rest:
+            self.recv_buffer[:rest] = bytes(self.recv_view[size:self.filled])
+        self.filled = rest
+
+    def _reserve(self, size):
+        """Увеличивает буфер, если в него не помещается size байт (длинный кадр)"""
+        if size > len(self.recv_buffer):
+            buffer = bytearray(size)
+            buffer[:self.filled] = self.recv_view[:self.filled]
+            self.recv_buffer, self.recv_view = buffer, memoryview(buffer)
+
+    def _read_greeting(self):
+        """Строка приветствия, данные после нее остаются в буфере"""
+        while (end := self.recv_buffer.find(b"\n", 0, self.filled)) < 0:
+            if self.filled == len(self.recv_buffer) or not self._recv():
+                end = self.filled
+                break
+        greeting = bytes(self.recv_view[:end])
+        self._consume(min(end + 1, self.filled))
+        return greeting
+
+    def _handle_lines(self):
+        """Прием данных по текстовому протоколу: обрабатываются все целые строки, накопленные
+        в буфере, неполная последняя строка ждет продолжения (в том числе KEEP_ALIVE и FINISHED,
+        разрезанные между порциями). Выход по FINISHED или при закрытии соединения"""
+
+        while not self.finished:
+            end = self.recv_buffer.rfind(b"\n", 0, self.filled) + 1
+            if end:
+                self._process_lines(bytes(self.recv_view[:end]))
+                self._consume(end)
+                continue
+
+            if self.filled == len(self.recv_buffer):    # строка длиннее буфера - заведомо не событие
+                self.skipping = True
+                self.filled = 0
+            size = self._recv()
+            if not size:
+                break
+            self.metrics.bytes.inc(size)
+
+        # обрыв посреди строки с токеном не обрабатываем: клиент отправит строку заново
+        if not self.finished and self.filled and not self.token and not self.skipping:
+            self._process_data(bytes(self.recv_view[:self.filled]))
+
+    def _process_lines(self, data):
+        """Обрабатывает пачку целых строк: участки из подряд идущих строк событий находятся
+        одним регулярным выражением и добавляются в буфер сессии целиком, остальные строки
+        (KEEP_ALIVE, FINISHED, строки не по формату) разбираются по одной"""
+
+        pos = 0
+        if self.skipping:               # конец строки, не поместившейся в буфер
+            pos = data.index(b"\n") + 1
+            self.skipping = False
+            self.counter += 1
+            self.metrics.malformed.inc()
+
+        while pos < len(data) and not self.finished:
+            match = EVENT_LINES.search(data, pos)
+            start = match.start() if match else len(data)
+            for line in data[pos:start].splitlines(keepends=True):
+                self._process_data(line)
+                if self.finished:
+                    return
+            if match is None:
+                break
+
+            events = data.count(b"\n", start, match.end())
+            self.counter += events
+            self.metrics.events.inc(events)
+            self._store(data[start:match.end()], events)
+            pos = match.end()
+
+    def _handle_frames(self):
+        """Прием данных по двоичному протоколу: обрабатываются все целые кадры, накопленные
+        в буфере. Выход по FINISHED или при закрытии соединения"""
+
+        while not self.finished:
+            try:
+                frames, rest = split_frames(self.recv_view[:self.filled])
+            except ProtocolError as e:
+                logging.error(f"{self.username}: {e}")
+                break
+
+            pending = len(rest)
+            rest.release()
+            for frame in frames:
+                self._process_frame(*frame)
+                if self.finished:
+                    return
+            self._consume(self.filled - pending)
+            if self.filled >= FRAME_HEADER.size:   # заголовок неполного кадра - уже в начале буфера
+                try:
+                    length, _ = check_header(self.recv_view[:FRAME_HEADER.size])
+                except ProtocolError as e:
+                    logging.error(f"{self.username}: {e}")
                     break
+                self._reserve(FRAME_HEADER.size + length)
 
-            self.server.users_online.remove(self.username)
+            size = self._recv()
+            if not size:
+                break
+            self.metrics.bytes.inc(size)
 
     def _auth(self, data):
         """Процедура авторизации"""
 
-        if len(data.split(":")) != 2:
+        greeting = parse_greeting(data)
+        if greeting is None or greeting_version(greeting[2]) is None:
             logging.error(f"Invalid auth data format from {self.client_address[0]}")
             return False
 
-        self.username, user_password = data.split(":")
-        if self.username in self.server.users_online:
+        self.username, user_password, options = greeting
+        self.version = greeting_version(options)
+        if "subscribe" in options:
+            self.subscription = options["subscribe"] or ALL
+        elif self.username in self.server.users_online:
             logging.error(f"{self.username}: allready logged in")
             self.wfile.write(f"Such user allready logged in\n".encode("ascii"))
             return False
 
-        user_row = self.db.get_user(self.username)
+        user_row = self.server.credentials.get_user(self.username)
         if user_row:
             if check_password(user_row.hash, user_password) :
+                if self.subscription:
+                    self.auth = True
+                    return True
+                if not self.server.users_online.add(self.username):     # вошел в другом соединении после проверки выше
+                    logging.error(f"{self.username}: allready logged in")
+                    self.wfile.write(f"Such user allready logged in\n".encode("ascii"))
+                    return False
+                opened = False
+                try:
+                    opened = self.server.open_session(self, options)
+                finally:        # при отказе или ошибке пользователь не должен остаться в сети
+                    if not opened:
+                        self.server.users_online.remove(self.username)
+                if not opened:
+                    return False
                 if not self.server.quiet: print(f"Login: {self.username}")
                 self.auth = True
-                self.server.users_online.add(self.username)
                 logging.info(f"{self.username} {self.client_address[0]}: authorized")
                 return True
             else:
@@ -96,48 +398,736 @@ class ThreadedTCPRequestHandler(socketserver.StreamRequestHandler):
         """Обрабатывает входящие данные и сообщение FINISHED, отвечает на KEEP_ALIVE,
         отбрасывает данные, несоответсвующе формату телеметрии (timestamp;code;value)"""
 
-        if data.decode("ascii").strip() == str(KEEP_ALIVE):
-            
+        text = data.decode("ascii", "replace")
+        if text.strip() == str(KEEP_ALIVE):
+
+            self.metrics.keep_alives.inc()
             try:
                 self.wfile.write((str(KEEP_ALIVE)+"\n").encode("ascii"))
+                if self.token: self.wfile.write(f"{ACK} {self.counter}\n".encode("ascii"))
             except BrokenPipeError:        # SIGPIPE, клиент уже закрыл сокет
                 print(f"[{self.username}] BrokenPipeError")
 
-        elif data.decode("ascii").strip() == str(FINISHED):
+        elif text.strip() == str(FINISHED):
             self.finished = True
         else:
             self.counter += 1
-            if len(data.decode("ascii").split(";")) == 3:
-                self.blob += data
+            if len(text.split(";")) == 3 and data.isascii():
+                self.metrics.events.inc()
+                self._store(data)
+            else:
+                self.metrics.malformed.inc()
+
+    def _process_frame(self, frame_type, payload):
+        """Двоичный аналог _process_data: отвечает на KEEP_ALIVE, обрабатывает FINISHED,
+        события из кадров данных добавляет в буфер сессии, кадр с неполной записью отбрасывается"""
+
+        if frame_type == FRAME_KEEP_ALIVE:
+            self.metrics.keep_alives.inc()
+            try:
+                self.wfile.write(KEEP_ALIVE_FRAME + (ack_frame(self.counter) if self.token else b""))
+            except BrokenPipeError:        # SIGPIPE, клиент уже закрыл сокет
+                print(f"[{self.username}] BrokenPipeError")
+
+        elif frame_type == FRAME_FINISHED:
+            self.finished = True
+        else:
+            try:
+                data, events = decode_records(frame_type, payload)
+            except ProtocolError as e:
+                logging.error(f"{self.username}: {e}")
+                self.metrics.malformed.inc()
+                self.counter += 1
+                return
+
+            self.counter += events
+            self.metrics.events.inc(events)
+            self._store(data, events)
+
+    def _store(self, data, events=1):
+        """Прореживает события по политике сервера, оставшиеся передает подписчикам
+        и добавляет в буфер сессии, сбрасывая его в БД, когда он наполнится"""
+        if self.filter:
+            data, events = self.filter.apply(data, events)
+            if not events:
+                return
+        self.server.live.publish(self.live, data, events)
+        if self.buffer.append(data, events):
+            with self.metrics.db_write_seconds.time():
+                self.buffer.flush(self.server.store)
+
+    def _flush_filter(self):
+        """Конец или обрыв сессии: события незакрытых окон прореживания - в буфер сессии"""
+        if self.filter:
+            data, events = self.filter.flush()
+            if events:
+                self.server.live.publish(self.live, data, events)
+                self.buffer.append(data, events)
+            logging.info(f"{self.username}: ingest policy kept/dropped {self.filter.summary()}")
 
     def finish(self):
         """ Запускается после завершения работы обработчика, если получены данные, 
-        сохраняет их в БД"""
+        сбрасывает остаток буфера сессии в БД"""
 
-        if self.auth:
+        self.server.metrics.connections_active.dec()
+        if self.server.idle: self.server.idle.remove(self)
+        if self.subscription and self.auth:
+            logging.info(f"{self.username}: unsubscribed from {self.subscription}")
+        elif self.suspended:
+            logging.info(f"{self.username}: connection lost, session kept for {self.server.grace.timeout} sec")
+        elif self.auth:
             if not self.server.quiet: print(f"Logout: {self.username}")
             if self.counter:
-                self.db.add_session(self.username, self.blob)
+                with self.server.metrics.db_write_seconds.time():
+                    self.buffer.close(self.server.store)
+                self.server.metrics.session_bytes.observe(self.buffer.total_bytes)
+                self.server.metrics.session_events.observe(self.buffer.total_events)
                 if not self.server.quiet: print(f'Saved {self.username} session. {self.counter} events blob added to DB')
                 logging.info(f"{self.username}: {self.counter} events dumped to DB")
             logging.info(f"{self.username}: session  finished")
         elif self.username:
+            self.server.metrics.auth_failures.inc()
             logging.info(f"{self.username} auth failed")
         else:
+            self.server.metrics.auth_failures.inc()
             logging.info(f"Bad connection from {self.client_address[0]}")
 
 
 
-class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+class ThreadedTCPServer(ResumableSessions, socketserver.ThreadingMixIn, socketserver.TCPServer):
     """Встроенная реализация TCP сервера, в атрибутах хранит список текущих авторизованных 
-    пользователей и путь к БД. Каждый обработчик открывает/закрывает соединение с БД в своем потоке"""
+    пользователей, общий кэш авторизации и пул соединений с БД, открытый при запуске. 
+    Обработчики берут соединения из пула, запись идет через одно соединение по очереди"""
 
-    def __init__(self, *args, db_path=None, quiet=True, **kwargs):
+    def __init__(self, *args, db_path=None, quiet=True, index_events=False, pool_size=POOL_SIZE, 
+                 reuse_port=False, users_online=None, store=None, 
+                 idle_timeout=KEEP_ALIVE_INTERVAL * IDLE_MISSED, grace=RESUME_GRACE, policy=None, 
+                 heatmap_interval=HEATMAP_INTERVAL, **kwargs):
+        self.reuse_port = reuse_port
         super().__init__(*args, **kwargs)
-        self.users_online = set()
+        self.users_online = SharedUsers({}) if users_online is None else users_online
+        self.db_path = db_path
+        self.quiet = quiet
+        self.index_events = index_events
+        self.db = Database(db_path, index_events=index_events, pool_size=pool_size)
+        self.store = self.db if store is None else store    # куда обработчики пишут данные сессий
+        self.credentials = CredentialCache(self.db)
+        self.live = LiveHub()
+        self.metrics = server_metrics(self)
+        self.policy = policy        # IngestPolicy: прореживание событий при приеме
+        if policy: policy.counter = self.metrics.policy_events
+        self.idle = TimerWheel(idle_timeout, self.close_idle).start() if idle_timeout else None
+        self._init_resume(grace)
+        if self.grace: self.grace.start()
+        self.heatmap = HeatmapUpdater(self.db, heatmap_interval).start() if heatmap_interval else None
+
+    def close_idle(self, handler):
+        """Закрывает молчащее соединение: блокированный readline обработчика получает EOF, 
+        и сессия сохраняется обычным путем через finish()"""
+        if not handler.reading:     # обработчик ждет БД, клиент не виноват: ставим таймер заново
+            self.idle.add(handler)
+            return
+        self.metrics.idle_closed.inc()
+        logging.info(f"{handler.username or handler.client_address[0]}: idle for {self.idle.timeout} sec, closing")
+        try:
+            handler.request.shutdown(socket.SHUT_RDWR)
+        except OSError:         # соединение уже закрыто
+            pass
+
+    def server_bind(self):
+        if self.reuse_port:     # несколько процессов слушают один порт, ядро распределяет соединения
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def server_close(self):
+        self.live.stop()        # потоки подписчиков, иначе server_close будет ждать их вечно
+        super().server_close()
+        if self.idle: self.idle.stop()
+        if self.grace: self.grace.stop()
+        self.close_suspended()
+        if self.heatmap: self.heatmap.stop()
+        self.db.close()
+
+
+class AsyncRequestHandler:
+    """Обработчик соединения для движка asyncio. Протокол и логика те же, что у 
+    ThreadedTCPRequestHandler, но все соединения обслуживаются в одном цикле событий, 
+    а обращения к БД выполняются в пуле потоков сервера"""
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.client_address = writer.get_extra_info("peername") or ("unknown", 0)
+        self.metrics = server.metrics
+
+        self.username = None
+        self.auth = False
+        self.counter = 0
+        self.buffer = None
+        self.finished = False
+        self.token = None           # токен возобновляемой сессии
+        self.suspended = False
+        self.subscription = None    # подписка на трансляцию: пользователь или live.ALL
+        self.live = None            # кольцо трансляции сессии
+        self.filter = None          # прореживание событий сессии по политике сервера
+
+    async def handle(self):
+        """Основной обработчик, принимает приветствие от клиента, если авторизация 
+        успешная, начинает прием данных"""
+
+        self.metrics.connections.inc()
+        self.metrics.connections_active.inc()
+        self.reading = True         # ждем данных от клиента, а не БД: только тогда простой закрывает соединение
+        if self.server.idle: self.server.idle.add(self)
+        greeting = await self.reader.readline()
+        self.reading = False
+        greeting = greeting.strip().decode("ascii", "replace")
+
+        start = time.perf_counter()
+        if await self._auth(greeting):
+            if self.subscription:
+                self.metrics.auth_seconds.observe(time.perf_counter() - start)
+                self.writer.write(make_accepted(ACCEPTED, self.token, self.counter).encode("ascii"))
+                await self._serve_subscription()
+                return
+
+            try:
+                self.metrics.auth_seconds.observe(time.perf_counter() - start)
+                self.writer.write(make_accepted(ACCEPTED, self.token, self.counter).encode("ascii"))
+                if self.version == PROTO_BINARY:
+                    await self._handle_frames()
+                else:
+                    await self._handle_lines()
+
+                self._flush_filter()
+                if self.token and not self.finished:    # обрыв без FINISHED: ждем переподключения
+                    self.suspended = True
+                    self.server.suspend(self)
+            finally:        # при любой ошибке после входа пользователь не должен остаться в сети, сессию сохранит finish
+                self.server.live.close(self.live)
+                self.server.users_online.remove(self.username)
+
+    async def _handle_lines(self):
+        """Прием данных по текстовому протоколу, выход по FINISHED или при закрытии соединения"""
+
+        while not self.finished:
+
+            try:
+                self.reading = True
+                data = await self.reader.readline()
+            except ConnectionResetError:
+                print(f"[{self.username}] ConnectionResetError")
+                data = b""
+            except ValueError:          # строка длиннее лимита StreamReader
+                logging.error(f"{self.username}: line too long")
+                data = b""
+
+            if self.token and not data.endswith(b"\n"):   # обрыв посреди строки, клиент отправит ее заново
+                data = b""
+
+            if data:
+                self.reading = False
+                if self.server.idle: self.server.idle.touch(self)
+                await self._process_data(data)
+            else:
+                break
+
+    async def _serve_subscription(self):
+        """Трансляция подписчику, как у ThreadedTCPRequestHandler: ожидание drain задерживает
+        только эту сопрограмму, отставший подписчик теряет данные, перезаписанные в кольцах"""
+
+        if self.server.idle: self.server.idle.remove(self)     # подписчик только читает
+        wake = asyncio.Event()
+        subscription = self.server.live.subscribe(self.subscription, wake.set)
+        logging.info(f"{self.username} {self.client_address[0]}: subscribed to {self.subscription}")
+        try:
+            while not self.writer.is_closing():
+                try:
+                    await asyncio.wait_for(wake.wait(), KEEP_ALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                wake.clear()
+                data, skipped = subscription.poll()
+                self.metrics.live_skipped.inc(skipped)
+                self.writer.write(data or f"{KEEP_ALIVE}\n".encode("ascii"))
+                await self.writer.drain()
+        except ConnectionError:     # подписчик отключился
+            pass
+        finally:
+            self.server.live.unsubscribe(subscription)
+
+    async def _handle_frames(self):
+        """Прием данных по двоичному протоколу, выход по FINISHED или при закрытии соединения"""
+
+        while not self.finished:
+            try:
+                self.reading = True
+                frame = await read_frame_async(self.reader)
+            except ConnectionResetError:
+                print(f"[{self.username}] ConnectionResetError")
+                frame = None
+            except ProtocolError as e:
+                logging.error(f"{self.username}: {e}")
+                frame = None
+
+            if frame:
+                self.reading = False
+                if self.server.idle: self.server.idle.touch(self)
+                await self._process_frame(*frame)
+            else:
+                break
+
+    async def _auth(self, data):
+        """Процедура авторизации"""
+
+        greeting = parse_greeting(data)
+        if greeting is None or greeting_version(greeting[2]) is None:
+            logging.error(f"Invalid auth data format from {self.client_address[0]}")
+            return False
+
+        self.username, user_password, options = greeting
+        self.version = greeting_version(options)
+        if "subscribe" in options:
+            self.subscription = options["subscribe"] or ALL
+        elif self.username in self.server.users_online:
+            logging.error(f"{self.username}: allready logged in")
+            self.writer.write(f"Such user allready logged in\n".encode("ascii"))
+            return False
+
+        cached, user_row = self.server.credentials.peek(self.username)
+        if not cached:
+            user_row = await self.server.run_db(lambda db: self.server.credentials.get_user(self.username))
+
+        if user_row:
+            if check_password(user_row.hash, user_password) :
+                if self.subscription:
+                    self.auth = True
+                    return True
+                if not self.server.users_online.add(self.username):     # вошел в другом соединении после проверки выше
+                    logging.error(f"{self.username}: allready logged in")
+                    self.writer.write(f"Such user allready logged in\n".encode("ascii"))
+                    return False
+                opened = False
+                try:
+                    opened = self.server.open_session(self, options)
+                finally:        # при отказе или ошибке пользователь не должен остаться в сети
+                    if not opened:
+                        self.server.users_online.remove(self.username)
+                if not opened:
+                    return False
+                if not self.server.quiet: print(f"Login: {self.username}")
+                self.auth = True
+                logging.info(f"{self.username} {self.client_address[0]}: authorized")
+                return True
+            else:
+                logging.error(f"{self.username}: invalid username or password")
+                return False
+        else:
+            logging.error(f"{self.username}: invalid username or password")
+            return False
+
+    async def _process_data(self, data):
+        """Обрабатывает входящие данные и сообщение FINISHED, отвечает на KEEP_ALIVE,
+        отбрасывает данные, несоответсвующе формату телеметрии (timestamp;code;value)"""
+
+        self.metrics.bytes.inc(len(data))
+        line = data.decode("ascii", "replace").strip()
+        if line == str(KEEP_ALIVE):
+            self.metrics.keep_alives.inc()
+            await self._send((str(KEEP_ALIVE)+"\n").encode("ascii") + 
+                             (f"{ACK} {self.counter}\n".encode("ascii") if self.token else b""))
+
+        elif line == str(FINISHED):
+            self.finished = True
+        else:
+            self.counter += 1
+            if len(line.split(";")) == 3 and data.isascii():
+                self.metrics.events.inc()
+                await self._store(data)
+            else:
+                self.metrics.malformed.inc()
+
+    async def _process_frame(self, frame_type, payload):
+        """Двоичный аналог _process_data: отвечает на KEEP_ALIVE, обрабатывает FINISHED,
+        события из кадров данных добавляет в буфер сессии, кадр с неполной записью отбрасывается"""
+
+        self.metrics.bytes.inc(FRAME_HEADER.size + len(payload))
+        if frame_type == FRAME_KEEP_ALIVE:
+            self.metrics.keep_alives.inc()
+            await self._send(KEEP_ALIVE_FRAME + (ack_frame(self.counter) if self.token else b""))
+
+        elif frame_type == FRAME_FINISHED:
+            self.finished = True
+        else:
+            try:
+                data, events = decode_records(frame_type, payload)
+            except ProtocolError as e:
+                logging.error(f"{self.username}: {e}")
+                self.metrics.malformed.inc()
+                self.counter += 1
+                return
+
+            self.counter += events
+            self.metrics.events.inc(events)
+            await self._store(data, events)
+
+    async def _send(self, data):
+        """Ответ клиенту с ожиданием drain: клиент, не читающий ответы, задерживает прием 
+        своей сессии (как блокирующая запись у потокового сервера), а не растит буфер транспорта"""
+        if self.writer.is_closing():        # клиент уже закрыл сокет
+            print(f"[{self.username}] BrokenPipeError")
+            return
+        self.writer.write(data)
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            print(f"[{self.username}] BrokenPipeError")
+
+    async def _store(self, data, events=1):
+        """Прореживает события по политике сервера, оставшиеся передает подписчикам
+        и добавляет в буфер сессии, запись в БД - в пуле потоков сервера"""
+        if self.filter:
+            data, events = self.filter.apply(data, events)
+            if not events:
+                return
+        self.server.live.publish(self.live, data, events)
+        if self.buffer.append(data, events):
+            chunks = self.buffer.drain()
+            with self.metrics.db_write_seconds.time():
+                await self.server.run_store(self.buffer.store, chunks)
+
+    def _flush_filter(self):
+        """Конец или обрыв сессии: события незакрытых окон прореживания - в буфер сессии"""
+        if self.filter:
+            data, events = self.filter.flush()
+            if events:
+                self.server.live.publish(self.live, data, events)
+                self.buffer.append(data, events)
+            logging.info(f"{self.username}: ingest policy kept/dropped {self.filter.summary()}")
+
+    async def finish(self):
+        """ Запускается после завершения работы обработчика, если получены данные, 
+        сбрасывает остаток буфера сессии в БД через пул потоков сервера"""
+
+        self.metrics.connections_active.dec()
+        if self.server.idle: self.server.idle.remove(self)
+        if self.subscription and self.auth:
+            logging.info(f"{self.username}: unsubscribed from {self.subscription}")
+        elif self.suspended:
+            logging.info(f"{self.username}: connection lost, session kept for {self.server.grace.timeout} sec")
+        elif self.auth:
+            if not self.server.quiet: print(f"Logout: {self.username}")
+            if self.counter:
+                with self.metrics.db_write_seconds.time():
+                    await self.server.run_store(self.buffer.close)
+                self.metrics.session_bytes.observe(self.buffer.total_bytes)
+                self.metrics.session_events.observe(self.buffer.total_events)
+                if not self.server.quiet: print(f'Saved {self.username} session. {self.counter} events blob added to DB')
+                logging.info(f"{self.username}: {self.counter} events dumped to DB")
+            logging.info(f"{self.username}: session  finished")
+        elif self.username:
+            self.metrics.auth_failures.inc()
+            logging.info(f"{self.username} auth failed")
+        else:
+            self.metrics.auth_failures.inc()
+            logging.info(f"Bad connection from {self.client_address[0]}")
+
+
+class AsyncTCPServer(ResumableSessions):
+    """TCP сервер на asyncio: все соединения обслуживаются одним циклом событий в одном 
+    потоке, поэтому число одновременных сессий ограничено только дескрипторами и памятью. 
+    Работа с БД вынесена в пул потоков, который использует общий пул соединений с БД"""
+
+    def __init__(self, server_address, db_path=None, quiet=True, index_events=False, 
+                 pool_size=POOL_SIZE, backlog=BACKLOG, reuse_port=False, users_online=None, store=None, 
+                 idle_timeout=KEEP_ALIVE_INTERVAL * IDLE_MISSED, grace=RESUME_GRACE, policy=None, 
+                 heatmap_interval=HEATMAP_INTERVAL):
+        self.server_address = server_address
+        self.reuse_port = reuse_port
+        self.users_online = SharedUsers({}) if users_online is None else users_online
         self.db_path = db_path
         self.quiet = quiet
+        self.index_events = index_events
+        self.backlog = backlog
+        self.db = Database(db_path, index_events=index_events, pool_size=pool_size)
+        self.store = self.db if store is None else store
+        self.credentials = CredentialCache(self.db)
+        self.live = LiveHub()
+        self.metrics = server_metrics(self)
+        self.policy = policy        # IngestPolicy: прореживание событий при приеме
+        if policy: policy.counter = self.metrics.policy_events
+        self.idle = TimerWheel(idle_timeout, self.close_idle) if idle_timeout else None
+        self._init_resume(grace)
+        self.heatmap = HeatmapUpdater(self.db, heatmap_interval) if heatmap_interval else None
+
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="db")
+        self.ready = threading.Event()
+        self._loop = None
+        self._stopped = None
 
+    async def run_db(self, func, *args):
+        """Выполняет func(db, *args) в пуле потоков БД, не блокируя цикл событий"""
+        return await self._loop.run_in_executor(self.executor, func, self.db, *args)
+
+    async def run_store(self, func, *args):
+        """Выполняет func(store, *args) в пуле потоков БД, store - куда пишутся данные сессий"""
+        return await self._loop.run_in_executor(self.executor, func, self.store, *args)
+
+    def close_idle(self, handler):
+        """Закрывает молчащее соединение: ожидающий readline обработчика получает EOF, 
+        и сессия сохраняется обычным путем через finish()"""
+        if not handler.reading:     # обработчик ждет БД, клиент не виноват: ставим таймер заново
+            self.idle.add(handler)
+            return
+        self.metrics.idle_closed.inc()
+        logging.info(f"{handler.username or handler.client_address[0]}: idle for {self.idle.timeout} sec, closing")
+        handler.writer.transport.abort()
+
+    def save_suspended(self, username, buffer, counter):
+        if counter:     # срок истекает в цикле событий, запись в БД - в пуле потоков
+            self._loop.run_in_executor(self.executor, buffer.close, self.store)
+
+    def _tick(self):
+        """Колеса таймеров крутятся в цикле событий, без отдельного потока"""
+        for wheel in (self.idle, self.grace):
+            if wheel: wheel.advance()
+        if not self._stopped.is_set():
+            self._loop.call_later(WHEEL_TICK, self._tick)
+
+    async def _on_connect(self, reader, writer):
+        handler = AsyncRequestHandler(self, reader, writer)
+        try:
+            await handler.handle()
+        except Exception:
+            logging.exception(f"Handler error for {handler.client_address[0]}")
+        finally:
+            try:
+                await handler.finish()
+            finally:
+                writer.close()
+
+    async def serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        host, port = self.server_address
+        server = await asyncio.start_server(self._on_connect, host, port, backlog=self.backlog, 
+                                            reuse_address=True, reuse_port=self.reuse_port or None)
+        if self.idle or self.grace:
+            self._loop.call_later(WHEEL_TICK, self._tick)
+        if self.heatmap: self.heatmap.start()
+        self.ready.set()
+        async with server:
+            await self._stopped.wait()
+
+    def serve_forever(self):
+        try:
+            asyncio.run(self.serve())
+        finally:
+            self.executor.shutdown(wait=True)   # дожидаемся записи уже принятых сессий
+            self.close_suspended()
+            if self.heatmap: self.heatmap.stop()
+            self.db.close()
+
+    def shutdown(self):
+        """Останавливает сервер, можно вызывать из другого потока"""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stopped.set)
+
+
+class SharedUsers:
+    """Множество авторизованных пользователей: username -> (pid, номер входа). Для одного 
+    процесса - обычный словарь, для процессов-приемников (--workers) - словарь процесса 
+    multiprocessing.Manager. Интерфейс как у set, но add атомарно занимает имя и сообщает, 
+    удалось ли: проверка и добавление одной операцией setdefault (в Manager выполняется 
+    целиком в его процессе), поэтому два соединения не войдут одновременно"""
+
+    def __init__(self, users):
+        self.users = users
+        self.claims = itertools.count()
+
+    def __contains__(self, username):
+        return username in self.users
+
+    def __len__(self):
+        return len(self.users)
+
+    def add(self, username):
+        """Занимает имя, False - пользователь уже в сети"""
+        claim = (os.getpid(), next(self.claims))
+        return self.users.setdefault(username, claim) == claim
+
+    def remove(self, username):
+        self.users.pop(username, None)
+
+    def release(self, pid):
+        """Снимает пользователей, авторизованных в процессе pid (приемник завершился, 
+        в том числе аварийно, и сам их уже не удалит), возвращает их имена"""
+        released = [username for username, (owner, _) in self.users.items() if owner == pid]
+        for username in released:
+            self.users.pop(username, None)
+        return released
+
+
+class SessionQueue:
+    """Заместитель Database для процессов-приемников (--workers): данные сессий не пишутся 
+    в БД, а отправляются единственному процессу записи. Вместо id сессии выдается ключ 
+    (pid приемника, номер), процесс записи сопоставляет его с настоящим id"""
+
+    def __init__(self, tasks):
+        self.tasks = tasks
+        self.counter = itertools.count()
+
+    def _key(self):
+        return (os.getpid(), next(self.counter))
+
+    def open_session(self, username):
+        key = self._key()
+        self.tasks.put(("open", key, username, 0, None))
+        return key
+
+    def add_chunks(self, session_id, seq, chunks, username=None):
+        if session_id is None:
+            session_id = self._key()
+        self.tasks.put(("chunks", session_id, username, seq, chunks))
+        return session_id, seq + len(chunks)
+
+    def close_session(self, session_id):
+        self.tasks.put(("close", session_id, None, 0, None))
+
+
+def session_writer(db_path, tasks, index_events=False):
+    """Цикл процесса записи: забирает из очереди все накопившиеся сообщения приемников 
+    (не больше WRITER_BATCH) и записывает их одной транзакцией. Если транзакция не прошла, 
+    сообщения пачки записываются по одному, сообщение с ошибкой пропускается, остальные 
+    сохраняются. Сопоставление ключей с id меняется только после фиксации транзакции. 
+    Останавливается по None"""
+
+    db = Database(db_path, index_events=index_events)
+    db.tune_for_writes()
+    sessions = {}       # ключ приемника -> id сессии в БД
+
+    running = True
+    while running:
+        batch = [tasks.get()]
+        while len(batch) < WRITER_BATCH:
+            try:
+                batch.append(tasks.get_nowait())
+            except queue.Empty:
+                break
+        if None in batch:           # все, что было до None, уже в пачке
+            running = False
+            batch = batch[:batch.index(None)]
+
+        try:
+            _write_messages(db, sessions, batch)
+        except Exception:
+            logging.exception(f"[Writer] Failed to save {len(batch)} messages in one transaction, saving one by one")
+            for task in batch:
+                try:
+                    _write_messages(db, sessions, [task])
+                except Exception:
+                    logging.exception(f"[Writer] Failed to save '{task[0]}' message of session {task[1]}")
+    db.close()
+
+def _write_messages(db, sessions, batch):
+    """Записывает сообщения приемников одной транзакцией, новые id сессий попадают 
+    в sessions только после ее фиксации (при откате сопоставление не меняется)"""
+    changes = {}        # ключ -> id сессии, None - ключ удаляется
+    with db.writer(new_sessions=True) as conn:
+        for op, key, username, seq, chunks in batch:
+            if op == "chunks":
+                session_id = changes[key] if key in changes else sessions.get(key)
+                changes[key], _ = db.add_chunks(session_id, seq, chunks, username, conn)
+            elif op == "open":
+                changes[key] = db.open_session(username, conn)
+            elif op == "exit":      # приемник завершился, его незакрытые сессии больше не продолжатся
+                changes.update((k, None) for k in set(sessions) | set(changes) if k[0] == key)
+            else:
+                changes[key] = None
+    for key, session_id in changes.items():
+        if session_id is None:
+            sessions.pop(key, None)
+        else:
+            sessions[key] = session_id
+
+def _writer_process(db_path, tasks, index_events):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)    # останавливается сообщением None после приемников
+    session_writer(db_path, tasks, index_events)
+
+def _worker_process(engine, address, db_path, quiet, users_online, tasks, metrics_address=None, 
+                    idle_timeout=KEEP_ALIVE_INTERVAL * IDLE_MISSED, grace=RESUME_GRACE, policy=None):
+    store = SessionQueue(tasks)
+    if engine == "asyncio":
+        server = AsyncTCPServer(address, quiet=quiet, db_path=db_path, idle_timeout=idle_timeout, grace=grace,
+                                policy=policy, reuse_port=True, users_online=users_online, store=store, 
+                                heatmap_interval=0)
+    else:
+        server = ThreadedTCPServer(address, ThreadedTCPRequestHandler, quiet=quiet, db_path=db_path, 
+                                   idle_timeout=idle_timeout, grace=grace, policy=policy, reuse_port=True, 
+                                   users_online=users_online, store=store, heatmap_interval=0)
+    if metrics_address is not None:
+        MetricsServer(metrics_address, server.metrics).start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if engine != "asyncio":
+            server.server_close()
+
+def _worker_exited(process, users_online, tasks):
+    """Приемник завершился: его пользователи снимаются из общего списка (после аварийного 
+    завершения иначе не смогли бы войти снова), процесс записи забывает его сессии"""
+    process.join()
+    released = users_online.release(process.pid)
+    if process.exitcode:
+        logging.error(f"{process.name} exited with code {process.exitcode}, released users: {released}")
+    tasks.put(("exit", process.pid, None, 0, None))
+
+def run_workers(workers, engine, address, db_path, quiet=True, index_events=False, metrics_port=0, 
+                idle_timeout=KEEP_ALIVE_INTERVAL * IDLE_MISSED, grace=RESUME_GRACE, policy=None, 
+                heatmap_interval=HEATMAP_INTERVAL):
+    """Запускает workers процессов-приемников на одном порту (SO_REUSEPORT) и один процесс 
+    записи в БД, приемники передают ему данные сессий через очередь multiprocessing. 
+    Метрики приемника i (если задан metrics_port) отдаются на порту metrics_port + i. 
+    Приостановленные сессии хранятся в приемнике, выдавшем токен: если ядро направит 
+    переподключение в другой приемник, возобновить сессию не получится. Тепловую карту 
+    обновляет главный процесс, один на все приемники"""
+
+    Database(db_path).close()                       # создаем БД до запуска процессов
+    manager = multiprocessing.managers.SyncManager()
+    manager.start(signal.signal, (signal.SIGINT, signal.SIG_IGN))
+    users_online = SharedUsers(manager.dict())
+    tasks = multiprocessing.Queue(maxsize=WRITER_QUEUE_SIZE)
+
+    writer = multiprocessing.Process(target=_writer_process, name="DBWriter", 
+                                     args=(db_path, tasks, index_events))
+    writer.start()
+    pool = [multiprocessing.Process(target=_worker_process, name=f"Worker-{i}",
+                                    args=(engine, address, db_path, quiet, users_online, tasks,
+                                          (address[0], metrics_port + i) if metrics_port else None, 
+                                          idle_timeout, grace, policy))
+            for i in range(workers)]
+    for p in pool:
+        p.start()
+    heatmap = HeatmapUpdater(Database(db_path, pool_size=1), heatmap_interval).start() if heatmap_interval else None
+
+    try:
+        running = {p.sentinel: p for p in pool}
+        while running:
+            for sentinel in multiprocessing.connection.wait(list(running)):
+                _worker_exited(running.pop(sentinel), users_online, tasks)
+    except KeyboardInterrupt:       # SIGINT получают все процессы группы, ждем завершения приемников
+        for p in pool:
+            p.join()
+    finally:
+        tasks.put(None)
+        writer.join()
+        manager.shutdown()
+        if heatmap:
+            heatmap.stop()
+            heatmap.db.close()
 
 if __name__ == "__main__":
 
@@ -147,6 +1137,23 @@ if __name__ == "__main__":
     parser.add_argument('-d', '--db', type=str, help=f'Path to sqlite3 database (default: ./telemetry.db)')
     parser.add_argument('-r', '--report', action='store_true', help=f"Print number of sessions by users in DB")
     parser.add_argument('-q', '--quiet', action='store_true', help=f"Quiet mode")
+    parser.add_argument('-e', '--engine', type=str, choices=ENGINES, default=ENGINES[0], 
+                        help=f"Connection handling engine: thread per client or single asyncio event loop (default: {ENGINES[0]})")
+    parser.add_argument('--events', action='store_true', help=f"Also store parsed events in typed events table")
+    parser.add_argument('-w', '--workers', type=int, default=0, 
+                        help=f"Number of acceptor processes sharing the port, sessions are saved by one writer process (default: 0 - single process)")
+    parser.add_argument('-m', '--metrics-port', type=int, default=0, 
+                        help=f"Serve Prometheus metrics on HOST:PORT/metrics (default: 0 - disabled)")
+    parser.add_argument('--keep-alive', type=float, default=KEEP_ALIVE_INTERVAL, 
+                        help=f"Expected client KEEP_ALIVE interval, sec (default: {KEEP_ALIVE_INTERVAL})")
+    parser.add_argument('--idle-missed', type=int, default=IDLE_MISSED, 
+                        help=f"Close connections silent for N keep-alive intervals (default: {IDLE_MISSED}, 0 - never)")
+    parser.add_argument('--resume-grace', type=float, default=RESUME_GRACE, 
+                        help=f"Keep dropped resumable sessions for N sec (default: {RESUME_GRACE}, 0 - disable resume)")
+    parser.add_argument('--policy', type=str, metavar="FILE",
+                        help=f"JSON ingest policy: per-code decimation of events (see policy.py)")
+    parser.add_argument('--heatmap-interval', type=float, default=HEATMAP_INTERVAL, 
+                        help=f"Add received data to position heatmap every N sec (default: {HEATMAP_INTERVAL}, 0 - never)")
     args = parser.parse_args()
     
     HOST = args.addr
@@ -158,14 +1165,53 @@ if __name__ == "__main__":
 
     af_inet_addr    = (HOST, PORT)
     quiet           = False
+    idle_timeout    = args.keep_alive * args.idle_missed
+
+    try:
+        policy = IngestPolicy.load(args.policy) if args.policy else None
+    except (OSError, ValueError) as e:
+        print(f"Bad ingest policy '{args.policy}': {e}")
+        sys.exit(1)
     
+    if args.workers > 0:
+        print(f"Database at '{DB_PATH}'")
+        print(f"Telemetry server up on '{HOST}:{PORT}' with {args.workers} workers, use <Ctrl-C> to stop")
+
+        run_workers(args.workers, args.engine, af_inet_addr, DB_PATH, quiet=args.quiet, index_events=args.events, 
+                    metrics_port=args.metrics_port, idle_timeout=idle_timeout, grace=args.resume_grace, policy=policy, 
+                    heatmap_interval=args.heatmap_interval)
+        sys.exit(0)
+
+    if args.engine == "asyncio":
+        server = AsyncTCPServer(af_inet_addr, quiet = args.quiet, db_path=DB_PATH, index_events=args.events, 
+                                idle_timeout=idle_timeout, grace=args.resume_grace, policy=policy, 
+                                heatmap_interval=args.heatmap_interval)
+        if args.metrics_port:
+            MetricsServer((HOST, args.metrics_port), server.metrics).start()
+
+        print(f"Database at '{DB_PATH}'")
+        print(f"Telemetry server (asyncio) up on '{HOST}:{PORT}', use <Ctrl-C> to stop")
+
+        try:
+            server.serve_forever()
+        except OSError:
+            print("Address already in use")
+            sys.exit(1)
+        sys.exit(0)
+
     try:
-        server = ThreadedTCPServer(af_inet_addr, ThreadedTCPRequestHandler, quiet = args.quiet, db_path=DB_PATH)
+        server = ThreadedTCPServer(af_inet_addr, ThreadedTCPRequestHandler, quiet = args.quiet, db_path=DB_PATH, 
+                                   index_events=args.events, idle_timeout=idle_timeout, grace=args.resume_grace, policy=policy, 
+                                   heatmap_interval=args.heatmap_interval)
     except OSError:
         print("Address already in use")
         sys.exit(1)
 
 
+    if args.metrics_port:
+        MetricsServer((HOST, args.metrics_port), server.metrics).start()
+        print(f"Metrics at 'http://{HOST}:{args.metrics_port}/metrics'")
+
     print(f"Database at '{DB_PATH}'")
     print(f"Telemetry server up on '{HOST}:{PORT}', use <Ctrl-C> to stop")
 
@@ -3,20 +3,30 @@
 разбирает эту очередь"""
 
 import os, sys
+import glob
+import time
 import uuid
 import hashlib
 import argparse
 
+import socket
 import socketserver
 
 import threading
 import queue
+import sqlite3
+
+from collections import deque
 
 import logging
 logging.basicConfig(filename='./serverq.log', level=logging.DEBUG, 
                     format='%(threadName)s  %(asctime)s : %(levelname)s : %(message)s')
 
-from db import Database
+from db import Database, CredentialCache, POOL_SIZE
+from metrics import ServerMetrics, MetricsServer
+from timers import TimerWheel
+from protocol import (PROTO_BINARY, FRAME_HEADER, FRAME_KEEP_ALIVE, FRAME_FINISHED, KEEP_ALIVE_FRAME, ProtocolError,
+                      parse_greeting, greeting_version, decode_records, read_frame)
 
 DB_PATH = os.path.abspath("telemetryq.db")
 
@@ -27,6 +37,19 @@ ACCEPTED    = 200
 KEEP_ALIVE  = 100
 FINISHED    = 500
 
+BATCH_SESSIONS  = 256               # максимум сессий в одной транзакции записи
+BATCH_BYTES     = 16 * 1024 * 1024  # максимум байт данных в одной транзакции
+BATCH_LATENCY   = 0.05              # сколько ждать новых сессий для транзакции после первой, сек
+WRITE_RETRIES   = 3                 # попыток записи сессии после ошибки транзакции пачки
+RETRY_DELAY     = 0.1               # пауза перед повтором (удваивается с каждой попыткой), сек
+
+QUEUE_BYTES         = 256 * 1024 * 1024     # сколько байт сессий очередь записи держит в памяти
+BACKPRESSURE_LEVEL  = 0.75                  # доля QUEUE_BYTES, после которой включается торможение клиентов
+BACKPRESSURE_DELAY  = 0.5                   # задержка ответа на KEEP_ALIVE при торможении, сек
+
+KEEP_ALIVE_INTERVAL = 1         # клиент шлет KEEP_ALIVE раз в секунду (clients.Client.timeout)
+IDLE_MISSED         = 5         # соединение без данных и KEEP_ALIVE дольше N интервалов закрывается
+
 
 def salt_and_hash(password):
     salt = uuid.uuid4().hex
@@ -47,43 +70,81 @@ class ThreadedTCPRequestHandler(socketserver.StreamRequestHandler):
         self.username = None
         self.auth = False
         self.counter = 0
-        self.db_reader = Database(self.server.db_path)
-        self.blob = bytes()
+        self.blob = bytearray()
+        self.events = 0
         self.finished = False
+        self.metrics = self.server.metrics
+        self.metrics.connections.inc()
+        self.metrics.connections_active.inc()
+        self.reading = True         # ждем данных от клиента, а не очереди: только тогда простой закрывает соединение
+        if self.server.idle: self.server.idle.add(self)
 
         greeting = self.rfile.readline().strip()
+        self.reading = False
         greeting = greeting.decode("ascii")
 
+        start = time.perf_counter()
         if self._auth(greeting):
+            self.metrics.auth_seconds.observe(time.perf_counter() - start)
             self.wfile.write((str(ACCEPTED)+"\n").encode("ascii"))
+            if self.version == PROTO_BINARY:
+                self._handle_frames()
+
             while not self.finished:
 
                 try:
+                    self.reading = True
                     data = self.rfile.readline()
                 except ConnectionResetError:
                     print(f"[Handler] {self.username}: ConnectionResetError")
+                    data = b""
 
                 if data:
+                    self.reading = False
+                    if self.server.idle: self.server.idle.touch(self)
                     self._process_data(data)
                 else:
                     break
 
             self.server.users_online.remove(self.username)
 
+    def _handle_frames(self):
+        """Прием данных по двоичному протоколу, выход по FINISHED или при закрытии соединения"""
+
+        while not self.finished:
+            try:
+                self.reading = True
+                frame = read_frame(self.rfile)
+            except ConnectionResetError:
+                print(f"[Handler] {self.username}: ConnectionResetError")
+                frame = None
+            except ProtocolError as e:
+                logging.error(f"[Handler] {self.username}: {e}")
+                frame = None
+
+            if frame:
+                self.reading = False
+                if self.server.idle: self.server.idle.touch(self)
+                self._process_frame(*frame)
+            else:
+                self.finished = True
+
     def _auth(self, data):
         """Процедура авторизации"""
 
-        if len(data.split(":")) != 2:
+        greeting = parse_greeting(data)
+        if greeting is None or greeting_version(greeting[2]) is None:
             logging.error(f"[Handler] Invalid auth data format from {self.client_address[0]}")
             return False
 
-        self.username, user_password = data.split(":")
+        self.username, user_password, options = greeting
+        self.version = greeting_version(options)
         if self.username in self.server.users_online:
             logging.error(f"{self.username}: allready logged in")
             self.wfile.write(f"[Handler] Such user allready logged in\n".encode("ascii"))
             return False
 
-        user_row = self.db_reader.get_user(self.username)
+        user_row = self.server.credentials.get_user(self.username)
         if user_row:
             if check_password(user_row.hash, user_password) :
                 if not self.server.quiet: print(f"[Handler] Login: {self.username}")
@@ -102,8 +163,11 @@ class ThreadedTCPRequestHandler(socketserver.StreamRequestHandler):
         """Обрабатывает входящие данные и сообщение FINISHED, отвечает на KEEP_ALIVE,
         отбрасывает данные, несоответсвующе формату телеметрии (timestamp;code;value)"""
 
+        self.metrics.bytes.inc(len(data))
         if data.decode("ascii").strip() == str(KEEP_ALIVE):
 
+            self.metrics.keep_alives.inc()
+            self.server.throttle()
             try:
                 self.wfile.write((str(KEEP_ALIVE)+"\n").encode("ascii"))
             except BrokenPipeError:        # SIGPIPE, клиент уже закрыл сокет
@@ -113,48 +177,338 @@ class ThreadedTCPRequestHandler(socketserver.StreamRequestHandler):
         else:
             self.counter += 1
             if len(data.decode("ascii").split(";")) == 3:
+                self.metrics.events.inc()
+                self.events += 1
                 self.blob += data
+            else:
+                self.metrics.malformed.inc()
+
+    def _process_frame(self, frame_type, payload):
+        """Двоичный аналог _process_data: отвечает на KEEP_ALIVE, обрабатывает FINISHED,
+        события из кадров данных добавляет к данным сессии, кадр с неполной записью отбрасывается"""
+
+        self.metrics.bytes.inc(FRAME_HEADER.size + len(payload))
+        if frame_type == FRAME_KEEP_ALIVE:
+            self.metrics.keep_alives.inc()
+            self.server.throttle()
+            try:
+                self.wfile.write(KEEP_ALIVE_FRAME)
+            except BrokenPipeError:        # SIGPIPE, клиент уже закрыл сокет
+                print(f"[Handler] {self.username}: BrokenPipeError")
+
+        elif frame_type == FRAME_FINISHED:
+            self.finished = True
+        else:
+            try:
+                data, events = decode_records(frame_type, payload)
+            except ProtocolError as e:
+                logging.error(f"[Handler] {self.username}: {e}")
+                self.metrics.malformed.inc()
+                self.counter += 1
+                return
+
+            self.counter += events
+            self.events += events
+            self.metrics.events.inc(events)
+            self.blob += data
 
     def finish(self):
         """ Запускается после завершения работы обработчика, если получены данные, 
         помещает их в очередь для сохранения их в БД"""
         
+        self.server.metrics.connections_active.dec()
+        if self.server.idle: self.server.idle.remove(self)
         if self.auth:
             if not self.server.quiet: print(f"[Handler] Logout: {self.username}")
             if self.counter:
-                task = (self.username, self.counter, self.blob)
+                task = (self.username, self.counter, bytes(self.blob))
                 self.server.db_write_queue.put_nowait(task)
+                self.server.metrics.session_bytes.observe(len(self.blob))
+                self.server.metrics.session_events.observe(self.events)
             logging.info(f"[Handler] {self.username}: session  finished")
         elif self.username:
+            self.server.metrics.auth_failures.inc()
             logging.info(f"[Handler] {self.username}: auth failed")
         else:
+            self.server.metrics.auth_failures.inc()
             logging.info(f"[Handler] Bad connection from {self.client_address[0]}")
 
 
 
+class SpillQueue:
+    """Очередь сессий на запись, ограниченная по объему: в памяти держится не больше max_bytes 
+    байт данных, остальные сессии сбрасываются в файлы каталога spill_dir. Пока на диске есть 
+    сессии, новые тоже идут на диск, поэтому порядок записи в БД сохраняется. Файл сессии 
+    удаляется только в task_done, который писатель вызывает после фиксации транзакции: 
+    файлы, оставшиеся после аварийной остановки, дописываются в БД после запуска (сессия, 
+    записанная перед самым сбоем, может сохраниться дважды, но не потеряется). 
+    Интерфейс (put_nowait, get, task_done) как у queue.Queue, put(None) - остановка: 
+    get вернет None после того, как отдаст все сессии из памяти и с диска"""
+
+    def __init__(self, spill_dir, max_bytes=QUEUE_BYTES):
+        self.spill_dir = spill_dir
+        self.max_bytes = max_bytes
+
+        self.items = deque()
+        self.bytes = 0
+        self.spilled = deque()          # (путь, размер)
+        self.spill_bytes = 0
+        self.spill_seq = 0
+        self.pending = deque()          # выданные get и еще не подтвержденные сессии: (путь, размер) или None
+        self.closing = False
+        self.cond = threading.Condition()
+
+        os.makedirs(spill_dir, exist_ok=True)
+        paths = glob.glob(os.path.join(spill_dir, "*.spill")) + glob.glob(os.path.join(spill_dir, "*.failed"))
+        for path in sorted(paths, key=os.path.basename):
+            size = os.path.getsize(path)
+            self.spilled.append((path, size))
+            self.spill_bytes += size
+            self.spill_seq = int(os.path.basename(path).split(".")[0]) + 1
+
+    def put(self, task):
+        with self.cond:
+            if task is None:
+                self.closing = True
+            elif self.spilled or (self.items and self.bytes + len(task[2]) > self.max_bytes):
+                self._spill(task)
+            else:
+                self.items.append(task)
+                self.bytes += len(task[2])
+            self.cond.notify()
+
+    put_nowait = put
+
+    def _spill(self, task, extension="spill"):
+        username, counter, blob = task
+        path = os.path.join(self.spill_dir, f"{self.spill_seq:012d}.{extension}")
+        self.spill_seq += 1
+        with open(path, "wb") as file:
+            file.write(f"{username}\n{counter}\n".encode("utf-8"))
+            file.write(blob)
+        size = os.path.getsize(path)
+        if extension == "spill":
+            self.spilled.append((path, size))
+            self.spill_bytes += size
+
+    def _load(self, path):
+        with open(path, "rb") as file:
+            username = file.readline().decode("utf-8").rstrip("\n")
+            counter = int(file.readline())
+            blob = file.read()
+        return username, counter, blob
+
+    def get(self, block=True, timeout=None):
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.items or self.spilled or self.closing, 
+                                      timeout if block else 0):
+                raise queue.Empty
+            if self.items:
+                task = self.items.popleft()
+                self.bytes -= len(task[2])
+                self.pending.append(None)
+                return task
+            if not self.spilled:
+                self.pending.append(None)
+                return None                 # закрыта и пуста
+            path, size = self.spilled.popleft()
+            self.pending.append((path, size))
+        return self._load(path)             # вне блокировки: читает только писатель, порядок не нарушится
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def task_done(self):
+        """Подтверждение записи сессии, выданной get (в порядке выдачи): ее файл больше не нужен"""
+        with self.cond:
+            spilled = self.pending.popleft()
+            if spilled:
+                self.spill_bytes -= spilled[1]
+        if spilled:
+            os.remove(spilled[0])
+
+    def reject(self, task):
+        """Сессия, которую не удалось записать в БД, остается на диске файлом .failed: 
+        в этом запуске она больше не выдается, после перезапуска запись повторяется. 
+        Подтверждать ее через task_done все равно нужно"""
+        with self.cond:
+            self._spill(task, "failed")
+
+    def pressure(self):
+        """Доля заполнения очереди, больше 1 - сессии уходят на диск"""
+        with self.cond:
+            return (self.bytes + self.spill_bytes) / self.max_bytes
+
+    def stats(self):
+        with self.cond:
+            return {"queued": len(self.items), "queued_bytes": self.bytes, 
+                    "spilled": len(self.spilled), "spilled_bytes": self.spill_bytes}
+
+
+class DBWriter(threading.Thread):
+    """Поток записи в БД: пишет через соединение-писатель Database, блокируется на очереди и сохраняет все 
+    накопившиеся к моменту записи сессии одной транзакцией (не больше max_sessions сессий 
+    и max_bytes байт, новые сессии после первой ждет не дольше max_latency секунд). 
+    Так одновременно завершившиеся клиенты стоят один fsync, а не по одному на сессию"""
+
+    STOP = None
+
+    def __init__(self, db, tasks, quiet=True, metrics=None,
+                 max_sessions=BATCH_SESSIONS, max_bytes=BATCH_BYTES, max_latency=BATCH_LATENCY):
+        super().__init__(name="DBWriter", daemon=True)
+        self.db = db
+        self.metrics = metrics or ServerMetrics()
+        self.tasks = tasks
+        self.quiet = quiet
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.max_latency = max_latency
+
+    def run(self):
+        db = self.db
+        db.tune_for_writes()
+
+        stopping = False
+        while not stopping:
+            batch = []
+            size = 0
+            task = self.tasks.get()                             # ждем первую сессию без опроса
+            deadline = time.monotonic() + self.max_latency
+
+            while True:
+                if task is DBWriter.STOP:                       # все, что было до STOP, уже в batch
+                    stopping = True
+                    break
+
+                batch.append(task)
+                size += len(task[2])
+                if len(batch) >= self.max_sessions or size >= self.max_bytes:
+                    break
+
+                try:
+                    task = self.tasks.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+
+            if batch:
+                self._write(db, batch)
+            if stopping:            # подтверждения идут в порядке get: STOP - после сессий перед ним
+                self.tasks.task_done()
+
+    def _write(self, db, batch):
+        try:
+            with self.metrics.db_write_seconds.time():
+                db.add_sessions([(username, blob) for username, _, blob in batch])
+        except Exception:
+            logging.exception(f"[Writer] Failed to save {len(batch)} sessions in one transaction, saving one by one")
+            saved = [task for task in batch if self._write_one(db, task)]
+            logging.info(f"[Writer] {len(saved)} of {len(batch)} sessions saved one by one")
+        else:
+            saved = batch
+            logging.info(f"[Writer] {len(batch)} sessions saved in one transaction")
+
+        for username, counter, _ in saved:
+            if not self.quiet: print(f'[Server] Saved {username} session. {counter} events blob added to DB')
+        if hasattr(self.tasks, "stats"):
+            logging.info("[Writer] queue: {queued} sessions / {queued_bytes} bytes in memory, "
+                         "{spilled} sessions / {spilled_bytes} bytes spilled".format(**self.tasks.stats()))
+        for _ in batch:             # подтверждение после записи: очередь удаляет файлы сессий
+            self.tasks.task_done()
+
+    def _write_one(self, db, task):
+        """Запись одной сессии из пачки, транзакция которой не прошла: сессия с ошибкой в данных 
+        не мешает остальным, временные ошибки БД (занята, нет места) повторяются с паузой. 
+        Возвращает True, если сессия записана, иначе она передается в _reject"""
+        username, _, blob = task
+        for attempt in range(WRITE_RETRIES):
+            try:
+                with self.metrics.db_write_seconds.time():
+                    db.add_sessions([(username, blob)])
+                return True
+            except sqlite3.OperationalError:
+                logging.exception(f"[Writer] {username}: attempt {attempt + 1} of {WRITE_RETRIES} failed")
+                if attempt < WRITE_RETRIES - 1:
+                    time.sleep(RETRY_DELAY * 2 ** attempt)
+            except Exception:
+                logging.exception(f"[Writer] {username}: session can not be saved")
+                break
+        self._reject(task)
+        return False
+
+    def _reject(self, task):
+        """Несохраненная сессия: очередь со сбросом на диск оставляет ее в файле до перезапуска"""
+        if hasattr(self.tasks, "reject"):
+            self.tasks.reject(task)
+            logging.error(f"[Writer] {task[0]}: session of {len(task[2])} bytes kept in {self.tasks.spill_dir}")
+        else:
+            logging.error(f"[Writer] {task[0]}: session of {len(task[2])} bytes lost")
+
+    def stop(self):
+        """Дописывает все сессии, уже поставленные в очередь, и завершает поток"""
+        self.tasks.put(DBWriter.STOP)
+        self.join()
+
+
 class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
-    def __init__(self, *args, db_path=None, quiet=True, **kwargs):
+    def __init__(self, *args, db_path=None, quiet=True, index_events=False, pool_size=POOL_SIZE, 
+                 queue_bytes=QUEUE_BYTES, spill_dir=None, backpressure=False, 
+                 idle_timeout=KEEP_ALIVE_INTERVAL * IDLE_MISSED, **kwargs):
         super().__init__(*args, **kwargs)
         self.quiet = quiet
         self.db_path = db_path
-        self.db_write_queue = queue.Queue(maxsize=0)
+        self.db = Database(db_path, index_events=index_events, pool_size=pool_size)
+        self.db_write_queue = SpillQueue(spill_dir or f"{db_path}.spill", max_bytes=queue_bytes)
+        self.backpressure = backpressure
 
         self.users_online = set()
-
-        threading.Thread(target=self.db_writer).start()
-        
-    def db_writer(self):
-        while True:
-            
-            db = Database(self.db_path)
-            try:
-                username, counter, blob = self.db_write_queue.get_nowait()
-            except queue.Empty:
-                continue
-
-            db.add_session(username, blob)
-            if not self.quiet: print(f'[Server] Saved {username} session. {counter} events blob added to DB')
-            self.db_write_queue.task_done()
+        self.credentials = CredentialCache(self.db)
+        self.metrics = self._metrics()
+        self.idle = TimerWheel(idle_timeout, self.close_idle).start() if idle_timeout else None
+
+        self.db_writer = DBWriter(self.db, self.db_write_queue, quiet=self.quiet, metrics=self.metrics)
+        self.db_writer.start()
+
+    def _metrics(self):
+        """Общие метрики сервера плюс кэш авторизации и состояние очереди записи"""
+        metrics = ServerMetrics()
+        metrics.counter("telemetry_auth_cache_hits_total", "Credential cache hits", 
+                        lambda: self.credentials.hits)
+        metrics.counter("telemetry_auth_cache_misses_total", "Credential cache misses", 
+                        lambda: self.credentials.misses)
+        metrics.gauge("telemetry_users_online", "Authorized users online", 
+                      lambda: len(self.users_online))
+        for key, help in (("queued", "Sessions waiting in memory for DB write"), 
+                          ("queued_bytes", "Bytes of sessions waiting in memory for DB write"),
+                          ("spilled", "Sessions spilled to disk"), 
+                          ("spilled_bytes", "Bytes of sessions spilled to disk")):
+            metrics.gauge(f"telemetry_queue_{key}", help, lambda key=key: self.db_write_queue.stats()[key])
+        return metrics
+
+    def close_idle(self, handler):
+        """Закрывает молчащее соединение: блокированный readline обработчика получает EOF, 
+        и сессия ставится в очередь записи обычным путем через finish()"""
+        if not handler.reading:     # обработчик притормаживает клиента, клиент не виноват
+            self.idle.add(handler)
+            return
+        self.metrics.idle_closed.inc()
+        logging.info(f"[Handler] {handler.username or handler.client_address[0]}: idle for {self.idle.timeout} sec, closing")
+        try:
+            handler.request.shutdown(socket.SHUT_RDWR)
+        except OSError:         # соединение уже закрыто
+            pass
+
+    def throttle(self):
+        """Сигнал обратного давления: если очередь записи почти заполнена, обработчик задерживает 
+        ответ на KEEP_ALIVE и не читает сокет, TCP притормаживает клиента"""
+        if self.backpressure and self.db_write_queue.pressure() >= BACKPRESSURE_LEVEL:
+            time.sleep(BACKPRESSURE_DELAY)
+
+    def server_close(self):
+        """Закрывает сокет, дожидается обработчиков и записи очереди в БД"""
+        super().server_close()
+        if self.idle: self.idle.stop()
+        self.db_writer.stop()
+        self.db.close()
 
 
 if __name__ == "__main__":
@@ -164,6 +518,18 @@ if __name__ == "__main__":
     parser.add_argument('-p', '--port', type=int, default=PORT, help=f"Server port (dafault: {PORT})")
     parser.add_argument('-d', '--db', type=str, help=f'Path to sqlite3 database (default: ./telemetry.db)')
     parser.add_argument('-r', '--report', action='store_true', help=f"Print number of sessions by users in DB")
+    parser.add_argument('-q', '--quiet', action='store_true', help=f"Quiet mode")
+    parser.add_argument('--events', action='store_true', help=f"Also store parsed events in typed events table")
+    parser.add_argument('--queue-mb', type=int, default=QUEUE_BYTES // 2**20, 
+                        help=f"Memory limit of DB write queue, MiB (default: {QUEUE_BYTES // 2**20})")
+    parser.add_argument('--spill-dir', type=str, help=f"Directory for sessions over the queue limit (default: DB_PATH.spill)")
+    parser.add_argument('--backpressure', action='store_true', help=f"Delay KEEP_ALIVE replies while write queue is nearly full")
+    parser.add_argument('-m', '--metrics-port', type=int, default=0, 
+                        help=f"Serve Prometheus metrics on HOST:PORT/metrics (default: 0 - disabled)")
+    parser.add_argument('--keep-alive', type=float, default=KEEP_ALIVE_INTERVAL, 
+                        help=f"Expected client KEEP_ALIVE interval, sec (default: {KEEP_ALIVE_INTERVAL})")
+    parser.add_argument('--idle-missed', type=int, default=IDLE_MISSED, 
+                        help=f"Close connections silent for N keep-alive intervals (default: {IDLE_MISSED}, 0 - never)")
     args = parser.parse_args()
     
     HOST = args.addr
@@ -177,13 +543,25 @@ if __name__ == "__main__":
     quiet           = False
     
     try:
-        server = ThreadedTCPServer(af_inet_addr, ThreadedTCPRequestHandler, quiet = args.quiet, db_path=DB_PATH)
+        server = ThreadedTCPServer(af_inet_addr, ThreadedTCPRequestHandler, quiet = args.quiet, db_path=DB_PATH, 
+                                   index_events=args.events, queue_bytes=args.queue_mb * 2**20, 
+                                   spill_dir=args.spill_dir, backpressure=args.backpressure, 
+                                   idle_timeout=args.keep_alive * args.idle_missed)
     except OSError:
         print("Address already in use")
         sys.exit(1)
 
+    if args.metrics_port:
+        MetricsServer((HOST, args.metrics_port), server.metrics).start()
+        print(f"Metrics at 'http://{HOST}:{args.metrics_port}/metrics'")
+
     print(f"Database at '{DB_PATH}'")
     print(f"Telemetry server up on '{HOST}:{PORT}', use <Ctrl-C> to stop")
 
-    server.serve_forever()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopping, saving queued sessions...")
+    finally:
+        server.server_close()
 
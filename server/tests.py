@@ -1,12 +1,35 @@
 import os
+import glob
 import time
+import datetime
+import queue
 import unittest
 import subprocess
+import shutil
+import socket
+import urllib.request
 
+import threading
 from threading import Thread
+from unittest import mock
 
-from db import Database
-from clients import session, starter
+from db import Database, SessionBuffer, CredentialCache, HeatmapUpdater, encode_blob, decode_blob, split_chunks
+from clients import Client, session, starter, load, percentiles
+from server import AsyncTCPServer, ThreadedTCPServer, ThreadedTCPRequestHandler, SessionQueue, SharedUsers, session_writer, check_password
+from serverq import DBWriter, SpillQueue
+from metrics import Registry, ServerMetrics, MetricsServer
+from timers import TimerWheel
+from live import LiveHub
+from policy import IngestPolicy
+
+try:
+    import numpy
+    import analytics
+except ImportError:         # аналитика требует numpy, сервер - нет
+    numpy = None
+from protocol import (PROTO_TEXT, PROTO_BINARY, parse_event, encode_events, decode_records, split_frames,
+                      parse_greeting, greeting_version, frame, FRAME_DATA_INT, FRAME_HEADER, RECORD_INT,
+                      KEEP_ALIVE_FRAME, FINISHED_FRAME, ack_frame)
 
 SERVER = "server.py"
 TEST_DB = "./tests/test.db"
@@ -25,8 +48,9 @@ class TestDB(unittest.TestCase):
  
     @classmethod
     def tearDownClass(cls):
-        if os.path.isfile(TEST_DB):
-            os.remove(TEST_DB)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.isfile(TEST_DB + suffix):
+                os.remove(TEST_DB + suffix)
         if os.path.isfile("./session1.txt"):
             os.remove("./session1.txt")
 
@@ -48,6 +72,83 @@ class TestDB(unittest.TestCase):
             session = f.read()
         self.assertTrue(TestDB.session == session, "Stored data should be equal to dumped data")
 
+    def test_stream_session(self):
+        buffer = SessionBuffer(TestDB.user, chunk_size=40, flush_events=2)
+        for line in TestDB.session.split(b"\n")[:-1] * 10:
+            if buffer.append(line + b"\n"):
+                buffer.flush(TestDB.db)
+        buffer.close(TestDB.db)
+        chunks = TestDB.db.get_cursor().execute("SELECT COUNT(*) AS n FROM chunks WHERE session_id = ?", 
+                                                 (buffer.session_id, )).fetchone()
+        self.assertTrue(chunks.n > 1, "Session should be stored in several chunks")
+        self.assertTrue(TestDB.db.read_session(buffer.session_id) == TestDB.session * 10, 
+                        "Chunks should be joined into the original stream")
+        stored = TestDB.db.get_cursor().execute("SELECT data FROM chunks WHERE session_id = ?", 
+                                                 (buffer.session_id, )).fetchone()
+        self.assertTrue(stored.data.startswith(b"\x00"), "New chunks should be stored compressed")
+
+    def test_credential_cache(self):
+        cache = CredentialCache(Database(TEST_DB, pool_size=2), size=1, check_interval=0)
+        cache.get_user("test")
+        cache.get_user("test")
+        self.assertTrue(cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1, "Second login should hit cache")
+
+        TestDB.db.add_user("cached", "old")
+        TestDB.db.set_password("cached", "new")
+        self.assertTrue(check_password(cache.get_user("cached").hash, "new"), "Changed users should invalidate cache")
+        self.assertTrue(cache.stats()["size"] == 1, "Least recently used rows should be evicted")
+
+        class SlowDatabase:
+            def __init__(self):
+                self.started, self.release = threading.Event(), threading.Event()
+            def users_version(self):
+                return 0
+            def get_user(self, username):
+                if username == "slow":
+                    self.started.set()
+                    self.release.wait(5)
+                return username
+
+        cache = CredentialCache(SlowDatabase())
+        cache.get_user("fast")
+        slow = Thread(target=cache.get_user, args=("slow", ))
+        slow.start()
+        cache.db.started.wait(5)
+        start = time.monotonic()
+        self.assertTrue(cache.get_user("fast") == "fast" and cache.get_user("other") == "other" 
+                        and time.monotonic() - start < 1, "Lookups should not wait for a slow miss of another user")
+        cache.db.release.set()
+        slow.join()
+
+    def test_connection_pool(self):
+        db = Database(TEST_DB, pool_size=2)
+        rows = []
+        threads = [Thread(target=lambda: rows.append(db.get_user("user"))) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertTrue(len(rows) == 8 and all(r is not None for r in rows), "Pooled reads should work from many threads")
+        self.assertTrue(db.pool_opened <= 2, "Pool should not open more than pool_size readers")
+        self.assertTrue(len({type(r) for r in rows}) == 1, "Row class should be created once per column set")
+        db.close()
+
+    def test_codec(self):
+        for data in (TestDB.session, TestDB.session + b"1678134985570;2;0.5\n", b"1;2;+3\n", b"no newline", b""):
+            for compression in ("zlib", "lzma", None):
+                self.assertTrue(decode_blob(encode_blob(data, compression)) == data, "Codec should be lossless")
+        self.assertTrue(decode_blob(TestDB.session) == TestDB.session, "Old uncompressed rows should stay readable")
+
+    def test_typed_events(self):
+        db = Database(TEST_DB, index_events=True)
+        db.add_user("events", "password")
+        db.add_session("events", TestDB.session + b"1678134985570;2;0.5\nbroken line\n")
+        events = list(db.events("events"))
+        self.assertTrue(len(events) == 4, "Malformed lines should not get into events table")
+        self.assertTrue(events[-1].value == 0.5 and events[0].value == 1, "Values should keep numeric type")
+        events = list(db.events("events", code=2, t_from=1678134985561))
+        self.assertTrue([e.ts for e in events] == [1678134985570], "Events should be filtered by code and time")
+
 
 class TestServer(unittest.TestCase):
     
@@ -59,8 +160,9 @@ class TestServer(unittest.TestCase):
 
     @classmethod
     def setUpClass(self):
-        if os.path.isfile(TEST_DB):
-            os.remove(TEST_DB)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.isfile(TEST_DB + suffix):
+                os.remove(TEST_DB + suffix)
 
         for i in range(1, TestServer.N_clients + 1):
             if os.path.isfile(f"./session{i}.txt"):
@@ -72,8 +174,9 @@ class TestServer(unittest.TestCase):
 
     @classmethod
     def tearDownClass(cls):       
-        if os.path.isfile(TEST_DB):
-            os.remove(TEST_DB)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.isfile(TEST_DB + suffix):
+                os.remove(TEST_DB + suffix)
 
         for i in range(1, TestServer.N_clients + 1):
             if os.path.isfile(f"./session{i}.txt"):
@@ -119,5 +222,1058 @@ class TestServer(unittest.TestCase):
 
 
 
+class TestAsyncServer(unittest.TestCase):
+
+    N_clients = 5
+    HOST = "localhost"
+    PORT = 10230
+    DB = "./tests/test_async.db"
+
+    @classmethod
+    def setUpClass(cls):
+        if not os.path.isdir("./tests"):
+            os.mkdir("./tests")
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.isfile(cls.DB + suffix):
+                os.remove(cls.DB + suffix)
+
+        cls.server = AsyncTCPServer((cls.HOST, cls.PORT), db_path=os.path.abspath(cls.DB))
+        cls.thread = Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+        cls.server.ready.wait(5)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.thread.join(5)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.isfile(cls.DB + suffix):
+                os.remove(cls.DB + suffix)
+
+    def _run_clients(self, prefix, E, proto=PROTO_TEXT):
+        N = TestAsyncServer.N_clients
+
+        db = Database(TestAsyncServer.DB)
+
+        thread_pool = []
+        for i in range(N):
+            user, password = f"{prefix}{i}", "password"
+            db.add_user(user, password)
+            thread_pool.append(Thread(target=session, 
+                                      args=(user, password, TestAsyncServer.HOST, TestAsyncServer.PORT, E, True, proto)))
+        starter.clear()
+
+        for t in thread_pool:
+            t.start()
+
+        starter.set()
+
+        for t in thread_pool:
+            t.join()
+
+        deadline = time.time() + 5  # запись в БД идет асинхронно в пуле потоков сервера
+        while time.time() < deadline:
+            rows = [r for r in db.select_sessions() if r.user.startswith(prefix)]
+            blobs = [db.read_session(r.id) for r in rows]
+            if len(rows) == N and all([len(b.split(b"\n")) == E + 1 for b in blobs]):
+                break
+            time.sleep(0.1)
+        return blobs
+
+    def test_server(self):
+        E = 100
+        blobs = self._run_clients("user", E)
+        self.assertTrue(len(blobs) == TestAsyncServer.N_clients, "In DB should be dumps from all clients")
+        self.assertTrue(all([len(b.split(b"\n")) == E + 1 for b in blobs]), "Number of send and saved events must mutch")
+
+    def test_binary_protocol(self):
+        E = 1000
+        blobs = self._run_clients("binary", E, PROTO_BINARY)
+        self.assertTrue(len(blobs) == TestAsyncServer.N_clients, "In DB should be dumps from all clients")
+        self.assertTrue(all([len(b.split(b"\n")) == E + 1 for b in blobs]), "Number of send and saved events must mutch")
+        self.assertTrue(all([len(line.split(b";")) == 3 for b in blobs for line in b.split(b"\n")[:-1]]),
+                        "Binary events should be stored as text lines")
+
+    def test_non_ascii(self):
+        db = Database(TestAsyncServer.DB)
+        db.add_user("ascii", "password")
+        with socket.create_connection((TestAsyncServer.HOST, TestAsyncServer.PORT)) as sock:
+            sock.settimeout(5)
+            sock.sendall(b"\xffascii:password\n")
+            self.assertTrue(sock.recv(1024) == b"", "Non-ASCII greeting should be rejected")
+        with socket.create_connection((TestAsyncServer.HOST, TestAsyncServer.PORT)) as sock:
+            sock.settimeout(5)
+            sock.sendall(b"ascii:password\n1678134985526;1;1\n\xff;1;1\n1678134985527;2;\xe9\n1678134985528;3;3\n500\n")
+            self.assertTrue(sock.recv(1024) == b"200\n" and sock.recv(1024) == b"", "Session should survive non-ASCII lines")
+
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            rows = db.select_sessions("ascii")
+            if rows and db.read_session(rows[0].id):
+                break
+            time.sleep(0.1)
+        self.assertTrue(db.read_session(rows[0].id) == b"1678134985526;1;1\n1678134985528;3;3\n", "Non-ASCII lines should be dropped")
+        self.assertTrue("ascii" not in TestAsyncServer.server.users_online, "User should be able to log in again")
+
+    def test_load_generator(self):
+        stats, stored = load(Database(TestAsyncServer.DB), TestAsyncServer.HOST, TestAsyncServer.PORT, 
+                             sessions=50, events=100, proto=PROTO_BINARY, wait=5, prefix="load")
+        self.assertTrue(stats.sessions == 50 and stats.failed == 0, "All load sessions should finish")
+        self.assertTrue(stored == (50, 5000), "Server should persist all sessions and events of the load test")
+        self.assertTrue(len(stats.auth) == 50 and percentiles(stats.auth)[50] <= percentiles(stats.auth)[99])
+
+
+class TestWriter(unittest.TestCase):
+
+    DB = "./tests/test_writer.db"
+
+    def setUp(self):
+        if not os.path.isdir("./tests"):
+            os.mkdir("./tests")
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.isfile(self.DB + suffix):
+                os.remove(self.DB + suffix)
+        Database(self.DB)
+
+    def tearDown(self):
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.isfile(self.DB + suffix):
+                os.remove(self.DB + suffix)
+
+    def test_batches_and_drains_on_stop(self):
+        tasks = queue.Queue()
+        for i in range(100):
+            tasks.put(("user", 1, f"{i};1;1\n".encode("ascii")))
+
+        writer = DBWriter(Database(self.DB, pool_size=2), tasks, max_sessions=30)
+        writer.start()
+        writer.stop()
+
+        db = Database(self.DB)
+        rows = db.select_sessions()
+        self.assertTrue(len(rows) == 100, "All queued sessions should be saved before writer stops")
+        self.assertTrue(db.read_session(rows[-1].id) == b"99;1;1\n", "Sessions should be saved in queue order")
+        mode = db.get_cursor().execute("PRAGMA journal_mode").fetchone()
+        self.assertTrue(mode.journal_mode == "wal", "Writer should switch DB to WAL mode")
+
+    def test_failed_batch(self):
+        class FlakyDatabase(Database):
+            def add_sessions(self, sessions):
+                if any(username == "broken" for username, _ in sessions):
+                    raise ValueError("bad row")
+                super().add_sessions(sessions)
+
+        spill_dir = "./tests/spill_failed"
+        shutil.rmtree(spill_dir, ignore_errors=True)
+        tasks = SpillQueue(spill_dir)
+        for user in ("user", "broken", "test"):
+            tasks.put((user, 1, b"1;1;1\n"))
+        writer = DBWriter(FlakyDatabase(self.DB, pool_size=2), tasks)
+        writer.start()
+        writer.stop()
+
+        db = Database(self.DB)
+        users = [r.user for r in db.select_sessions()]
+        self.assertTrue(users == ["user", "test"], "One bad session should not sink the rest of the batch")
+        self.assertTrue(SpillQueue(spill_dir).stats()["spilled"] == 1, "Failed session should be kept on disk")
+        shutil.rmtree(spill_dir)
+
+    def test_stop_keeps_spill_files(self):
+        spill_dir = "./tests/spill_stop"
+        shutil.rmtree(spill_dir, ignore_errors=True)
+
+        class CheckedDatabase(Database):
+            def add_sessions(self, sessions):
+                files.append(len(os.listdir(spill_dir)))
+                super().add_sessions(sessions)
+
+        files = []
+        tasks = SpillQueue(spill_dir, max_bytes=0)
+        for i in range(4):
+            tasks.put_nowait(("user", 1, f"{i};1;1\n".encode("ascii")))
+        tasks = SpillQueue(spill_dir)           # после перезапуска все сессии очереди - в файлах
+        tasks.put(DBWriter.STOP)
+        writer = DBWriter(CheckedDatabase(self.DB, pool_size=2), tasks)
+        writer.start()
+        writer.join(5)
+
+        self.assertTrue(files == [3], "Spill files should be kept until the final batch is committed")
+        self.assertTrue(os.listdir(spill_dir) == [], "Spill files should be removed after the commit")
+        self.assertTrue(len(Database(self.DB).select_sessions()) == 3)
+        shutil.rmtree(spill_dir)
+
+    def test_spill_queue(self):
+        spill_dir = "./tests/spill"
+        shutil.rmtree(spill_dir, ignore_errors=True)
+        tasks = SpillQueue(spill_dir, max_bytes=20)
+        for i in range(10):
+            tasks.put_nowait(("user", 1, f"{i};1;1\n".encode("ascii")))
+        self.assertTrue(tasks.stats()["queued_bytes"] <= 20, "Queue should not hold more than max_bytes in memory")
+        self.assertTrue(tasks.stats()["spilled"] > 0 and tasks.pressure() > 1, "Overflow should go to spill directory")
+
+        first = [tasks.get()[2] for _ in range(5)]
+        self.assertTrue(len(os.listdir(spill_dir)) == 7, "Spill files should be kept until the write is acknowledged")
+        for _ in range(5):
+            tasks.task_done()
+        tasks.reject(("user", 1, b"failed;1;1\n"))
+        tasks = SpillQueue(spill_dir, max_bytes=20)     # после перезапуска файлы на диске подхватываются
+        tasks.put(None)
+        rest = []
+        while (task := tasks.get()) is not None:
+            rest.append(task[2])
+            tasks.task_done()
+        self.assertTrue(first + rest == [f"{i};1;1\n".encode("ascii") for i in range(10)] + [b"failed;1;1\n"], 
+                        "Sessions should be drained in order, rejected ones retried after restart")
+        self.assertTrue(os.listdir(spill_dir) == [], "Drained spill files should be removed")
+        os.rmdir(spill_dir)
+
+
+class TestWorkers(unittest.TestCase):
+
+    DB = "./tests/test_workers.db"
+
+    def tearDown(self):
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.isfile(self.DB + suffix):
+                os.remove(self.DB + suffix)
+
+    def test_session_queue(self):
+        if not os.path.isdir("./tests"):
+            os.mkdir("./tests")
+        tasks = queue.Queue()
+        store = SessionQueue(tasks)
+
+        data = b"".join(f"{1678134985526 + i};{i % 12};{i}\n".encode("ascii") for i in range(100))
+        buffer = SessionBuffer("user", chunk_size=256, flush_events=10)
+        for line in data.splitlines(keepends=True):
+            if buffer.append(line):
+                buffer.flush(store)
+        buffer.close(store)
+        SessionBuffer("test").close(store)      # сессия без валидных событий
+        tasks.put(None)
+
+        session_writer(self.DB, tasks)
+        db = Database(self.DB)
+        rows = db.select_sessions()
+        self.assertTrue([r.user for r in rows] == ["user", "test"], "Writer should create one session per key")
+        self.assertTrue(db.read_session(rows[0].id) == data, "Writer should rebuild the session from queued chunks")
+        self.assertTrue(db.read_session(rows[1].id) == b"", "Empty sessions should be saved too")
+
+
+    def test_failed_message(self):
+        if not os.path.isdir("./tests"):
+            os.mkdir("./tests")
+        tasks = queue.Queue()
+        key, other = (1, 0), (1, 1)
+        for task in (("open", key, "user", 0, None), ("chunks", key, "user", 0, [b"1;1;1\n"]), 
+                     ("chunks", other, "user", 0, None), ("chunks", key, "user", 1, [b"2;1;1\n"]), 
+                     ("close", key, None, 0, None), None):
+            tasks.put(task)
+        session_writer(self.DB, tasks)
+
+        db = Database(self.DB)
+        rows = db.select_sessions()
+        self.assertTrue(len(rows) == 1 and db.read_session(rows[0].id) == b"1;1;1\n2;1;1\n", 
+                        "Bad message should not drop the batch or split its sessions")
+
+        users = SharedUsers({})
+        logins = []
+        threads = [threading.Thread(target=lambda: logins.append(users.add("user"))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(sorted(logins) == [False] * 7 + [True], "Only one connection should log the user in")
+        self.assertTrue(users.release(os.getpid()) == ["user"] and "user" not in users, 
+                        "Users of an exited worker should be released")
+
+
+class TestProtocol(unittest.TestCase):
+
+    def test_roundtrip(self):
+        lines = [b"1678134985526;8;1\n", b"1678134985539;1;0.25\n", b"1678134985560;2;-7\n", 
+                 b"1678134985561;11;0.1\n", b"1678134985562;3;3000000000\n"]
+        frames, rest = split_frames(encode_events([parse_event(line.decode("ascii")) for line in lines]))
+        self.assertTrue(rest == b"", "All frames should be complete")
+        decoded = b"".join(decode_records(*frame)[0] for frame in frames)
+        self.assertTrue(decoded.split(b"\n")[:3] == b"".join(lines).split(b"\n")[:3], "Decoded lines should match sent lines")
+        self.assertTrue(decoded.endswith(b";3000000000.0\n"), "Values out of int32 range are sent as float64")
+
+    def test_greeting(self):
+        self.assertTrue(parse_greeting("user:password") == ("user", "password", {}))
+        self.assertTrue(greeting_version(parse_greeting("user:password:proto=2")[2]) == PROTO_BINARY)
+        self.assertTrue(greeting_version(parse_greeting("user:password:proto=9")[2]) is None)
+        self.assertTrue(parse_greeting("user") is None)
+
+class TestMetrics(unittest.TestCase):
+
+    def test_render(self):
+        registry = Registry()
+        events = registry.counter("events_total", "Events")
+        registry.gauge("online", "Users online", lambda: 3)
+        latency = registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1))
+        events.inc(5)
+        for value in (0.05, 0.5, 5):
+            latency.observe(value)
+
+        text = registry.render()
+        self.assertTrue("# TYPE events_total counter\nevents_total 5\n" in text, "Counter should be rendered")
+        self.assertTrue("online 3\n" in text, "Gauge should read its function")
+        self.assertTrue('latency_seconds_bucket{le="0.1"} 1\n' in text and 'latency_seconds_bucket{le="1"} 2\n' in text, 
+                        "Histogram buckets should be cumulative")
+        self.assertTrue('latency_seconds_bucket{le="+Inf"} 3\n' in text and "latency_seconds_count 3\n" in text)
+
+    def test_http(self):
+        metrics = ServerMetrics()
+        metrics.events.inc(42)
+        server = MetricsServer(("localhost", 10240), metrics).start()
+        try:
+            with urllib.request.urlopen("http://localhost:10240/metrics") as response:
+                text = response.read().decode("utf-8")
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertTrue("telemetry_events_total 42\n" in text, "Metrics should be served over HTTP")
+
+
+class TestIdle(unittest.TestCase):
+
+    DB = "./tests/test_idle.db"
+
+    def tearDown(self):
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.isfile(self.DB + suffix):
+                os.remove(self.DB + suffix)
+
+    def test_timer_wheel(self):
+        expired = []
+        wheel = TimerWheel(1, expired.append, tick=0.25)
+        start = wheel.now
+        wheel.add("idle")
+        wheel.add("busy")
+        wheel.add("gone")
+        wheel.remove("gone")
+        for i in range(1, 9):                   # 2 секунды, busy активен каждые 0.5 сек
+            if i % 2 == 0:
+                wheel.touch("busy")
+            wheel.advance(start + i * 0.25)
+            if i == 3:
+                self.assertTrue(expired == [], "Nothing should expire before timeout")
+        self.assertTrue(expired == ["idle"], "Only silent key should expire")
+        self.assertTrue(list(wheel.deadlines) == ["busy"], "Active key should stay in the wheel")
+
+    def test_close_idle_session(self):
+        if not os.path.isdir("./tests"):
+            os.mkdir("./tests")
+        ThreadedTCPServer.allow_reuse_address = True    # порт мог остаться в TIME_WAIT от прошлого запуска
+        server = ThreadedTCPServer(("localhost", 10250), ThreadedTCPRequestHandler, db_path=self.DB, idle_timeout=0.5)
+        Thread(target=server.serve_forever, daemon=True).start()
+        server.db.add_user("idle", "password")
+        try:
+            with socket.create_connection(("localhost", 10250)) as sock:
+                sock.sendall(b"idle:password\n1678134985526;1;1\n1678134985527;2;0.5\n")
+                sock.settimeout(5)
+                self.assertTrue(sock.recv(1024) == b"200\n", "Client should be accepted")
+                start = time.time()
+                self.assertTrue(sock.recv(1024) == b"", "Server should close silent connection")
+                self.assertTrue(time.time() - start < 2, "Connection should be closed after idle timeout")
+
+            deadline = time.time() + 5
+            while "idle" in server.users_online and time.time() < deadline:
+                time.sleep(0.05)
+            self.assertTrue("idle" not in server.users_online, "Closed user should be able to log in again")
+            row, = server.db.select_sessions("idle")
+            self.assertTrue(server.db.read_session(row.id) == b"1678134985526;1;1\n1678134985527;2;0.5\n",
+                            "Partial session should be saved")
+            self.assertTrue(server.metrics.idle_closed.value == 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_login_error_releases_user(self):
+        if not os.path.isdir("./tests"):
+            os.mkdir("./tests")
+        ThreadedTCPServer.allow_reuse_address = True
+        server = ThreadedTCPServer(("localhost", 10251), ThreadedTCPRequestHandler, db_path=self.DB)
+        Thread(target=server.serve_forever, daemon=True).start()
+        server.db.add_user("idle", "password")
+        observe = server.metrics.auth_seconds.observe
+        server.metrics.auth_seconds.observe = mock.Mock(side_effect=RuntimeError("metrics are down"))
+        try:
+            with mock.patch("sys.stderr"), socket.create_connection(("localhost", 10251)) as sock:
+                sock.sendall(b"idle:password\n")
+                sock.settimeout(5)
+                self.assertTrue(sock.recv(1024) == b"", "Failed login should close the connection")
+            self.assertTrue("idle" not in server.users_online, "Handler error should not leave the user online")
+            server.metrics.auth_seconds.observe = observe
+            with socket.create_connection(("localhost", 10251)) as sock:
+                sock.sendall(b"idle:password\n")
+                sock.settimeout(5)
+                self.assertTrue(sock.recv(1024) == b"200\n", "User should be able to log in after the error")
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class TestResume(unittest.TestCase):
+
+    DB = "./tests/test_resume.db"
+    EVENTS = [f"16781349855{i:02};{i % 12};{i}\n" for i in range(40)]
+
+    def setUp(self):
+        if not os.path.isdir("./tests"):
+            os.mkdir("./tests")
+        ThreadedTCPServer.allow_reuse_address = True
+        self.server = ThreadedTCPServer(("localhost", 10260), ThreadedTCPRequestHandler, db_path=self.DB, grace=5)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.isfile(self.DB + suffix):
+                os.remove(self.DB + suffix)
+
+    def wait_session(self, user):
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            rows = self.server.db.select_sessions(user)
+            if rows and user not in self.server.users_online:
+                return self.server.db.read_session(rows[0].id)
+            time.sleep(0.05)
+
+    def test_resume_after_drop(self):
+        self.server.db.add_user("resume", "password")
+        first, rest = "".join(self.EVENTS[:2]), "".join(self.EVENTS[2:3])
+        with socket.create_connection(("localhost", 10260)) as sock:
+            sock.settimeout(5)
+            sock.sendall(f"resume:password:resume\n{first}100\n".encode("ascii"))
+            lines = sock.makefile("rb")
+            code, _, options = lines.readline().decode("ascii").partition(" ")
+            self.assertTrue(code == "200" and options.startswith("token="), "Resumable session should get a token")
+            token = options.split()[0].partition("=")[2]
+            self.assertTrue(lines.readline() == b"100\n", "Keep-alive should be answered")
+            self.assertTrue(lines.readline() == b"300 2\n", "Keep-alive should be followed by ack")
+            lines.close()
+
+        deadline = time.time() + 5
+        while token not in self.server.suspended and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertTrue(token in self.server.suspended, "Dropped session should be suspended, not saved")
+
+        with socket.create_connection(("localhost", 10260)) as sock:
+            sock.settimeout(5)
+            sock.sendall(f"resume:password:token={token},offset=2\n".encode("ascii"))
+            self.assertTrue(sock.recv(1024) == f"200 token={token} offset=2\n".encode("ascii"), 
+                            "Session should be resumed from the acked offset")
+            sock.sendall(f"{rest}500\n".encode("ascii"))
+            self.assertTrue(sock.recv(1024) == b"", "Server should close finished session")
+
+        self.assertTrue(self.wait_session("resume") == (first + rest).encode("ascii"), 
+                        "Resumed session should be saved once with all events")
+        self.assertTrue(self.server.metrics.resumed.value == 1)
+
+    def test_client_reconnects(self):
+        self.server.db.add_user("reconnect", "password")
+
+        def stream():
+            for i, event in enumerate(self.EVENTS):
+                if i == len(self.EVENTS) // 2:
+                    client.sock.shutdown(socket.SHUT_RDWR)     # обрыв посреди сессии
+                yield event
+
+        client = Client("reconnect", "password", stream(), "localhost", 10260, timeout=0.1, resume=True)
+        client.connect()
+        self.assertTrue(self.wait_session("reconnect") == "".join(self.EVENTS).encode("ascii"), 
+                        "Client should resend unconfirmed events after reconnect")
+        self.assertTrue(self.server.metrics.resumed.value == 1)
+
+
+class TestBulkReceive(unittest.TestCase):
+
+    DB = "./tests/test_bulk.db"
+
+    def test_split_lines(self):
+        if not os.path.isdir("./tests"):
+            os.mkdir("./tests")
+        ThreadedTCPServer.allow_reuse_address = True
+        server = ThreadedTCPServer(("localhost", 10280), ThreadedTCPRequestHandler, db_path=self.DB)
+        Thread(target=server.serve_forever, daemon=True).start()
+        server.db.add_user("bulk", "password")
+        try:
+            with socket.create_connection(("localhost", 10280)) as sock:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sock.settimeout(5)
+                # строки и управляющие сообщения разрезаны между порциями
+                for part in (b"bulk:pass", b"word\n1678134985526;1;1\n1678134985527;2;0.5\n10",
+                             b"0\n1678134985528;3", b";3\nbad line\n\xff;1;1\n1678134985529;4;4", b"\n50", b"0\ntail;1;1\n"):
+                    sock.sendall(part)
+                    time.sleep(0.05)
+                self.assertTrue(sock.recv(1024) == b"200\n100\n", "Split KEEP_ALIVE should be answered")
+                self.assertTrue(sock.recv(1024) == b"", "Split FINISHED should finish the session")
+
+            deadline = time.time() + 5
+            while "bulk" in server.users_online and time.time() < deadline:
+                time.sleep(0.05)
+            row, = server.db.select_sessions("bulk")
+            self.assertTrue(server.db.read_session(row.id) == b"1678134985526;1;1\n1678134985527;2;0.5\n"
+                                                              b"1678134985528;3;3\n1678134985529;4;4\n",
+                            "Valid lines should be stored, data after FINISHED ignored")
+            self.assertTrue(server.metrics.events.value == 4)
+            self.assertTrue(server.metrics.malformed.value == 2)
+            self.assertTrue(server.metrics.keep_alives.value == 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.isfile(self.DB + suffix):
+                    os.remove(self.DB + suffix)
+
+    def test_split_frames(self):
+        if not os.path.isdir("./tests"):
+            os.mkdir("./tests")
+        reserved = []
+
+        class Handler(ThreadedTCPRequestHandler):
+            def _reserve(self, size):
+                reserved.append(size)
+                super()._reserve(size)
+
+        ThreadedTCPServer.allow_reuse_address = True
+        server = ThreadedTCPServer(("localhost", 10281), Handler, db_path=self.DB)
+        Thread(target=server.serve_forever, daemon=True).start()
+        server.db.add_user("bulk", "password")
+        small = frame(FRAME_DATA_INT, b"".join(RECORD_INT.pack(1678134985526 + i, 1, i) for i in range(3)))
+        large = frame(FRAME_DATA_INT, b"".join(RECORD_INT.pack(1678134985600 + i, 2, i) for i in range(6000)))
+        try:
+            with socket.create_connection(("localhost", 10281)) as sock:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sock.settimeout(5)
+                # KEEP_ALIVE и начало кадра в одной порции, кадр длиннее буфера приема - частями
+                for part in (b"bulk:password:proto=2\n" + KEEP_ALIVE_FRAME + small[:9], small[9:] + large[:3],
+                             large[3:40000], large[40000:] + FINISHED_FRAME):
+                    sock.sendall(part)
+                    time.sleep(0.05)
+                self.assertTrue(sock.recv(1024) == b"200\n" + KEEP_ALIVE_FRAME, "KEEP_ALIVE frame should be answered")
+                self.assertTrue(sock.recv(1024) == b"", "FINISHED frame should finish the session")
+
+            deadline = time.time() + 5
+            while "bulk" in server.users_online and time.time() < deadline:
+                time.sleep(0.05)
+            row, = server.db.select_sessions("bulk")
+            self.assertTrue(server.db.read_session(row.id).count(b"\n") == 6003, "All framed events should be stored")
+            self.assertTrue(max(reserved) == len(large), "Buffer should grow to the length of the pending frame only")
+
+            with socket.create_connection(("localhost", 10281)) as sock:
+                sock.settimeout(5)
+                sock.sendall(b"bulk:password:proto=2\n" + FRAME_HEADER.pack(1 << 30, FRAME_DATA_INT))
+                self.assertTrue(sock.recv(1024) == b"200\n" and sock.recv(1024) == b"", 
+                                "Oversized frame should close the connection")
+            deadline = time.time() + 5
+            while "bulk" in server.users_online and time.time() < deadline:
+                time.sleep(0.05)
+            self.assertTrue("bulk" not in server.users_online, "User should be able to log in again after a bad frame")
+        finally:
+            server.shutdown()
+            server.server_close()
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.isfile(self.DB + suffix):
+                    os.remove(self.DB + suffix)
+
+
+    def test_ack_frame(self):
+        """ACK шлет только сервер: такой кадр от клиента - ошибка протокола, а не сбой обработчика"""
+        if not os.path.isdir("./tests"):
+            os.mkdir("./tests")
+        data = frame(FRAME_DATA_INT, b"".join(RECORD_INT.pack(1678134985526 + i, 1, i) for i in range(3)))
+        for engine, port in (("thread", 10282), ("asyncio", 10283)):
+            if engine == "thread":
+                ThreadedTCPServer.allow_reuse_address = True
+                server = ThreadedTCPServer(("localhost", port), ThreadedTCPRequestHandler, db_path=self.DB)
+                Thread(target=server.serve_forever, daemon=True).start()
+            else:
+                server = AsyncTCPServer(("localhost", port), db_path=self.DB)
+                Thread(target=server.serve_forever, daemon=True).start()
+                server.ready.wait(5)
+            server.db.add_user("bulk", "password")
+            try:
+                with self.assertLogs(level="ERROR") as logs:
+                    with socket.create_connection(("localhost", port)) as sock:
+                        sock.settimeout(5)
+                        sock.sendall(b"bulk:password:proto=2\n" + data)
+                        time.sleep(0.1)
+                        sock.sendall(ack_frame(3))
+                        self.assertTrue(sock.recv(1024) == b"200\n" and sock.recv(1024) == b"", 
+                                        f"{engine}: ACK frame from client should close the connection")
+                    deadline = time.time() + 5
+                    while "bulk" in server.users_online and time.time() < deadline:
+                        time.sleep(0.05)
+                self.assertTrue(any("Unexpected frame type: 5" in line for line in logs.output) and 
+                                not any("Traceback" in line for line in logs.output),
+                                f"{engine}: ACK frame should be rejected as a protocol error")
+                self.assertTrue("bulk" not in server.users_online, f"{engine}: User should be released")
+                row, = server.db.select_sessions("bulk")
+                self.assertTrue(server.db.read_session(row.id).count(b"\n") == 3, 
+                                f"{engine}: Events before the bad frame should be stored")
+            finally:
+                server.shutdown()
+                if engine == "thread":
+                    server.server_close()
+                for suffix in ("", "-wal", "-shm"):
+                    if os.path.isfile(self.DB + suffix):
+                        os.remove(self.DB + suffix)
+
+class TestLive(unittest.TestCase):
+
+    DB = "./tests/test_live.db"
+
+    def test_ring_skips_for_slow_subscriber(self):
+        hub = LiveHub(capacity=4)
+        woken = []
+        ring = hub.open("slow")
+        hub.publish(ring, b"0;0;0\n")                  # подписчиков нет - в кольцо не пишется
+        subscription = hub.subscribe("slow", lambda: woken.append(1))
+        self.assertTrue(ring.watchers == 1 and ring.written == 0)
+        for i in range(1, 7):
+            hub.publish(ring, f"{i};1;{i}\n".encode("ascii"))
+        self.assertTrue(len(woken) == 6, "Publisher should wake the subscriber without waiting for it")
+        data, skipped = subscription.poll()
+        self.assertTrue(skipped == 2 and data == b"410 slow 2\nslow;3;1;3\nslow;4;1;4\nslow;5;1;5\nslow;6;1;6\n",
+                        "Overwritten records should be reported as skipped")
+        hub.publish(ring, b"7;1;7\n8;1;8\n", 2)
+        hub.close(ring)
+        data, skipped = subscription.poll()
+        self.assertTrue(data == b"slow;7;1;7\nslow;8;1;8\n500 slow\n" and skipped == 0)
+        hub.unsubscribe(subscription)
+        self.assertTrue(hub.subscriptions == () and subscription.poll() == (b"", 0))
+
+    def test_subscribe(self):
+        if not os.path.isdir("./tests"):
+            os.mkdir("./tests")
+        ThreadedTCPServer.allow_reuse_address = True
+        server = ThreadedTCPServer(("localhost", 10290), ThreadedTCPRequestHandler, db_path=self.DB)
+        Thread(target=server.serve_forever, daemon=True).start()
+        server.db.add_user("player", "password")
+        server.db.add_user("spectator", "password")
+        try:
+            with socket.create_connection(("localhost", 10290)) as watcher:
+                watcher.settimeout(5)
+                watcher.sendall(b"spectator:password:subscribe=player\n")
+                lines = watcher.makefile("rb")
+                self.assertTrue(lines.readline() == b"200\n", "Subscriber should be accepted")
+                deadline = time.time() + 5
+                while not server.live.subscriptions and time.time() < deadline:
+                    time.sleep(0.05)
+
+                with socket.create_connection(("localhost", 10290)) as player:
+                    player.sendall(b"player:password\n1678134985526;1;1\n1678134985527;2;0.5\n500\n")
+                    player.settimeout(5)
+                    self.assertTrue(player.recv(1024) == b"200\n")
+
+                received = []
+                while (line := lines.readline()) != b"500 player\n":
+                    if line != b"100\n":
+                        received.append(line)
+                self.assertTrue(received == [b"player;1678134985526;1;1\n", b"player;1678134985527;2;0.5\n"],
+                                "Subscriber should get the live stream of the session")
+                lines.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.isfile(self.DB + suffix):
+                    os.remove(self.DB + suffix)
+
+
+class TestPolicy(unittest.TestCase):
+
+    DB = "./tests/test_policy.db"
+    RULES = {"1": {"every": 3}, "2": {"min_interval": 10}, "3": {"min_change": 1}, "4": {"window": 100}}
+
+    def test_rules(self):
+        metrics = ServerMetrics()
+        session = IngestPolicy(self.RULES, metrics.policy_events).session()
+        lines = [f"{ts};1;{ts}\n" for ts in range(7)]                             # 0, 3, 6
+        lines += [f"{ts};2;0\n" for ts in (0, 5, 10, 12, 25)]                      # 0, 10, 25
+        lines += [f"{ts};3;{v}\n" for ts, v in ((0, 0), (1, 0.5), (2, 1), (3, 1.9))]   # 0, 2
+        lines += [f"{ts};4;{v}\n" for ts, v in ((0, 5), (10, 1), (20, 9), (30, 4), (40, 6), (150, 7))]
+        lines += ["0;5;5\n", "0;4;oops\n"]
+        data, events = session.apply("".join(lines).encode(), len(lines))
+        tail, tail_events = session.flush()
+        kept = (data + tail).decode().splitlines()
+        self.assertTrue(kept[:8] == ["0;1;0", "3;1;3", "6;1;6", "0;2;0", "10;2;0", "25;2;0", "0;3;0", "2;3;1"])
+        self.assertTrue(kept[8:] == ["10;4;1", "20;4;9", "40;4;6", "0;5;5", "0;4;oops", "150;4;7"],
+                        "Window should keep min, max and last event in time order")
+        self.assertTrue(events + tail_events == len(kept), "Event count should match the kept lines")
+        self.assertTrue(session.summary() == "1: 3/4, 2: 3/2, 3: 2/2, 4: 4/2")
+        text = metrics.render()
+        self.assertTrue('telemetry_policy_events_total{code="4",action="dropped"} 2' in text)
+        self.assertTrue('telemetry_policy_events_total{code="1",action="kept"} 3' in text)
+
+        with self.assertRaises(ValueError):
+            IngestPolicy({"1": {"window": 10, "every": 2}})
+        with self.assertRaises(ValueError):
+            IngestPolicy({"1": {"every": 0}})
+
+    def test_server_policy(self):
+        if not os.path.isdir("./tests"):
+            os.mkdir("./tests")
+        ThreadedTCPServer.allow_reuse_address = True
+        server = ThreadedTCPServer(("localhost", 10300), ThreadedTCPRequestHandler, db_path=self.DB, 
+                                   policy=IngestPolicy(self.RULES))
+        Thread(target=server.serve_forever, daemon=True).start()
+        server.db.add_user("policy", "password")
+        try:
+            events = "".join(f"16781349855{i:02};{i % 2};{i}\n" for i in range(20))
+            with socket.create_connection(("localhost", 10300)) as sock:
+                sock.sendall(f"policy:password\n{events}500\n".encode("ascii"))
+                sock.settimeout(5)
+                self.assertTrue(sock.recv(1024) == b"200\n")
+                self.assertTrue(sock.recv(1024) == b"", "Server should close finished session")
+
+            deadline = time.time() + 5
+            while "policy" in server.users_online and time.time() < deadline:
+                time.sleep(0.05)
+            row, = server.db.select_sessions("policy")
+            stored = server.db.read_session(row.id).decode().splitlines()
+            self.assertTrue([line.split(";")[2] for line in stored] == 
+                            ["0", "1", "2", "4", "6", "7", "8", "10", "12", "13", "14", "16", "18", "19"],
+                            "Every third event of code 1 should be stored")
+            self.assertTrue(server.metrics.events.value == 20, "Received events should be counted before the policy")
+            self.assertTrue(server.metrics.policy_events.values == {("1", "kept"): 4, ("1", "dropped"): 6})
+        finally:
+            server.shutdown()
+            server.server_close()
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.isfile(self.DB + suffix):
+                    os.remove(self.DB + suffix)
+
+
+class TestExport(unittest.TestCase):
+
+    DB = "./tests/test_export.db"
+    OUT = "./tests/export"
+
+    def tearDown(self):
+        shutil.rmtree(self.OUT, ignore_errors=True)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.isfile(self.DB + suffix):
+                os.remove(self.DB + suffix)
+
+    def test_export(self):
+        if not os.path.isdir("./tests"):
+            os.mkdir("./tests")
+        db = Database(self.DB, pool_size=2)
+        sessions = [b"".join(b"%d;%d;%d\n" % (1678134985526 + i, i % 12, i * n) for i in range(5000)) for n in range(3)]
+        with db.writer() as conn:                   # старый формат: сессия целиком в sessions.blob
+            conn.execute("INSERT INTO sessions (user, timestamp, blob) VALUES ('user', '2023-01-01 00:00:00', ?)", 
+                         (sessions[0], ))
+        db.add_session("user", sessions[1])
+        db.add_session("test", sessions[2])
+
+        self.assertTrue(b"".join(db.iter_session(1, block=1000)) == sessions[0], "Raw blob should be read by blocks")
+        self.assertTrue(max(len(d) for d in db.iter_session(1, block=1000)) == 1000)
+
+        archive = os.path.join(self.OUT, "user.txt")
+        os.mkdir(self.OUT)
+        self.assertTrue(db.export(archive, username="user")[0] == 2)
+        with open(archive, "rb") as f:
+            lines = f.read().split(b"\n")
+        self.assertTrue(lines[0] == b"# session 1 user 2023-01-01 00:00:00", "Archive should start with session header")
+        self.assertTrue(b"\n".join(l for l in lines if not l.startswith(b"#")) == sessions[0] + sessions[1], 
+                        "Archive should contain sessions in order")
+
+        count, size = db.export(self.OUT + "/files/", since="2024-01-01", jobs=2)
+        self.assertTrue(count == 2 and size == len(sessions[1]) + len(sessions[2]), "Only new sessions should be exported")
+        with open(os.path.join(self.OUT, "files", "session3.txt"), "rb") as f:
+            self.assertTrue(f.read() == sessions[2], "Exported file should be equal to stored session")
+        db.close()
+
+    def test_read_range(self):
+        if not os.path.isdir("./tests"):
+            os.mkdir("./tests")
+        db = Database(self.DB)
+        lines = [b"%d;%d;%d\n" % (1000 + i, i % 12, i) for i in range(1000)]
+        session_id, _ = db.add_chunks(None, 0, split_chunks(b"".join(lines), 1000), "user")
+        with db.writer() as conn:
+            conn.execute("INSERT INTO sessions (user, timestamp, blob) VALUES ('user', '2023-01-01 00:00:00', ?)", 
+                         (b"".join(lines[:100]), ))
+
+        ranges = db.get_cursor().execute("SELECT ts_min, ts_max FROM chunks WHERE session_id = ? ORDER BY seq", 
+                                         (session_id, )).fetchall()
+        self.assertTrue(ranges[0] == (1000, 1000 + len(split_chunks(b"".join(lines), 1000)[0].split(b"\n")) - 2), 
+                        "Chunk time range should be stored at ingest")
+
+        result = list(db.read_range("user", 1050, 1060, session_id=session_id))
+        self.assertTrue(b"".join(data for _, data in result) == b"".join(lines[50:61]), "Only events in range should be read")
+        self.assertTrue(len(result) == 1, "Only the chunk covering the range should be read")
+        result = list(db.read_range("user", 1095))
+        self.assertTrue([sid for sid, _ in result][0] == session_id + 1, "Legacy blob sessions should be scanned too")
+        self.assertTrue(b"".join(data for _, data in result) == b"".join(lines[95:100] + lines[95:]))
+        db.close()
+
+    def test_user_stats(self):
+        if not os.path.isdir("./tests"):
+            os.mkdir("./tests")
+        db = Database(self.DB)
+        db.add_session("user", b"1;1;1\n2;2;2\n")
+        db.add_session("user", b"3;3;3\n")
+        stats = db.user_stats("user")
+        self.assertTrue((stats.sessions, stats.events, stats.bytes) == (2, 3, 18), "Stats should be updated on add")
+        self.assertTrue(stats.first_seen <= stats.last_seen)
+        self.assertTrue(db.user_stats("test") is None and [r.user for r in db.user_stats()] == ["user"])
+
+        with db.writer() as conn:                   # файл БД до появления user_stats
+            conn.execute("INSERT INTO sessions (user, timestamp, blob) VALUES ('test', '2023-01-01 00:00:00', ?)", 
+                         (b"4;4;4\n", ))
+            conn.execute("DROP TABLE user_stats;")
+        db.close()
+        db = Database(self.DB)
+        self.assertTrue([(r.user, r.sessions, r.events) for r in db.user_stats()] == [("user", 2, 3), ("test", 1, 1)], 
+                        "Stats should be rebuilt for existing DB files")
+        self.assertTrue(db.user_stats("test").first_seen == "2023-01-01 00:00:00")
+        db.close()
+
+
+class TestHeatmap(unittest.TestCase):
+
+    DB = "./tests/test_heatmap.db"
+
+    def tearDown(self):
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.isfile(self.DB + suffix):
+                os.remove(self.DB + suffix)
+
+    def test_heatmap(self):
+        if not os.path.isdir("./tests"):
+            os.mkdir("./tests")
+        db = Database(self.DB)
+        # игрок идет по x с шагом 0.5 каждые 100 мс, между положениями - другие события
+        lines = [b"%d;0;%s\n%d;1;-0.5\n%d;2;3\n%d;8;1\n" % (100 * i, str(i / 2).encode(), 100 * i, 100 * i, 100 * i + 50)
+                 for i in range(10)]
+        session_id, seq = db.add_chunks(None, 0, [b"".join(lines[:5]), b"".join(lines[5:])], "user")
+        with db.writer() as conn:                   # старый формат: сессия целиком в sessions.blob
+            conn.execute("INSERT INTO sessions (user, timestamp, blob) VALUES ('test', '2023-01-01 00:00:00', ?)",
+                         (b"0;0;0.5\n0;1;0.5\n0;2;0.5\n5000;0;0.5\n", ))
+
+        self.assertTrue(db.update_heatmap() == 2 and db.update_heatmap() == 0, "Sessions should be processed once")
+        self.assertTrue([tuple(r) for r in db.heatmap("xy")] == [(0, -1, 1, 200), (0, 0, 1, 1000), (1, -1, 1, 200),
+                                                              (2, -1, 1, 200), (3, -1, 1, 200), (4, -1, 1, 100)],
+                        "Dwell should be credited until next position and capped by DWELL_MAX_GAP")
+
+        db.add_chunks(session_id, seq, [b"1000;0;9\n1000;1;-0.5\n1000;2;3\n"])
+        self.assertTrue(db.update_heatmap() == 1, "Only the session with new chunks should be updated")
+        self.assertTrue(db.region_stats((4, None, None), (5, None, None)) == (1, 1, 200),
+                        "Position pending at chunk end should continue in next chunk")
+        self.assertTrue(tuple(db.region_stats()) == (6, 6, 2000), "Last position of session has no dwell yet")
+        self.assertTrue([tuple(r) for r in db.heatmap("xz", (1, -1, 2.5), (None, -0.1, 3.5))] ==
+                        [(1, 3, 1, 200), (2, 3, 1, 200), (3, 3, 1, 200), (4, 3, 1, 200)],
+                        "Box limiting the third axis should be summed over the grid")
+
+        db.rebuild_heatmap(cell=2.0)
+        self.assertTrue(db.heatmap_cell() == 2.0 and tuple(db.region_stats()) == (4, 4, 2000), 
+                        "Rebuild should regrid all sessions")
+
+        db.rebuild_heatmap(codes=(8, 1, 2))         # x - из событий с кодом 8 (значение 1)
+        self.assertTrue(db.heatmap_codes() == (8, 1, 2) and db.heatmap_cell() == 2.0, "Position codes should be stored")
+        self.assertTrue([tuple(r) for r in db.heatmap("xy")] == [(0, -1, 1, 950)], 
+                        "Heatmap should be built from configured position codes")
+        with self.assertRaises(ValueError):
+            db.rebuild_heatmap(codes=(0, 1, 1))
+        db.close()
+
+    def test_update_outside_writer(self):
+        if not os.path.isdir("./tests"):
+            os.mkdir("./tests")
+        db = Database(self.DB, pool_size=2)
+        db.add_chunks(None, 0, [b"0;0;0.5\n0;1;0.5\n0;2;0.5\n100;0;1.5\n"], "user")
+        blocked = []
+        positions = db._session_positions
+
+        def parse(*args):
+            # пока данные разбираются, другой поток должен успеть записать сессию
+            writer = threading.Thread(target=db.add_chunks, args=(None, 0, [b"0;0;5\n0;1;5\n0;2;5\n"], "test"))
+            writer.start()
+            writer.join(5)
+            blocked.append(writer.is_alive())
+            yield from positions(*args)
+
+        db._session_positions = parse
+        self.assertTrue(db.update_heatmap() == 1 and blocked == [False], "Data should be parsed without the write lock")
+        db._session_positions = positions
+        with db.reader() as conn:
+            marks = dict(conn.execute("SELECT key, value FROM meta WHERE key LIKE 'heatmap_%:main';").fetchall())
+        self.assertTrue(marks == {"heatmap_chunk:main": 1, "heatmap_session:main": 0}, "Processed rows should be marked")
+        self.assertTrue(db.update_heatmap() == 1 and db.update_heatmap() == 0, "Only rows after the marks should be read")
+        with db.reader() as conn:
+            self.assertTrue(conn.execute("SELECT COUNT(*) AS n FROM heatmap_sessions;").fetchone()[0] == 2)
+        db.close()
+
+    def test_updater(self):
+        if not os.path.isdir("./tests"):
+            os.mkdir("./tests")
+        db = Database(self.DB, pool_size=2)
+        updater = HeatmapUpdater(db, interval=0.05).start()
+        session_id, seq = db.add_chunks(None, 0, [b"0;0;0.5\n0;1;0.5\n0;2;0.5\n100;0;1.5\n"], "user")
+        deadline = time.time() + 5
+        while updater.sessions < 1 and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertTrue(tuple(db.region_stats()) == (1, 1, 100), "Stored sessions should be added to heatmap periodically")
+
+        db.add_chunks(session_id, seq, [b"300;0;1.5\n"])
+        while updater.sessions < 2 and time.time() < deadline:
+            time.sleep(0.05)
+        updater.stop()
+        self.assertTrue(tuple(db.region_stats()) == (2, 2, 300), "Continued sessions should be updated incrementally")
+        db.close()
+
+
+class TestPartitions(unittest.TestCase):
+
+    DB = "./tests/test_partitions.db"
+
+    def tearDown(self):
+        for path in glob.glob(self.DB[:-len(".db")] + "*"):
+            os.remove(path)
+
+    def at(self, day):
+        """Часы БД на полдень дня day марта 2023"""
+        moment = datetime.datetime(2023, 3, day, 12)
+        clock = type("Clock", (datetime.datetime, ), {"now": classmethod(lambda cls, tz=None: moment)})
+        return mock.patch("datetime.datetime", clock)
+
+    def test_partitions(self):
+        if not os.path.isdir("./tests"):
+            os.mkdir("./tests")
+        db = Database(self.DB, partition="day")
+        with self.at(1):
+            db.add_session("user", b"1;1;1\n")
+        with self.at(2):
+            session_id, seq = db.add_chunks(None, 0, [b"2;1;1\n"], "user")
+            db.add_session("test", b"3;1;1\n")
+        with self.at(3):
+            db.add_session("user", b"4;1;1\n")
+            db.add_chunks(session_id, seq, [b"5;1;1\n"])
+        self.assertTrue([p[:2] for p in db.partitions()] == [("2023-03-01", 1), ("2023-03-02", 2), ("2023-03-03", 4)],
+                        "Session ids should continue across partitions")
+        self.assertTrue(all(os.path.isfile(p[2]) for p in db.partitions()), "Each partition should be a separate file")
+        self.assertTrue(db.read_session(2) == b"2;1;1\n5;1;1\n", "Chunks of a session should follow it to its partition")
+        self.assertTrue(db.read_session(4) == b"4;1;1\n" and db.read_session(99) is None)
+        self.assertTrue([r.id for r in db.select_sessions(since="2023-03-02", until="2023-03-03")] == [2, 3],
+                        "Only partitions overlapping the interval should be queried")
+        stats = db.user_stats("user")
+        self.assertTrue((stats.sessions, stats.events, str(stats.first_seen)) == (3, 4, "2023-03-01 12:00:00"),
+                        "User stats should be summed over partitions")
+        db.close()
+
+        db = Database(self.DB)
+        self.assertTrue(db.partition == "day", "Partition mode should be stored in the database")
+        self.assertTrue(db.drop_partitions("2023-03-02") == ["2023-03-01"], "Only ended partitions should be dropped")
+        self.assertTrue(not os.path.exists(db.partition_path("2023-03-01")) and db.read_session(1) is None)
+        self.assertTrue([r.sessions for r in db.user_stats()] == [2, 1], "Dropped sessions should leave the stats")
+        db.close()
+        with self.assertRaises(ValueError):
+            Database(self.DB, partition="month")
+
+    def test_writers(self):
+        if not os.path.isdir("./tests"):
+            os.mkdir("./tests")
+        db = Database(self.DB, partition="day", pool_size=2)
+        other = Database(self.DB)                   # второй процесс записи с тем же каталогом
+        with self.at(1):
+            db.add_session("user", b"1;1;1\n")
+            other.add_session("test", b"2;1;1\n")
+        with self.at(2):
+            other.add_user("player", "secret")
+            self.assertTrue([p[0] for p in db.partitions()] == ["2023-03-01"], 
+                            "Partitions should be created only when sessions are written")
+            db.add_session("user", b"3;1;1\n")
+        with self.at(1):                            # часы второго процесса отстают
+            other.add_session("test", b"4;1;1\n")
+        self.assertTrue([p[:2] for p in db.partitions()] == [("2023-03-01", 1), ("2023-03-02", 3)] 
+                        and db.read_session(4) == b"4;1;1\n", "Writer should follow partition created by another process")
+        other.close()
+
+        self.assertTrue(db.read_session(1) == b"1;1;1\n" and db.read_session(3) == b"3;1;1\n")
+        self.assertTrue(db.drop_partitions("2023-03-02") == ["2023-03-01"])
+        with db.reader() as conn:
+            attached = [row.name for row in conn.execute("PRAGMA database_list;")]
+        self.assertTrue("p_2023_03_01" not in attached, "Pooled readers should not keep dropped partitions")
+        self.assertTrue(db.read_session(3) == b"3;1;1\n")
+        db.close()
+        single = Database("./tests/test_partitions_single.db")
+        with self.assertRaises(ValueError):
+            single.drop_partitions("2023-03-02")
+        single.close()
+
+    def test_queries(self):
+        if not os.path.isdir("./tests"):
+            os.mkdir("./tests")
+        db = Database(self.DB, partition="day")
+        with self.at(1):
+            db.add_session("user", b"100;0;0.5\n100;1;0.5\n100;2;0.5\n200;0;0.5\n")
+        with self.at(2):
+            db.add_session("user", b"300;0;0.7\n300;1;0.2\n300;2;0.1\n600;0;3.5\n")
+        tables = {r.name for r in db.get_cursor().execute("SELECT name FROM main.sqlite_master WHERE type = 'table'")}
+        self.assertTrue(tables == {"users", "meta", "partitions", "sqlite_sequence"}, 
+                        "Catalog should keep no session data tables")
+
+        self.assertTrue(db.index_sessions() == 2 and db.index_sessions() == 0, "Sessions of all partitions should be indexed")
+        self.assertTrue([tuple(e) for e in db.events("user", code=0)] == 
+                        [(1, 100, 0, 0.5), (1, 200, 0, 0.5), (2, 300, 0, 0.7), (2, 600, 0, 3.5)],
+                        "Events should be read from all partitions in session order")
+        self.assertTrue(list(db.read_range("user", 150, 350)) == [(1, b"200;0;0.5\n"), (2, b"300;0;0.7\n300;1;0.2\n300;2;0.1\n")],
+                        "Range should be read from all partitions")
+        self.assertTrue(list(db.read_range("user", 150, 350, session_id=1)) == [(1, b"200;0;0.5\n")])
+
+        self.assertTrue(db.update_heatmap() == 2 and db.update_heatmap() == 0, "Sessions of all partitions should be mapped")
+        self.assertTrue([tuple(r) for r in db.heatmap("xy")] == [(0, 0, 2, 400)], "Partition maps should be summed")
+        self.assertTrue(tuple(db.region_stats()) == (1, 2, 400), "Cell visited in two partitions should count once")
+        self.assertTrue(db.rebuild_heatmap(cell=4.0) == 2, "Rebuild should reprocess sessions of all partitions")
+        self.assertTrue(tuple(db.region_stats()) == (1, 2, 400) and db.heatmap_cell() == 4.0, 
+                        "Rebuild should clear the maps of all partitions")
+        db.close()
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class TestAnalytics(unittest.TestCase):
+
+    DB = "./tests/test_analytics.db"
+
+    def tearDown(self):
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.isfile(self.DB + suffix):
+                os.remove(self.DB + suffix)
+
+    def test_decode(self):
+        data = b"".join(b"%d;%d;%r\n" % (1000 + 10 * i, i % 3, i / 4) if i % 2 else b"%d;%d;%d\n" % (1000 + 10 * i, i % 3, i) 
+                        for i in range(100))
+        text = analytics.text_to_array(data)
+        columns = analytics.blob_to_array(encode_blob(data))
+        self.assertTrue(len(text) == 100 and (text == columns).all(), "Columnar and text decoding should match")
+        self.assertTrue(len(analytics.text_to_array(data + b"bad line\n")) == 100, "Malformed lines should be skipped")
+        self.assertTrue((analytics.text_to_array(b"1;2\n3;4;5;6\n" + data) == text).all(), 
+                        "Lines with 2 and 4 fields should be skipped, not shift the columns")
+
+        stats = analytics.session_stats(text)
+        self.assertTrue(stats["duration"] == 990 and abs(stats["rate"] - 100 / 0.99) < 1e-9)
+        self.assertTrue(list(stats["codes"][:3]) == [34, 33, 33])
+        self.assertTrue(stats["intervals"].sum() == 99 and stats["max_interval"] == 10)
+
+    def test_analyze(self):
+        if not os.path.isdir("./tests"):
+            os.mkdir("./tests")
+        db = Database(self.DB)
+        for n in range(1, 6):
+            db.add_session("user", b"".join(b"%d;%d;%d\n" % (i * 100, n, i) for i in range(n * 10)))
+        ids = [s.id for s in db.select_sessions()]
+        for jobs in (1, 2):
+            summary = analytics.summarize(analytics.analyze(self.DB, ids, jobs))
+            self.assertTrue(summary["sessions"] == 5 and summary["events"] == 150)
+            self.assertTrue(summary["codes"] == {n: n * 10 for n in range(1, 6)}, "Events should be counted by code")
+            self.assertTrue(summary["duration"][50] == 2900, "Median session should last 29 intervals")
+        db.close()
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,94 @@
+"""Колесо таймеров для отслеживания простоя соединений.
+
+Одно колесо на сервер вместо таймера на соединение: колесо - кольцо из слотов по tick секунд,
+соединение кладется в слот, на который приходится его срок. Активность соединения (touch)
+только переписывает срок в словаре, без перекладывания между слотами, поэтому стоит O(1)
+и не требует системного вызова за временем: используется грубое время последнего тика.
+Когда колесо доходит до слота, соединения с истекшим сроком закрываются, остальные
+перекладываются в слот своего нового срока. Так десятки тысяч соединений обходятся
+одним потоком (или одним периодическим вызовом в цикле событий asyncio)"""
+
+import math
+import time
+import threading
+
+
+WHEEL_TICK      = 0.25      # разрешение колеса, сек: срок срабатывания точен до одного тика
+
+
+class TimerWheel:
+    """Колесо таймеров с одинаковым для всех ключей таймаутом timeout секунд.
+    on_expire(key) вызывается для ключей, по которым не было touch дольше timeout,
+    вызов идет вне блокировки, ключ к этому моменту уже удален из колеса"""
+
+    def __init__(self, timeout, on_expire, tick=WHEEL_TICK):
+        self.timeout = timeout
+        self.on_expire = on_expire
+        self.tick = tick
+        self.slots = [set() for _ in range(math.ceil(timeout / tick) + 2)]
+        self.deadlines = {}
+        self.position = 0
+        self.now = time.monotonic()
+        self.lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def _slot(self, deadline):
+        ticks = max(1, math.ceil((deadline - self.now) / self.tick))
+        return self.slots[(self.position + ticks) % len(self.slots)]
+
+    def add(self, key):
+        with self.lock:
+            deadline = self.now + self.timeout
+            self.deadlines[key] = deadline
+            self._slot(deadline).add(key)
+
+    def touch(self, key):
+        """Отмечает активность: сдвигает срок, слот не меняется (проверяется при проходе колеса). 
+        Под блокировкой: иначе срок, записанный параллельно с истечением ключа в advance, 
+        вернул бы ключ в словарь без слота"""
+        with self.lock:
+            if key in self.deadlines:
+                self.deadlines[key] = self.now + self.timeout
+
+    def remove(self, key):
+        """Ленивое удаление: запись в слоте выбрасывается, когда колесо до нее дойдет"""
+        with self.lock:
+            self.deadlines.pop(key, None)
+
+    def advance(self, now=None):
+        """Проворачивает колесо до момента now, возвращает список закрытых по таймауту ключей"""
+        now = time.monotonic() if now is None else now
+        expired = []
+        with self.lock:
+            steps = min(int((now - self.now) / self.tick), len(self.slots))
+            for _ in range(steps):
+                self.position = (self.position + 1) % len(self.slots)
+                self.now += self.tick
+                slot, self.slots[self.position] = self.slots[self.position], set()
+                for key in slot:
+                    deadline = self.deadlines.get(key)
+                    if deadline is None:
+                        continue
+                    if deadline <= self.now:
+                        del self.deadlines[key]
+                        expired.append(key)
+                    else:
+                        self._slot(deadline).add(key)
+            if now - self.now >= self.tick:     # долго не вызывали: все слоты уже пройдены
+                self.now = now
+
+        for key in expired:
+            self.on_expire(key)
+        return expired
+
+    def run(self):
+        while not self._stopped.wait(self.tick):
+            self.advance()
+
+    def start(self):
+        """Крутит колесо в фоновом потоке (для серверов с потоком на соединение)"""
+        threading.Thread(target=self.run, name="TimerWheel", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
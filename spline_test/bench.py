@@ -0,0 +1,127 @@
+"""Проверка точности и скорости spline.py на точках траектории из main.cpp.
+
+    точность    - сравнение со scipy.interpolate (CubicSpline и interp1d kind='cubic',
+                  если scipy установлен) и с выводом main.cpp (spline.json - 6 значащих цифр,
+                  ./main spline.traj - полная точность)
+    длина дуги  - с ломаной по плотной сетке и равномерность скорости после перепараметризации
+    скорость    - вычислений значений сплайна и t(s) в секунду
+
+    python3 bench.py [-n 10000000] [--reference spline.json|spline.traj]
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+import trajectory
+from spline import Spline, ArcLength
+
+
+T = [0.0, 0.055429223661391955, 0.11226802257450681, 0.16667266705943598, 0.22107731154436516,
+     0.2526429623849674, 0.28730604786617, 0.31645844615149604, 0.34755643186681057, 0.4019610763517397,
+     0.510770365321598, 0.565977087139274, 0.67438162843623, 0.8911907110301417, 1.0]
+X = [0.0, 4.0, 1.0, -3.0, -6.0, -4.0, -2.0, 0.0, 2.0, -1.0, -9.0, -12.0, -20.0, -8.0, 0.0]
+Y = [0.0, -3.0, -7.0, -4.0, -8.0, -9.5, -11.0, -12.0, -14.0, -18.0, -12.0, -16.0, -10.0, 6.0, 0.0]
+Z = [12.0, 13.1, 11.5, 11.0, 11.5, 13.0, 11.0, 12.5, 12.0, 11.5, 12.5, 11.5, 12.0, 13.0, 12.0]
+
+RMS_LIMIT       = 1e-10     # допустимое отклонение от scipy
+REFERENCE_LIMIT = 1e-4      # от вывода main.cpp: в spline.json 6 значащих цифр
+LENGTH_LIMIT    = 1e-8      # относительное отклонение длины дуги от ломаной
+SPEED_LIMIT     = 1e-5      # относительный разброс скорости после перепараметризации (по конечным разностям)
+POLYLINE_POINTS = 10_000_001
+
+
+def rms(a, b):
+    return float(np.sqrt(np.mean((a - b) ** 2)))
+
+
+def check(name, value, limit):
+    ok = value <= limit
+    print(f"{name:<40} {value:.3e}  {'ok' if ok else f'FAIL (> {limit:g})'}")
+    return ok
+
+
+def timed(func, *args, repeat=3):
+    """Лучшее время из repeat вызовов, секунд"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def accuracy(spline, reference):
+    ok = True
+    x = np.linspace(0, 1, 1_000_001)
+    try:
+        from scipy.interpolate import CubicSpline, interp1d
+    except ImportError:
+        print("scipy is not installed, comparison skipped")
+    else:
+        points = np.column_stack([X, Y, Z])
+        ok &= check("RMS vs scipy CubicSpline", rms(spline(x), CubicSpline(T, points)(x)), RMS_LIMIT)
+        ok &= check("RMS vs scipy interp1d(kind='cubic')",
+                    rms(spline(x), interp1d(T, points, kind="cubic", axis=0)(x)), RMS_LIMIT)
+        ok &= check("RMS vs scipy CubicSpline, 1st derivative",
+                    rms(spline(x, nu=1), CubicSpline(T, points)(x, 1)), RMS_LIMIT * 100)
+
+    if os.path.exists(reference):
+        t, xyz = trajectory.load(reference)
+        ok &= check(f"max error vs {os.path.basename(reference)} (main.cpp)",
+                    float(np.max(np.abs(spline(t) - xyz))), REFERENCE_LIMIT)
+    return ok
+
+
+def arc_length(spline):
+    ok = True
+    arc = ArcLength(spline)
+    polyline = np.linalg.norm(np.diff(spline(np.linspace(0, 1, POLYLINE_POINTS)), axis=0), axis=1).sum()
+    print(f"{'arc length':<40} {arc.length:.10f}")
+    ok &= check("arc length vs polyline (relative)", abs(arc.length - polyline) / arc.length, LENGTH_LIMIT)
+
+    s = np.linspace(0, arc.length, 100_001)
+    t = arc.time(s)
+    ok &= check("max |s(t(s)) - s|", float(np.max(np.abs(arc.length_at(t) - s))), LENGTH_LIMIT * arc.length)
+    speed = spline.speed(t) * np.gradient(t, s)
+    ok &= check("constant speed spread (relative)", float(np.ptp(speed[1:-1]) / np.mean(speed)), SPEED_LIMIT)
+    return ok
+
+
+def throughput(spline, n):
+    arc = ArcLength(spline)
+    x = np.random.default_rng(1).random(n)
+    s = x * arc.length
+    print(f"{'fit 15 knots x 3 coordinates':<40} {timed(Spline, T, np.column_stack([X, Y, Z])) * 1e6:.0f} us")
+    print(f"{'arc length table':<40} {timed(ArcLength, spline) * 1e3:.2f} ms")
+    for name, func, arg in (("evaluate", spline, x),
+                            ("1st derivative", lambda x: spline(x, nu=1), x),
+                            ("t(s)", arc.time, s)):
+        seconds = timed(func, arg)
+        print(f"{name + f' ({n:,} points)':<40} {seconds:.3f} s, {n / seconds / 1e6:.1f} M points/s")
+
+    try:
+        from scipy.interpolate import CubicSpline
+    except ImportError:
+        return
+    reference = CubicSpline(T, np.column_stack([X, Y, Z]))
+    seconds = timed(reference, x)
+    print(f"{f'scipy CubicSpline ({n:,} points)':<40} {seconds:.3f} s, {n / seconds / 1e6:.1f} M points/s")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Spline accuracy and throughput benchmark.')
+    parser.add_argument('-n', type=int, default=10_000_000, help=f"Points per throughput run (default: 10000000)")
+    parser.add_argument("--reference", type=str, default=os.path.join(os.path.dirname(__file__) or ".", "spline.json"),
+                        help=f"main.cpp output to compare with, JSON or .traj (default: spline.json)")
+    args = parser.parse_args()
+
+    spline = Spline(T, np.column_stack([X, Y, Z]))
+    ok = accuracy(spline, args.reference)
+    ok &= arc_length(spline)
+    throughput(spline, args.n)
+    sys.exit(0 if ok else 1)
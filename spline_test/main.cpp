@@ -1,10 +1,31 @@
 #include <iostream>
 #include <fstream>
+#include <string>
 #include <vector>
+#include <cstdint>
 #include "spline.h"
 
 
-int main() {
+// двоичный формат траектории (см. trajectory.py): заголовок 32 байта, затем столбцы
+// float64 t[n], x[n], y[n], z[n]; числа пишутся в порядке байт машины (little endian на x86/ARM)
+struct TrajHeader {
+    char magic[4] = {'T', 'R', 'A', 'J'};
+    uint16_t version = 1;
+    uint16_t columns = 4;
+    uint64_t n = 0;
+    char reserved[16] = {};
+};
+static_assert(sizeof(TrajHeader) == 32, "trajectory header must be 32 bytes");
+
+bool ends_with(const std::string& s, const std::string& suffix) {
+    return s.size() >= suffix.size() && s.compare(s.size() - suffix.size(), suffix.size(), suffix) == 0;
+}
+
+
+int main(int argc, char* argv[]) {
+    // путь вывода: spline.json по умолчанию, *.traj - двоичный формат
+    std::string path = argc > 1 ? argv[1] : "spline.json";
+
     const int N = 15;
     double T[N] = {0.0,0.055429223661391955,0.11226802257450681,0.16667266705943598,0.22107731154436516,0.2526429623849674,0.28730604786617,0.31645844615149604,0.34755643186681057,0.4019610763517397,0.510770365321598,0.565977087139274,0.67438162843623,0.8911907110301417,1.0};
     double X[N] = {0.0,4.0,1.0,-3.0,-6.0,-4.0,-2.0,0.0,2.0,-1.0,-9.0,-12.0,-20.0,-8.0,0.0};
@@ -32,7 +53,24 @@ int main() {
     int n = N * 50 - 1; // 50 семплов на сегмент
     double dt = double(1) / n;
 
-    std::ofstream out("spline.json");
+    if (ends_with(path, ".traj")) {
+        std::vector<double> columns[4];
+        for (int i = 0; i <= n; ++i) {
+            columns[0].push_back(dt * i);
+            columns[1].push_back(sx(dt * i));
+            columns[2].push_back(sy(dt * i));
+            columns[3].push_back(sz(dt * i));
+        }
+        TrajHeader header;
+        header.n = n + 1;
+        std::ofstream out(path, std::ios::binary);
+        out.write(reinterpret_cast<const char*>(&header), sizeof(header));
+        for (auto& column : columns)
+            out.write(reinterpret_cast<const char*>(column.data()), column.size() * sizeof(double));
+        return out ? 0 : 1;
+    }
+
+    std::ofstream out(path);
 
     out <<     "[\n";
     for (int i = 0; i <= n; ++i) {
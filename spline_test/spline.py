@@ -0,0 +1,218 @@
+"""Кубические сплайны траекторий и равномерное движение по ним на NumPy.
+
+Тот же сплайн, что `spline.h` с граничными условиями not_a_knot (и `scipy.interpolate.
+interp1d(t, x, kind='cubic')`), сразу для всех координат x(t), y(t), z(t): наклоны в узлах
+находятся одним проходом прогонки по трехдиагональной системе, векторизованной по координатам,
+значения и производные считаются для массива параметров за один вызов (миллионы точек)
+кусками по CHUNK точек, чтобы промежуточные массивы оставались в кэше процессора.
+
+Для движения с постоянной скоростью строится таблица длины дуги s(t): каждый сегмент
+делится на subdivisions частей, длина части считается квадратурой Гаусса-Лежандра
+от |r'(t)|. Обратная функция t(s) - поиск части в таблице, начальное приближение по
+эрмитовой интерполяции (dt/ds = 1/|r'|) и шаги Ньютона с той же квадратурой.
+
+    python3 spline.py trajectory.json -n 1000 -o uniform.json   # точки с постоянной скоростью (или .traj)
+"""
+
+import sys
+import json
+import argparse
+
+import numpy as np
+
+import trajectory
+
+
+GAUSS_ORDER         = 8         # узлов квадратуры Гаусса-Лежандра на часть сегмента в таблице
+NEWTON_ORDER        = 5         # узлов квадратуры на шаге Ньютона (отрезок внутри части)
+ARC_SUBDIVISIONS    = 64        # частей сегмента в таблице длины дуги
+NEWTON_STEPS        = 1         # уточнений t(s) методом Ньютона: эрмитово приближение ~1e-6 -> ~1e-13
+MIN_SPEED           = 1e-12     # ниже считаем, что объект стоит, и Ньютон не шагает
+CHUNK               = 1 << 14   # точек, вычисляемых за один проход
+
+LEGENDRE = {order: np.polynomial.legendre.leggauss(order) for order in (GAUSS_ORDER, NEWTON_ORDER)}
+
+
+def solve_tridiagonal(lower, diag, upper, rhs):
+    """Прогонка (алгоритм Томаса): lower, diag, upper - диагонали (n), lower[0] и upper[-1]
+    не используются, rhs - (n) или (n, d), все столбцы правой части решаются одновременно"""
+    n = len(diag)
+    c = np.empty(n)
+    d = np.empty(rhs.shape)
+    c[0] = upper[0] / diag[0]
+    d[0] = rhs[0] / diag[0]
+    for i in range(1, n):
+        denom = diag[i] - lower[i] * c[i - 1]
+        c[i] = upper[i] / denom if i < n - 1 else 0.0
+        d[i] = (rhs[i] - lower[i] * d[i - 1]) / denom
+    for i in range(n - 2, -1, -1):
+        d[i] -= c[i] * d[i + 1]
+    return d
+
+
+class Spline:
+    """Кубический сплайн с условием not-a-knot на обоих концах: t - возрастающие узлы (n >= 4),
+    points - значения в узлах, (n) или (n, d) для d координат сразу"""
+
+    def __init__(self, t, points):
+        t = np.asarray(t, dtype=np.float64)
+        y = np.asarray(points, dtype=np.float64)
+        self.scalar = y.ndim == 1
+        if self.scalar:
+            y = y[:, None]
+        if len(t) < 4 or len(t) != len(y):
+            raise ValueError(f"Need at least 4 knots and one point per knot, got {len(t)} knots, {len(y)} points")
+        h = np.diff(t)
+        if np.any(h <= 0):
+            raise ValueError("Knots must be strictly increasing")
+
+        m = np.diff(y, axis=0) / h[:, None]          # наклоны хорд
+        n = len(t)
+        lower, diag, upper = np.empty(n), np.empty(n), np.empty(n)
+        rhs = np.empty((n, y.shape[1]))
+
+        # внутренние узлы: непрерывность второй производной
+        lower[1:-1] = h[1:]
+        diag[1:-1] = 2 * (h[:-1] + h[1:])
+        upper[1:-1] = h[:-1]
+        rhs[1:-1] = 3 * (h[1:, None] * m[:-1] + h[:-1, None] * m[1:])
+
+        # not-a-knot: третья производная непрерывна во втором и предпоследнем узле
+        diag[0], upper[0] = h[1], h[0] + h[1]
+        rhs[0] = ((h[0] + 2 * upper[0]) * h[1] * m[0] + h[0] ** 2 * m[1]) / upper[0]
+        lower[-1], diag[-1] = h[-1] + h[-2], h[-2]
+        rhs[-1] = (h[-1] ** 2 * m[-2] + (2 * lower[-1] + h[-1]) * h[-2] * m[-1]) / lower[-1]
+
+        slopes = solve_tridiagonal(lower, diag, upper, rhs)
+
+        # коэффициенты сегментов: y = c0 + c1 dx + c2 dx^2 + c3 dx^3, dx = x - t[i],
+        # лежат рядом (сегмент, степень, координата), чтобы выбираться одной операцией
+        hh = h[:, None]
+        self.t = t
+        self.coeffs = np.stack([y[:-1], slopes[:-1],
+                                (3 * m - 2 * slopes[:-1] - slopes[1:]) / hh,
+                                (slopes[:-1] + slopes[1:] - 2 * m) / hh ** 2], axis=1)
+        self.derivatives = [self.coeffs,
+                            self.coeffs[:, 1:] * np.array([1.0, 2.0, 3.0])[:, None],
+                            self.coeffs[:, 2:] * np.array([2.0, 6.0])[:, None]]
+
+    @classmethod
+    def load(cls, path):
+        """Сплайн по файлу траектории: JSON {"t": ..., "xyz": [x, y, z]} или .traj (trajectory.py)"""
+        return cls(*trajectory.load(path))
+
+    def segments(self, x):
+        """Номера сегментов и смещения dx от их начала для массива параметров"""
+        index = np.searchsorted(self.t, x, side="right") - 1
+        np.clip(index, 0, len(self.t) - 2, out=index)
+        return index, x - self.t[index]
+
+    def __call__(self, x, nu=0):
+        """Значения (nu=0), первые (nu=1) или вторые (nu=2) производные в точках x: (m, d)
+        или (m) для скалярного сплайна. За пределами [t0, tn] сплайн продолжается крайними
+        кубиками, как interp1d(..., fill_value="extrapolate")"""
+        if nu not in (0, 1, 2):
+            raise ValueError(f"Derivative order {nu} not supported")
+        coeffs = self.derivatives[nu]
+        x = np.asarray(x, dtype=np.float64)
+        flat = x.ravel()
+        out = np.empty((flat.size, coeffs.shape[2]))
+        for start in range(0, flat.size, CHUNK):
+            index, dx = self.segments(flat[start:start + CHUNK])
+            dx = dx[:, None]
+            c = coeffs[index]                   # (точки, степень, координата)
+            value = out[start:start + CHUNK]
+            np.copyto(value, c[:, -1])
+            for k in range(c.shape[1] - 2, -1, -1):     # схема Горнера
+                value *= dx
+                value += c[:, k]
+        out = out.reshape(x.shape + (out.shape[1], ))
+        return out[..., 0] if self.scalar else out
+
+    def speed(self, x):
+        """|r'(x)| - скорость движения по кривой при равномерном изменении параметра"""
+        v = self(x, nu=1).reshape(np.size(x), -1)
+        return np.sqrt(np.einsum("ij,ij->i", v, v)).reshape(np.shape(x))
+
+
+class ArcLength:
+    """Таблица длины дуги сплайна и перепараметризация по длине (постоянная скорость)"""
+
+    def __init__(self, spline, subdivisions=ARC_SUBDIVISIONS):
+        self.spline = spline
+        parts = np.linspace(0, 1, subdivisions + 1)
+        knots = spline.t
+        self.t = np.concatenate([knots[:-1, None] + np.diff(knots)[:, None] * parts[:-1], knots[-1:, None]], axis=None)
+        self.s = np.concatenate([[0.0], np.cumsum(self._integrate(self.t[:-1], self.t[1:]))])
+        self.speeds = spline.speed(self.t)
+        self.length = self.s[-1]
+
+    def _integrate(self, a, b, order=GAUSS_ORDER):
+        """Длины дуги на отрезках [a, b] (массивы) квадратурой Гаусса-Лежандра"""
+        nodes, weights = LEGENDRE[order]
+        half = (b - a) / 2
+        x = (a + b)[:, None] / 2 + half[:, None] * nodes
+        return half * (self.spline.speed(x) @ weights)
+
+    def length_at(self, t):
+        """s(t) - длина дуги от начала кривой до параметра t"""
+        t = np.clip(np.asarray(t, dtype=np.float64), self.t[0], self.t[-1])
+        flat = t.ravel()
+        j = np.clip(np.searchsorted(self.t, flat, side="right") - 1, 0, len(self.t) - 2)
+        return (self.s[j] + self._integrate(self.t[j], flat)).reshape(t.shape)
+
+    def time(self, s, steps=NEWTON_STEPS):
+        """t(s) - параметр точки на длине дуги s от начала (массив)"""
+        s = np.clip(np.asarray(s, dtype=np.float64), 0, self.length)
+        flat = s.ravel()
+        t = np.empty(flat.size)
+        for start in range(0, flat.size, CHUNK):
+            t[start:start + CHUNK] = self._time(flat[start:start + CHUNK], steps)
+        return t.reshape(s.shape)
+
+    def _time(self, s, steps):
+        j = np.clip(np.searchsorted(self.s, s, side="right") - 1, 0, len(self.s) - 2)
+        t0, t1 = self.t[j], self.t[j + 1]
+        ds = self.s[j + 1] - self.s[j]
+
+        # кубическая эрмитова интерполяция t(s) на части таблицы, dt/ds = 1/|r'(t)|
+        with np.errstate(divide="ignore", invalid="ignore"):
+            u = np.where(ds > 0, (s - self.s[j]) / ds, 0.0)
+            d0 = np.where(self.speeds[j] > MIN_SPEED, ds / self.speeds[j], t1 - t0)
+            d1 = np.where(self.speeds[j + 1] > MIN_SPEED, ds / self.speeds[j + 1], t1 - t0)
+        u2, u3 = u * u, u * u * u
+        t = (t0 * (2 * u3 - 3 * u2 + 1) + d0 * (u3 - 2 * u2 + u)
+             + t1 * (-2 * u3 + 3 * u2) + d1 * (u3 - u2))
+        np.clip(t, t0, t1, out=t)
+
+        for _ in range(steps):
+            error = self.s[j] + self._integrate(t0, t, NEWTON_ORDER) - s
+            speed = self.spline.speed(t)
+            step = np.divide(error, speed, out=np.zeros_like(error), where=speed > MIN_SPEED)
+            t = np.clip(t - step, t0, t1)
+        return t
+
+    def uniform(self, n):
+        """n значений параметра, делящих кривую на равные по длине части"""
+        return self.time(np.linspace(0, self.length, n))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Constant speed sampling of a trajectory spline.')
+    parser.add_argument("trajectory", type=str, help="Trajectory: JSON [{\"t\": ..., \"xyz\": [x, y, z]}, ...] or .traj")
+    parser.add_argument('-n', type=int, default=1000, help=f"Number of points (default: 1000)")
+    parser.add_argument('-o', "--out", type=str, help=f"Output JSON or .traj (default: JSON to stdout)")
+    args = parser.parse_args()
+
+    spline = Spline.load(args.trajectory)
+    arc = ArcLength(spline)
+    t = arc.uniform(args.n)
+
+    if args.out and args.out.endswith(trajectory.EXTENSION):
+        trajectory.write(args.out, t, spline(t))
+    else:
+        points = [{"t": ti, "xyz": xyz} for ti, xyz in zip(t.tolist(), spline(t).tolist())]
+        out = open(args.out, "w") if args.out else sys.stdout
+        json.dump(points, out, indent=4)
+    print(f"Length {arc.length:.6f}, {args.n} points", file=sys.stderr)
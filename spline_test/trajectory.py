@@ -0,0 +1,108 @@
+"""Двоичный формат траекторий, открываемый через numpy.memmap без копирования.
+
+JSON траектории (`[{"t": ..., "xyz": [x, y, z]}, ...]`, как trajectory.json и вывод main.cpp)
+для плотных траекторий медленно разбирается и занимает много памяти: каждая точка - словарь
+и список чисел. В двоичном файле (.traj) после заголовка лежат подряд столбцы float64 (little
+endian) t[n], x[n], y[n], z[n]:
+
+    смещение  размер
+    0         4       магическое число b"TRAJ"
+    4         2       версия формата (uint16, 1)
+    6         2       столбцов (uint16, 4: t, x, y, z)
+    8         8       точек n (uint64)
+    16        16      зарезервировано (нули), данные начинаются с 32 - выравнивание на 8
+    32        8*n*4   столбцы t, x, y, z
+
+load() возвращает t (n) и xyz (n, 3) как представления отображенного в память файла,
+данные читаются с диска только при обращении к ним. main.cpp пишет этот формат сам,
+если имя выходного файла заканчивается на .traj.
+
+    python3 trajectory.py spline.json spline.traj    # JSON -> .traj
+    python3 trajectory.py spline.traj out.json       # .traj -> JSON
+"""
+
+import os
+import json
+import struct
+import argparse
+
+import numpy as np
+
+
+MAGIC       = b"TRAJ"
+VERSION     = 1
+COLUMNS     = 4         # t, x, y, z
+EXTENSION   = ".traj"
+
+HEADER      = struct.Struct("<4sHHQ16x")        # 32 байта
+DTYPE       = np.dtype("<f8")
+
+
+def write(path, t, xyz):
+    """Записывает траекторию: t - (n), xyz - (n, 3)"""
+    t = np.asarray(t, dtype=DTYPE)
+    xyz = np.asarray(xyz, dtype=DTYPE)
+    if t.ndim != 1 or xyz.shape != (len(t), COLUMNS - 1):
+        raise ValueError(f"Expected t (n) and xyz (n, {COLUMNS - 1}), got {t.shape} and {xyz.shape}")
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, COLUMNS, len(t)))
+        t.tofile(f)
+        for column in xyz.T:
+            np.ascontiguousarray(column).tofile(f)
+
+
+def load(path, mode="r"):
+    """Открывает .traj через memmap, возвращает (t, xyz) - представления файла без копирования
+    (mode="r+" - с возможностью записи в файл). JSON траектории тоже читаются (с копированием)"""
+    with open(path, "rb") as f:
+        header = f.read(HEADER.size)
+    if header[:len(MAGIC)] != MAGIC:
+        return load_json(path)
+    if len(header) < HEADER.size:
+        raise ValueError(f"{path}: truncated header")
+    _, version, columns, n = HEADER.unpack(header)
+    if version != VERSION or columns != COLUMNS:
+        raise ValueError(f"{path}: unsupported version {version} or columns {columns}")
+    expected = HEADER.size + n * columns * DTYPE.itemsize
+    if os.path.getsize(path) < expected:
+        raise ValueError(f"{path}: {os.path.getsize(path)} bytes, {expected} expected for {n} points")
+    if n == 0:
+        return np.empty(0, DTYPE), np.empty((0, columns - 1), DTYPE)
+    data = np.memmap(path, DTYPE, mode, offset=HEADER.size, shape=(columns, n))
+    return data[0], data[1:].T
+
+
+def load_json(path):
+    with open(path) as f:
+        trajectory = json.load(f)
+    t = np.array([p["t"] for p in trajectory], dtype=DTYPE)
+    xyz = np.array([p["xyz"] for p in trajectory], dtype=DTYPE).reshape(len(t), COLUMNS - 1)
+    return t, xyz
+
+
+def save_json(path, t, xyz):
+    """Записывает траекторию в JSON в том же виде, что trajectory.json"""
+    points = [{"t": ti, "xyz": p} for ti, p in zip(np.asarray(t).tolist(), np.asarray(xyz).tolist())]
+    with open(path, "w") as f:
+        json.dump(points, f, indent=4)
+
+
+def convert(source, target):
+    """JSON <-> .traj, направление - по расширению target; возвращает число точек"""
+    t, xyz = load(source)
+    if target.endswith(EXTENSION):
+        write(target, t, xyz)
+    else:
+        save_json(target, t, xyz)
+    return len(t)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Convert trajectories between JSON and binary .traj format.')
+    parser.add_argument("source", type=str, help="Input trajectory (JSON or .traj, detected by content)")
+    parser.add_argument("target", type=str, help=f"Output trajectory ({EXTENSION} - binary, otherwise JSON)")
+    args = parser.parse_args()
+
+    n = convert(args.source, args.target)
+    print(f"{args.source} -> {args.target}: {n} points, {os.path.getsize(args.target)} bytes")